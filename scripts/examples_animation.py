@@ -303,7 +303,7 @@ def main(simulationNumber=0, saveFigures=False):
         N = 20
         x_init = samplePointsAtBorder(N, x_range, y_range)
         collisions = obs_check_collision(x_init, obs)
-        x_init = x_init[:,collisions[0]]
+        x_init = x_init[:,collisions]
 
         attractorPos = [4,8]
 
@@ -85,6 +85,14 @@ def main():
 
     # Simulation_vectorFields(x_lim, y_lim, N_resol, obs, xAttractor=xAttractor, saveFigure=saveFigures, figName='linearSystem_avoidanceCube', noTicks=False, figureSize=(6.,5))
     
+def obs_avoidance_pointwise(x, xd, obs):
+    ''' Modulation of the velocities xd [dim x N] point by point (the learned obstacles are not evaluated on arrays) '''
+    xd_mod = np.zeros(xd.shape)
+    for j in range(x.shape[1]):
+        xd_mod[:, j] = obs_avoidance_interpolation_moving(x[:, j], xd[:, j], obs)
+    return xd_mod
+
+
 def plot_streamlines_sensory(sensor_data, points_init, ax, attractorPos=[0,0],
                              dim=2, dt=0.01, max_simu_step=300, convergence_margin=0.03):
 
@@ -106,20 +114,24 @@ def plot_streamlines_sensory(sensor_data, points_init, ax, attractorPos=[0,0],
     for iSim in range(max_simu_step):
 
         print("Simulation step #{}".format(iSim))
-        for j in range(n_points):
-            start_time_createFromScan = time.time()
-            time_clust, time_obstacleLearning = ObstaclesScanned.get_obstacle_from_scan(sensor_data=sensor_data)
+        # The scan is evaluated once per step for all points
+        start_time_createFromScan = time.time()
+        time_clust, time_obstacleLearning = ObstaclesScanned.get_obstacle_from_scan(sensor_data=sensor_data)
+
+        time_tot_createFromScan += time.time()-start_time_createFromScan
+        time_tot_clustering += time_clust
+        time_tot_obstacleLearning += time_obstacleLearning
 
-            time_tot_createFromScan += time.time()-start_time_createFromScan
-            time_tot_clustering += time_clust
-            time_tot_obstacleLearning += time_obstacleLearning
+        # Converged trajectories are not evaluated anymore
+        ind_active = (np.sum((x_pos[:, iSim, :]-np.tile(attractorPos, (n_points,1)).T)**2, axis=0)
+                      >= convergence_margin)
 
-            start_time_modulation = time.time()
-            x_pos[:, iSim+1,j] = obs_avoidance_rk4(
-                dt, x_pos[:,iSim, j], obs=ObstaclesScanned.obs_list, x0=attractorPos,
-                obs_avoidance=obs_avoidance_interpolation_moving)
+        start_time_modulation = time.time()
+        x_pos[:, iSim+1, :] = obs_avoidance_rk4_batch(
+            dt, x_pos[:, iSim, :], obs=ObstaclesScanned.obs_list, x0=attractorPos,
+            obs_avoidance=obs_avoidance_pointwise, ind_active=ind_active)
 
-            time_tot_modulation += (time.time()-start_time_modulation)
+        time_tot_modulation += (time.time()-start_time_modulation)
             
          # Check convergence
         if (np.sum((x_pos[:, iSim+1, :]-np.tile(attractorPos, (n_points,1)).T)**2)
@@ -0,0 +1,79 @@
+#!/USSR/bin/python3
+# coding: utf-8
+
+'''
+Check of the incremental CommonSectionTracker against obs_common_section & dynamic_center_3d
+(evaluated on copies of the same obstacles) while some obstacles are moving.
+
+@author Lukas Huber
+@date 2020-05-20
+'''
+
+import copy
+import time
+
+import numpy as np
+import numpy.linalg as LA
+
+from dynamic_obstacle_avoidance.obstacle_avoidance.ellipse_obstacles import Ellipse
+from dynamic_obstacle_avoidance.obstacle_avoidance.obs_common_section import obs_common_section, CommonSectionTracker
+from dynamic_obstacle_avoidance.obstacle_avoidance.obs_dynamic_center_3d import dynamic_center_3d
+
+
+def create_obstacles(n_obstacles=40, x_range=[0, 20], y_range=[0, 10], seed=0):
+    np.random.seed(seed)
+    obs = []
+    for ii in range(n_obstacles):
+        obs.append(Ellipse(
+            axes_length=np.random.uniform(0.3, 1.5, 2),
+            center_position=np.array([np.random.uniform(x_range[0], x_range[1]), np.random.uniform(y_range[0], y_range[1])]),
+            orientation=np.random.uniform(-np.pi, np.pi),
+            margin_absolut=np.random.choice([0, 0.1])))
+    return obs
+
+
+def compare_tracker(n_obstacles=40, ind_moving=[1, 7, 20], n_steps=5, step_size=0.8, seed=0):
+    ''' Returns the maximum distance of the reference points and the number of steps with different groups '''
+    obs = create_obstacles(n_obstacles, seed=seed)
+    tracker = CommonSectionTracker()
+
+    max_dist = 0
+    n_group_mismatch = 0
+    time_tracker, time_scratch = 0, 0
+    for it_step in range(n_steps+1):
+        if it_step: # Move obstacles
+            for ii in ind_moving:
+                obs[ii].center_position = obs[ii].center_position + np.random.uniform(-step_size, step_size, 2)
+                obs[ii].orientation = obs[ii].orientation + np.random.uniform(-0.5, 0.5)
+
+        obs_scratch = copy.deepcopy(obs)
+        t_start = time.time()
+        intersection_obs = obs_common_section(obs_scratch)
+        dynamic_center_3d(obs_scratch, intersection_obs)
+        time_scratch += time.time() - t_start
+
+        t_start = time.time()
+        intersection_tracker = tracker.update(obs)
+        time_tracker += time.time() - t_start
+
+        if sorted(intersection_obs) != sorted(intersection_tracker):
+            n_group_mismatch += 1
+
+        for ii in range(n_obstacles):
+            dist = LA.norm(obs[ii].get_reference_point(in_global_frame=True)
+                           - obs_scratch[ii].get_reference_point(in_global_frame=True))
+            max_dist = max(max_dist, dist)
+
+        print("Step {}: {} groups, {} pair evaluations, max reference point distance {:.2e}".format(
+            it_step, len(intersection_tracker), tracker.n_pair_evaluations, max_dist))
+
+    print("Time tracker: {:.3f}s -- from scratch: {:.3f}s".format(time_tracker, time_scratch))
+    return max_dist, n_group_mismatch
+
+
+if (__name__)=="__main__":
+    max_dist, n_group_mismatch = compare_tracker()
+    if max_dist > 1e-6 or n_group_mismatch:
+        raise ValueError("Tracker differs from the evaluation from scratch (distance {}, {} group mismatches).".format(
+            max_dist, n_group_mismatch))
+    print("Tracker equal to evaluation from scratch.")
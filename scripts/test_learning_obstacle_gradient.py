@@ -13,6 +13,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import copy
+import os
 
 # Custom libraries
 from dynamic_obstacle_avoidance.dynamical_system.dynamical_system_representation import *
@@ -46,17 +47,15 @@ def create_obstacle_from_data(file_in_path, file_in_name, save_data=True):
     Obstacles = LearningContainer()
     Obstacles.create_obstacles_from_data(data=X, label=y, plot_raw_data=True)
 
-    return Obstacles
+    if save_data:
+        Obstacles.save_obstacles_to_file(file_in_path+file_in_name+"_obstacles.npz")
 
-    # TODO: save data to file
-    # if save_data:
-        # file_name = file_in_path+file_in_name + "csv"
-        # pickle.dump(Obstacles, file_name)
+    return Obstacles
 
-def read_obstacle_from_file(file_in_path, file_name):
-    # TODO: make it work
-    file_type = ".txt"
-    file_name = file_in_path+file_in_name+file_type
+def read_obstacle_from_file(file_in_path, file_in_name):
+    Obstacles = LearningContainer()
+    Obstacles.load_obstacles_from_file(file_in_path+file_in_name+"_obstacles.npz")
+    return Obstacles
 
 def create_normal_vector_field(Obstacles, resolution=20, x_range=[0, 1], y_range=[0, 1]):
     YY, XX = np.mgrid[y_range[0]:y_range[1]:resolution*1j, x_range[0]:x_range[1]:resolution*1j]
@@ -169,7 +168,10 @@ plt.close('all')
 
 if not ('Obstacles' in locals()):
     print("Imported obstacles")
-    Obstacles = create_obstacle_from_data(data_set_path, file_name_in)
+    if os.path.isfile(data_set_path+file_name_in+"_obstacles.npz"):
+        Obstacles = read_obstacle_from_file(data_set_path, file_name_in)
+    else:
+        Obstacles = create_obstacle_from_data(data_set_path, file_name_in)
 
 for oo in range(len(Obstacles)):
     Obstacles[oo].draw_obstacle(show_contour=True)
@@ -180,5 +182,3 @@ for oo in range(len(Obstacles)):
 attractor = np.array([0.8, 0.2])
 # create_modulated_vector_field(Obstacles, attractor, resolution=30, plot_type_quiver=True)
 create_modulated_vector_field(Obstacles, attractor, resolution=80, plot_type_quiver=False)
-
-# read_obstacle_from_file(file_in_path, file_in_name)
@@ -51,6 +51,31 @@ def linearAttractor_const(x, x0 = 'default', velConst=0.3, distSlow=0.01):
     return dx
         
 
+def velConst_attr(x, vel, x0=False, velConst=6, distSlow=0.01):
+    ''' Velocity with constant magnitude velConst, which decreases linearly 
+    within the distance distSlow to the attractor x0.
+    x, vel [dim] or [dim x N] '''
+    x = np.array(x, dtype=float)
+    vel = np.array(vel, dtype=float)
+    dim = x.shape[0]
+
+    if type(x0)==bool:
+        x0 = np.zeros(dim)
+
+    x_shape = vel.shape
+    x = np.reshape(x, (dim, -1))
+    vel = np.reshape(vel, (dim, -1))
+
+    dist_mag = LA.norm(x - np.reshape(x0, (dim, 1)), axis=0)
+    new_mag = np.minimum(velConst, dist_mag/distSlow*velConst)
+
+    vel_mag = LA.norm(vel, axis=0)
+    ind_nonzero = vel_mag>0
+    vel[:, ind_nonzero] = vel[:, ind_nonzero]/vel_mag[ind_nonzero]*new_mag[ind_nonzero]
+
+    return vel.reshape(x_shape)
+
+
 def nonlinear_wavy_DS(x, x0=[0,0]):
     xd = np.zeros((np.array(x).shape))
     if len(xd.shape)>1:
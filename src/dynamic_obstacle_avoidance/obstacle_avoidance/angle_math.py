@@ -30,6 +30,9 @@ def angle_modulo(angle):
 
 def angle_difference_directional_2pi(angle1, angle2):
     angle_diff = (angle1-angle2)
+    if isinstance(angle_diff, np.ndarray) and angle_diff.shape:
+        # Multiple angles
+        return np.mod(angle_diff, 2*pi)
     while angle_diff > 2*pi:
         angle_diff -= 2*pi
     while angle_diff < 0:
@@ -43,6 +46,9 @@ def angle_difference_directional(angle1, angle2):
     Note: angle1-angle2 (non-commutative)
     '''
     angle_diff = (angle1-angle2)
+    if isinstance(angle_diff, np.ndarray) and angle_diff.shape:
+        # Multiple angles
+        return -(np.mod(pi-angle_diff, 2*pi) - pi)
     while angle_diff > pi:
         angle_diff = angle_diff-2*pi
     while angle_diff <= -pi:
@@ -170,6 +176,57 @@ def get_orthogonal_basis(vector, normalize=True):
     return basis_matrix
 
 
+def get_orthogonal_basis_batch(vectors, normalize=True):
+    '''
+    Orthonormal basis for each column of vectors [dim x N]
+    Returns basis matrices of shape [dim x dim x N], equal to get_orthogonal_basis() per column.
+    '''
+    vectors = np.array(vectors, dtype=float)
+    dim, n_vectors = vectors.shape
+
+    if normalize:
+        v_norm = np.linalg.norm(vectors, axis=0)
+        if not np.all(v_norm):
+            raise ValueError("Orthogonal basis Matrix not defined for 0-direction vector.")
+        vectors = vectors / v_norm
+
+    basis_matrix = np.zeros((dim, dim, n_vectors))
+
+    if dim == 2:
+        basis_matrix[:, 0, :] = vectors
+        basis_matrix[0, 1, :] = vectors[1, :]
+        basis_matrix[1, 1, :] = -vectors[0, :]
+
+    elif dim == 3:
+        basis_matrix[:, 0, :] = vectors
+        basis_matrix[0, 1, :] = -vectors[1, :]
+        basis_matrix[1, 1, :] = vectors[0, :]
+
+        norm_vec2 = np.linalg.norm(basis_matrix[:, 1, :], axis=0)
+        ind_nonzero = norm_vec2 > 0
+        basis_matrix[:, 1, ind_nonzero] = basis_matrix[:, 1, ind_nonzero] / norm_vec2[ind_nonzero]
+        basis_matrix[0, 1, ~ind_nonzero] = 1
+
+        basis_matrix[:, 2, :] = np.cross(basis_matrix[:, 0, :], basis_matrix[:, 1, :], axis=0)
+
+        norm_vec = np.linalg.norm(basis_matrix[:, 2, :], axis=0)
+        ind_nonzero = norm_vec > 0
+        basis_matrix[:, 2, ind_nonzero] = basis_matrix[:, 2, ind_nonzero] / norm_vec[ind_nonzero]
+
+    else:
+        basis_matrix[:, 0, :] = vectors
+        for ii in range(1, dim):
+            ind_nonzero = vectors[ii, :] != 0
+            column = np.zeros((ii+1, np.sum(ind_nonzero)))
+            column[:ii, :] = vectors[:ii, ind_nonzero]
+            column[ii, :] = -np.sum(vectors[:ii, ind_nonzero]**2, axis=0) / vectors[ii, ind_nonzero]
+            basis_matrix[:ii+1, ii, ind_nonzero] = column / np.linalg.norm(column, axis=0)
+
+            basis_matrix[ii, ii, ~ind_nonzero] = 1
+
+    return basis_matrix
+
+
 def get_angle_space(reference_direction, directions, normalize=True):
     """
     Get angle space transformation
@@ -305,6 +362,78 @@ def get_directional_weighted_sum(reference_direction, directions, weights, total
     return direction_weightedSum
 
 
+def get_directional_weighted_sum_batch(reference_direction, directions, weights, total_weight=1, normalize=True, normalize_reference=True):
+    '''
+    Batch version of get_directional_weighted_sum() for N query points at once.
+
+    # INPUT
+    reference_direction [dim x N]: basis direction for the angle-frame of each point
+    directions [dim x K x N]: the directions which the weighted sum is taken from
+    weights [K x N]: used for weighted sum (directions with zero weight are ignored)
+    total_weight [float or N]: [<=1]
+
+    # OUTPUT
+    weighted directions [dim x N]
+    '''
+    reference_direction = np.array(reference_direction, dtype=float)
+    directions = np.array(directions, dtype=float)
+    weights = np.array(weights, dtype=float)
+    dim, n_directions, n_points = directions.shape
+    total_weight = total_weight*np.ones(n_points)
+
+    weights = np.where(weights>0, weights, 0) # non-negative
+    ind_partial = total_weight<1
+    weight_sum = np.sum(weights[:, ind_partial], axis=0)
+    weight_sum[weight_sum==0] = 1
+    weights[:, ind_partial] = weights[:, ind_partial]/weight_sum * total_weight[ind_partial]
+
+    # Single direction -- returned as it is
+    ind_single = (np.sum(weights>0, axis=0)==1) & ~ind_partial
+    direction_single = directions[:, np.argmax(weights>0, axis=0), np.arange(n_points)]
+    
+    if normalize_reference:
+        norm_refDir = np.linalg.norm(reference_direction, axis=0)
+        if np.any(norm_refDir[~ind_single]==0):
+            raise ValueError("Zero norm direction as input")
+        norm_refDir[norm_refDir==0] = 1
+        reference_direction = reference_direction/norm_refDir
+
+    if normalize:
+        norm_dir = np.linalg.norm(directions, axis=0)
+        ind_nonzero = (norm_dir>0)
+        directions[:, ind_nonzero] = directions[:, ind_nonzero]/norm_dir[ind_nonzero]
+
+    reference_direction[:, ind_single & ~np.any(reference_direction, axis=0)] = 1 # Dummy basis (not used)
+    OrthogonalBasisMatrix = get_orthogonal_basis_batch(reference_direction, normalize=False)
+
+    directions_referenceSpace = np.einsum('jin,jkn->ikn', OrthogonalBasisMatrix, directions)
+    directions_directionSpace = directions_referenceSpace[1:, :, :]
+
+    norm_dirSpace = np.linalg.norm(directions_directionSpace, axis=0)
+    ind_nonzero = (norm_dirSpace > 0)
+    directions_directionSpace[:, ind_nonzero] = directions_directionSpace[:, ind_nonzero] / norm_dirSpace[ind_nonzero]
+
+    # Numerical error correction
+    cos_directions = np.clip(directions_referenceSpace[0, :, :], -1, 1)
+
+    directions_directionSpace *= np.arccos(cos_directions)
+    direction_dirSpace_weightedSum = np.sum(directions_directionSpace*weights, axis=1)
+
+    norm_directionSpace_weightedSum = np.linalg.norm(direction_dirSpace_weightedSum, axis=0)
+    ind_nonzero = norm_directionSpace_weightedSum > 0
+
+    direction_weightedSum = np.copy(OrthogonalBasisMatrix[:, 0, :])
+    if np.sum(ind_nonzero):
+        norm_sum = norm_directionSpace_weightedSum[ind_nonzero]
+        direction_angleSpace = np.vstack((np.cos(norm_sum),
+                                          np.sin(norm_sum)/norm_sum * direction_dirSpace_weightedSum[:, ind_nonzero]))
+        direction_weightedSum[:, ind_nonzero] = np.einsum('ijn,jn->in', OrthogonalBasisMatrix[:, :, ind_nonzero], direction_angleSpace)
+
+    direction_weightedSum[:, ind_single] = direction_single[:, ind_single]
+
+    return direction_weightedSum
+
+
 def periodic_weighted_sum(angles, weights, reference_angle=None):
     '''Weighted Average of angles (1D)'''
     # TODO: unify with directional_weighted_sum() // see above
@@ -0,0 +1,255 @@
+'''
+Struct-of-arrays snapshot of an obstacle environment.
+
+The parameters of all obstacles are packed in contiguous arrays such that the
+gamma, normal and reference directions can be evaluated for all obstacles and
+positions at once (instead of calling the properties of each obstacle object).
+
+@author Lukas Huber
+@date 2020-04-20
+'''
+
+import numpy as np
+import numpy.linalg as LA
+import sys
+
+from dynamic_obstacle_avoidance.obstacle_avoidance.obstacle import Obstacle
+from dynamic_obstacle_avoidance.obstacle_avoidance.ellipse_obstacles import Ellipse, get_local_radius_ellipse_batch
+
+
+class CompiledEnvironment():
+    '''
+    Snapshot of the obstacles (of a container or a list).
+
+    Ellipses with the reference point inside the obstacle are evaluated with array
+    operations (compiled), all other obstacles through the methods of the obstacle.
+
+    Arrays (N: number of obstacles)
+    center_position [N x dim]
+    rotation_matrix [N x dim x dim]
+    axes_length, axes_with_margin, curvature, reference_point, linear_velocity [N x dim]
+    angular_velocity [N] in 2D / [N x 3] in 3D
+    sigma, margin_absolut [N]
+    is_boundary, is_compiled [N] (bool)
+    bounding_radius [N]: radius of a sphere around the center which contains the (extended) hull
+    gamma_radius [N]: Gamma(x) >= |x-center| / gamma_radius (infinite if no bound is known)
+    '''
+    def __init__(self, obs_list=None):
+        self._obstacle_list = []
+        self._state_versions = []
+        self._source_list = None
+        self._modification_counter = None
+        self.version = 0 # Increased with each rebuild
+
+        if not obs_list is None:
+            self.update(obs_list)
+
+    def __len__(self):
+        return len(self._obstacle_list)
+
+    def __repr__(self):
+        return "CompiledEnvironment of {} obstacles (version #{})".format(len(self), self.version)
+
+    @property
+    def dim(self):
+        return self.center_position.shape[1]
+
+    @property
+    def dimension(self):
+        return self.dim
+
+    @property
+    def list(self):
+        return self._obstacle_list
+
+    def is_outdated(self, obs_list):
+        ''' Check if an obstacle has been added, removed or changed since the last build.
+        The obstacles are only compared one by one if any obstacle or container has been
+        modified (Obstacle.modification_counter) or if the list is not the one of the last build. '''
+        if len(obs_list) != len(self._obstacle_list):
+            return True
+
+        if (obs_list is self._source_list
+            and Obstacle.modification_counter == self._modification_counter):
+            return False
+
+        for oo in range(len(obs_list)):
+            if (not obs_list[oo] is self._obstacle_list[oo]
+                or obs_list[oo].state_version != self._state_versions[oo]):
+                return True
+
+        # Unchanged (e.g. only obstacles of another environment were modified)
+        self._source_list = obs_list
+        self._modification_counter = Obstacle.modification_counter
+        return False
+
+    def update(self, obs_list, force_rebuild=False):
+        ''' Rebuild the arrays if the obstacles changed. Returns True if rebuilt. '''
+        if not force_rebuild and not self.is_outdated(obs_list):
+            return False
+
+        self._obstacle_list = [obs for obs in obs_list]
+        self._state_versions = [obs.state_version for obs in obs_list]
+        self._source_list = obs_list
+        self._modification_counter = Obstacle.modification_counter
+        self.version += 1
+
+        n_obs = len(obs_list)
+        if not n_obs:
+            return True
+        dim = obs_list[0].dim
+
+        self.center_position = np.zeros((n_obs, dim))
+        self.rotation_matrix = np.zeros((n_obs, dim, dim))
+        self.reference_point = np.zeros((n_obs, dim))
+        self.linear_velocity = np.zeros((n_obs, dim))
+        if dim==3:
+            self.angular_velocity = np.zeros((n_obs, dim))
+        else:
+            self.angular_velocity = np.zeros(n_obs)
+        self.sigma = np.zeros(n_obs)
+        self.is_boundary = np.zeros(n_obs, dtype=bool)
+
+        # Geometry (ellipse only)
+        self.is_compiled = np.zeros(n_obs, dtype=bool)
+        self.axes_length = np.ones((n_obs, dim))
+        self.axes_with_margin = np.ones((n_obs, dim))
+        self.curvature = np.ones((n_obs, dim))
+        self.margin_absolut = np.zeros(n_obs)
+
+        self.bounding_radius = np.ones(n_obs)*np.inf
+        self.gamma_radius = np.ones(n_obs)*np.inf
+
+        for oo, obs in enumerate(obs_list):
+            self.center_position[oo, :] = obs.center_position
+            self.rotation_matrix[oo, :, :] = obs.rotMatrix
+            self.reference_point[oo, :] = obs.local_reference_point
+            self.linear_velocity[oo, :] = obs.xd
+            if dim==2:
+                self.angular_velocity[oo] = np.squeeze(obs.w)
+            elif dim==3:
+                self.angular_velocity[oo, :] = obs.w
+            self.sigma[oo] = obs.sigma
+            self.is_boundary[oo] = obs.is_boundary
+
+            if isinstance(obs, Ellipse):
+                self.is_compiled[oo] = (obs.reference_point_is_inside
+                                        and not obs.hull_with_respect_to_reference)
+                self.axes_length[oo, :] = obs.axes_length
+                self.axes_with_margin[oo, :] = obs.axes_with_margin
+                self.curvature[oo, :] = obs.p # Raw value (equal to get_normal_ellipse)
+                self.margin_absolut[oo] = obs.margin_absolut
+                self.bounding_radius[oo] = obs.get_bounding_radius()
+
+            self.gamma_radius[oo] = obs.get_gamma_bound_radius()
+        return True
+
+    def get_influence_radius(self, gamma_cutoff):
+        ''' Distance from the center beyond which Gamma>=gamma_cutoff for sure [N] '''
+        return self.gamma_radius*gamma_cutoff
+
+    def get_obstacle_candidates(self, position, gamma_cutoff):
+        '''
+        Obstacles which can have Gamma<gamma_cutoff at the positions [dim x M] (brute force).
+        Returns a boolean array [N x M]
+        '''
+        dist = LA.norm(position[:, np.newaxis, :] - self.center_position.T[:, :, np.newaxis], axis=0)
+        return dist < self.get_influence_radius(gamma_cutoff)[:, np.newaxis]
+
+    def transform_global2relative(self, position):
+        ''' Position [dim x M] in global frame to [dim x N x M] in the frames of the obstacles'''
+        position = position[:, np.newaxis, :] - self.center_position.T[:, :, np.newaxis]
+        return np.einsum('nji,jnm->inm', self.rotation_matrix, position)
+
+    def transform_relative2global_dir(self, direction):
+        ''' Direction [dim x N x M] from the frames of the obstacles to the global frame '''
+        if self.dim > 3:
+            return direction
+        return np.einsum('nij,jnm->inm', self.rotation_matrix, direction)
+
+    def transform_global2relative_dir(self, direction):
+        ''' Direction [dim x M] (global) to [dim x N x M] in the frames of the obstacles '''
+        if self.dim > 3:
+            return np.tile(direction, (len(self), 1, 1)).transpose(1, 0, 2)
+        return np.einsum('nji,jm->inm', self.rotation_matrix, direction)
+
+    def get_gamma(self, position, ind_evaluate=None):
+        '''
+        Gamma of all obstacles with positions [dim x N x M] in the obstacle frames.
+        Only the pairs ind_evaluate [N x M] (bool) are evaluated, the others are set to infinity.
+        Returns [N x M]
+        '''
+        if ind_evaluate is None:
+            ind_evaluate = np.ones(position.shape[1:], dtype=bool)
+        Gamma = np.ones(position.shape[1:])*np.inf
+
+        ind_compiled = ind_evaluate & self.is_compiled[:, np.newaxis]
+        if np.sum(ind_compiled):
+            ind_obs = np.nonzero(ind_compiled)[0]
+            pos = position[:, ind_compiled]
+            dist_position = LA.norm(pos, axis=0)
+
+            radius = get_local_radius_ellipse_batch(
+                pos, self.reference_point[ind_obs].T, self.axes_with_margin[ind_obs].T)
+
+            gamma = np.zeros(dist_position.shape)
+            ind_nonzero = dist_position > 0
+            gamma[ind_nonzero] = dist_position[ind_nonzero] / radius[ind_nonzero]
+
+            ind_boundary = self.is_boundary[ind_obs]
+            gamma[ind_boundary & ind_nonzero] = 1/gamma[ind_boundary & ind_nonzero]
+            gamma[ind_boundary & ~ind_nonzero] = sys.float_info.max
+
+            Gamma[ind_compiled] = gamma
+
+        for oo in np.arange(len(self))[~self.is_compiled]:
+            if np.sum(ind_evaluate[oo, :]):
+                Gamma[oo, ind_evaluate[oo, :]] = self._obstacle_list[oo].get_gamma(
+                    position[:, oo, ind_evaluate[oo, :]], in_global_frame=False)
+        return Gamma
+
+    def get_normal_direction(self, position, normalize=True, ind_evaluate=None):
+        '''
+        Normal direction of all obstacles with positions [dim x N x M] in the obstacle frames.
+        Only the pairs ind_evaluate [N x M] (bool) are evaluated, the others are zero.
+        Returns [dim x N x M] (in the obstacle frames)
+        '''
+        if ind_evaluate is None:
+            ind_evaluate = np.ones(position.shape[1:], dtype=bool)
+        normal_vector = np.zeros(position.shape)
+
+        ind_compiled = ind_evaluate & self.is_compiled[:, np.newaxis]
+        if np.sum(ind_compiled):
+            ind_obs = np.nonzero(ind_compiled)[0]
+            axes = self.axes_length[ind_obs].T
+            curvature = self.curvature[ind_obs].T
+            normal = 2*curvature/axes * (position[:, ind_compiled]/axes)**(2*curvature-1)
+            if normalize:
+                normal = normal / LA.norm(normal, axis=0)
+            normal_vector[:, ind_compiled] = normal
+
+        for oo in np.arange(len(self))[~self.is_compiled]:
+            if np.sum(ind_evaluate[oo, :]):
+                normal_vector[:, oo, ind_evaluate[oo, :]] = self._obstacle_list[oo].get_normal_direction(
+                    position[:, oo, ind_evaluate[oo, :]], in_global_frame=False, normalize=normalize)
+        return normal_vector
+
+    def get_reference_direction(self, position, normalize=True, ind_evaluate=None):
+        '''
+        Reference direction of all obstacles with positions [dim x N x M] in the obstacle frames.
+        Only the pairs ind_evaluate [N x M] (bool) are evaluated, the others are zero.
+        Returns [dim x N x M] (in the obstacle frames)
+        '''
+        if ind_evaluate is None:
+            ind_evaluate = np.ones(position.shape[1:], dtype=bool)
+        reference_direction = np.zeros(position.shape)
+
+        ind_obs = np.nonzero(ind_evaluate)[0]
+        reference = self.reference_point[ind_obs].T - position[:, ind_evaluate]
+
+        if normalize:
+            ref_norm = LA.norm(reference, axis=0)
+            ind_nonzero = ref_norm > 0
+            reference[:, ind_nonzero] = reference[:, ind_nonzero]/ref_norm[ind_nonzero]
+        reference_direction[:, ind_evaluate] = reference
+        return reference_direction
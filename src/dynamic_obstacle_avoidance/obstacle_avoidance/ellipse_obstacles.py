@@ -23,11 +23,46 @@ from dynamic_obstacle_avoidance.obstacle_avoidance.obs_dynamic_center_3d import
 
 from dynamic_obstacle_avoidance.obstacle_avoidance.obstacle import Obstacle
 
-import matplotlib.pyplot as plt
 # import quaternion
 
 visualize_debug = False
 
+
+def get_local_radius_ellipse_batch(position, reference_point, axes):
+    '''
+    Distance from the reference point to the ellipse surface (x_1/a_1)^2 + ... + (x_d/a_d)^2 = 1
+    along the line reference_point + t*(position-reference_point).
+
+    The intersection is chosen as in get_intersection_with_surface(only_positive_direction=True):
+    the one with the larger x_1-coordinate, unless it lies in positive line-direction.
+    If the reference point is inside the ellipse, this is the intersection behind the reference point.
+
+    All arrays have the dimension as first axis, the remaining axes are broadcasted.
+    Returns nan if the line does not intersect the ellipse.
+    '''
+    direction = position - reference_point
+
+    # Position at the reference point -- take the direction from the center
+    ind_zero = np.all(direction==0, axis=0)
+    if np.any(ind_zero):
+        direction = np.where(ind_zero, position, direction)
+
+    # Quadratic equation A*t^2 + B*t + C = 0 along the line
+    A = np.sum((direction/axes)**2, axis=0)
+    B = 2*np.sum(reference_point*direction/axes**2, axis=0)
+    C = np.sum((reference_point/axes)**2, axis=0) - 1
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sqrtD = np.sqrt(B*B - 4*A*C)
+        t_large = (-B + sqrtD) / (2*A)
+        t_small = (-B - sqrtD) / (2*A)
+
+        direction_x = direction[0]*np.ones(A.shape)
+        line_parameter = np.where(direction_x>0, np.where(t_large>0, t_small, t_large),
+                                  np.where(direction_x<0, np.where(t_small>0, t_large, t_small), t_small))
+        return np.abs(line_parameter)*np.linalg.norm(direction, axis=0)
+
+
 class Ellipse(Obstacle):
     ''' Ellipse type obstacle 
     Geometry specifi attributes are
@@ -35,6 +70,9 @@ class Ellipse(Obstacle):
     curvature: float / array (list)
     '''
     # self.ellipse_type = dynamic_obstacle_avoidance.obstacle_avoidance.obstacle.Ellipse
+    lazy_boundary_points = True
+    boundary_resolution = 20
+
     def __init__(self, axes_length=None, curvature=None,
                  a=None, p=None,
                  margin_absolut=0,
@@ -108,6 +146,7 @@ class Ellipse(Obstacle):
     @axes_length.setter
     def axes_length(self, value):
         self._axes_length = value
+        self.increment_shape_version()
 
     @property
     def p(self): # TODO: remove
@@ -129,6 +168,7 @@ class Ellipse(Obstacle):
             self._curvature = np.array(value)
         else:
             self._curvature = value
+        self.increment_shape_version()
 
     @property
     def margin_absolut(self):
@@ -137,10 +177,15 @@ class Ellipse(Obstacle):
     @margin_absolut.setter
     def margin_absolut(self, value):
         self._margin_absolut = value
+        self.increment_shape_version()
 
     @property
     def axes_with_margin(self):
         return self.axes_length + self.margin_absolut
+
+    @property
+    def radius_depends_only_on_direction(self):
+        return self.reference_point_is_inside
     
     def get_minimal_distance(self):
         return np.min(self.a)
@@ -151,6 +196,30 @@ class Ellipse(Obstacle):
         
     def get_reference_length(self):
         return LA.norm(self.axes_length) + self.margin_absolut
+
+    def get_bounding_radius(self):
+        ''' Radius of a sphere around the center which contains the (extended) hull '''
+        # The superellipse is within the box of the axes
+        bounding_radius = LA.norm(self.axes_with_margin)
+        if not self.reference_point_is_inside:
+            bounding_radius = max(bounding_radius, np.max(LA.norm(self.edge_reference_points, axis=0)))
+        return bounding_radius
+
+    def get_bounding_box(self):
+        if self.is_boundary or not self.reference_point_is_inside:
+            return super().get_bounding_box()
+
+        # Rotated box of the axes, which is limited by the bounding sphere
+        half_width = np.abs(self.rotMatrix).dot(self.axes_with_margin)
+        half_width = np.minimum(half_width, self.get_bounding_radius())
+        center_position = np.array(self.center_position, dtype=float)
+        return center_position-half_width, center_position+half_width
+
+    def get_gamma_bound_radius(self):
+        if self.is_boundary:
+            return np.inf
+        # The local radius is the distance between the reference point and a point on the hull
+        return LA.norm(self.local_reference_point) + self.get_bounding_radius()
     
 
     def calculate_normalVectorAndDistance(self):
@@ -232,8 +301,14 @@ class Ellipse(Obstacle):
         '''
         Return normal to ellipse surface
         '''
+        if len(position.shape)>1:
+            # Multiple positions [dim x N]
+            axes = np.reshape(self.axes_length, (-1, 1))
+            p = np.reshape(self.p, (-1, 1))
+            return (2*p/axes*(position/axes)**(2*p-1))
+
         return (2*self.p/self.axes_length*(position/self.axes_length)**(2*self.p-1))
-    
+
 
     def get_angle2referencePatch(self, position, max_angle=pi, in_global_frame=False):
         '''
@@ -274,6 +349,22 @@ class Ellipse(Obstacle):
             position = position-self.reference_point
             raise NotImplementedError("Everything needs to be with respect to reference.")
 
+        if len(position.shape)>1:
+            # Multiple positions [dim x N]
+            if self.reference_point_is_inside:
+                normal_vector = self.get_normal_ellipse(position)
+            else:
+                normal_vector = np.zeros(position.shape)
+                for pp in range(position.shape[1]):
+                    normal_vector[:, pp] = self.get_normal_direction(position[:, pp], normalize=False)
+
+            if normalize:
+                normal_vector = normal_vector/LA.norm(normal_vector, axis=0)
+
+            if in_global_frame:
+                normal_vector = self.transform_relative2global_dir(normal_vector)
+            return normal_vector
+
         if self.reference_point_is_inside or self.position_is_in_direction_of_ellipse(position):
             normal_vector = self.get_normal_ellipse(position)
         else:
@@ -474,21 +565,23 @@ class Ellipse(Obstacle):
     def _get_local_radius_ellipse(self, position, reference_point):
         '''
         Get radius of ellipse in direction of position from the reference point
-
-        # TODO: include in previous example
+        Position [dim] or [dim x N]; nan if there is no intersection
         '''
-        # intersection = self.get_intersection_with_surface(reference_point, position-reference_point, only_positive_direction=True)
-        intersection = self.get_intersection_with_surface(reference_point, position-reference_point, only_positive_direction=True)
-        
-        try:
-            return np.linalg.norm(intersection-reference_point)
-        except:
-            import pdb; pdb.set_trace() ## DEBUG ##
+        if len(position.shape)>1:
+            reference_point = np.reshape(reference_point, (-1, 1))
+            axes = np.reshape(self.axes_with_margin, (-1, 1))
+        else:
+            axes = self.axes_with_margin
+        return get_local_radius_ellipse_batch(position, reference_point, axes)
 
     
     def _get_local_radius(self, position, reference_point=None):
+        '''
+        Radius of the obstacle in direction of the positions [dim x N] (all points at once).
+        If the reference point is outside of the ellipse, the radius is evaluated with
+        respect to the hull which is extended around the reference point (edge_reference_points).
+        '''
         # TODO: test for margin / reference point
-        # TODO: improve speed
         if reference_point is None:
             reference_point = self.reference_point
 
@@ -498,45 +591,61 @@ class Ellipse(Obstacle):
 
         margin_absolut = self.margin_absolut
         
-        n_points = position.shape[1]
+        if self.reference_point_is_inside:
+            return self._get_local_radius_ellipse(position, reference_point)
+
+        if not self.dim==2:
+            raise NotImplementedError("Extended hull only implemented for d=2.")
 
-        radius = np.zeros(position.shape[1])
-        
         # Original Gamma
-        if self.dim==2:
-            if (self.reference_point_is_inside):
-                for pp in range(n_points):
-                    radius[pp] = self._get_local_radius_ellipse(position[:, pp], reference_point)
-            else:
-                for pp in range(n_points):
-                    if self.position_is_in_direction_of_ellipse(position[:, pp]):
-                        radius[pp] = self._get_local_radius_ellipse(position[:, pp], reference_point)
-                    else:
-                        angle_position = np.arctan2(position[1, pp], position[0, pp])
+        radius = np.zeros(position.shape[1])
 
-                        dist_intersect = -1
-                        for ii, sign in zip(range(self.n_planes), [1,-1]):
-                            angle_ref = np.arctan2(self.edge_reference_points[1,self.ind_edge_ref, ii], self.edge_reference_points[0,self.ind_edge_ref, ii])
+        ind_ellipse = self.position_is_in_direction_of_ellipse(position)
+        if np.sum(ind_ellipse):
+            radius[ind_ellipse] = self._get_local_radius_ellipse(position[:, ind_ellipse], reference_point)
 
-                            # print('angle ref', angle_ref)
+        # Intersection with the hull planes (including the directions which do not intersect the ellipse)
+        ind_hull = ~ind_ellipse | np.isnan(radius)
+        if not np.sum(ind_hull):
+            return radius
+        position = position[:, ind_hull]
+        angle_position = np.arctan2(position[1, :], position[0, :])
 
-                            if sign*angle_difference_directional(angle_ref, angle_position) >= 0:
-                                surface_dir = (self.edge_reference_points[: ,self.ind_edge_ref, ii] - self.edge_reference_points[:, self.ind_edge_tang, 1-ii])
+        dist_intersect = -np.ones(position.shape[1])
+        for ii, sign in zip(range(self.n_planes), [1,-1]):
+            edge_point = self.edge_reference_points[:, self.ind_edge_ref, ii]
+            angle_ref = np.arctan2(edge_point[1], edge_point[0])
+            ind_plane = sign*angle_difference_directional(angle_ref*np.ones(position.shape[1]), angle_position) >= 0
 
-                                dist_intersect, dist_tangent = LA.lstsq(np.vstack((position[:, pp], -surface_dir)).T, self.edge_reference_points[:, self.ind_edge_ref, ii], rcond=-1)[0]
+            if not np.sum(ind_plane):
+                continue
 
-                        if dist_intersect<0: # 
-                            if not margin_absolut:
-                                # import pdb; pdb.set_trace() ## DEBUG ##
-                                raise ValueError("Negative value not possible.")
+            surface_dir = (edge_point - self.edge_reference_points[:, self.ind_edge_tang, 1-ii])
 
-                            intersections = get_intersectionWithEllipse(
-                                edge_point=np.zeros(self.dim), direction=position,
-                                axes=np.ones(self.dim)*margin_absolut)
+            # Solve dist_intersect*position - dist_tangent*surface_dir = edge_point (Cramer's rule)
+            pos_plane = position[:, ind_plane]
+            det = -pos_plane[0, :]*surface_dir[1] + pos_plane[1, :]*surface_dir[0]
+            dist_plane = np.zeros(pos_plane.shape[1])
 
-                            distances = np.linalg.norm(intersections, axis=0)
-                            dist_intersect = np.max(distances)
-                        radius[pp] = dist_intersect
+            ind_regular = det!=0
+            dist_plane[ind_regular] = (-edge_point[0]*surface_dir[1] + edge_point[1]*surface_dir[0])/det[ind_regular]
+            for pp in np.arange(pos_plane.shape[1])[~ind_regular]:
+                dist_plane[pp] = LA.lstsq(np.vstack((pos_plane[:, pp], -surface_dir)).T, edge_point, rcond=-1)[0][0]
+            dist_intersect[ind_plane] = dist_plane
+
+        # The intersection is at dist_intersect*position
+        radius_hull = dist_intersect*LA.norm(position, axis=0)
+
+        ind_negative = dist_intersect<0
+        if np.any(ind_negative):
+            if not margin_absolut:
+                raise ValueError("Negative value not possible.")
+
+            # Intersection with the margin (sphere around the origin) instead
+            radius_hull[ind_negative] = get_local_radius_ellipse_batch(
+                position[:, ind_negative], np.zeros((self.dim, 1)), np.ones((self.dim, 1))*margin_absolut)
+
+        radius[ind_hull] = radius_hull
         return radius
 
     # def get_gamma(self, position, in_global_frame=False, gamma_type='proportional', margin_absolut=None):
@@ -633,10 +742,16 @@ class Ellipse(Obstacle):
         return Gamma
     
     
-    def draw_obstacle(self, numPoints=20, update_core_boundary_points=True, point_density=2*pi/50):
+    def draw_obstacle(self, numPoints=None, update_core_boundary_points=True, point_density=2*pi/50):
         '''
         Creates points for obstacle and obstacle margin
+        (The resolution numPoints is kept for the lazy redrawing, default is boundary_resolution)
         '''
+        if numPoints is None:
+            numPoints = self.boundary_resolution
+        self.boundary_resolution = numPoints
+        self._boundary_key = (self._shape_version, numPoints)
+        
         p = self.p
         a = self.axes_length
         
@@ -8,19 +8,18 @@ Library for the Modulation of Linear Systems
 Copyright (c)2019 under GPU license
 '''
 
-import matplotlib.pyplot as plt
-
 import numpy as np
 import numpy.linalg as LA
 
 from dynamic_obstacle_avoidance.dynamical_system.dynamical_system_representation import *
 from dynamic_obstacle_avoidance.obstacle_avoidance.modulation import *
+from dynamic_obstacle_avoidance.obstacle_avoidance.compiled_environment import CompiledEnvironment
 
 import warnings
 import sys
 
 
-def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPow=2, repulsive_gammaMargin=0.01, repulsive_obstacle=True, velocicity_max=None, evaluate_in_global_frame=False, zero_vel_inside=False):
+def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPow=2, repulsive_gammaMargin=0.01, repulsive_obstacle=True, velocicity_max=None, evaluate_in_global_frame=False, zero_vel_inside=False, gamma_cutoff=None, weight_cutoff=None):
     '''
     This function modulates the dynamical system at position x and dynamics xd such that it avoids all obstacles obs. It can furthermore be forced to converge to the attractor. 
     
@@ -30,6 +29,10 @@ def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPo
     obs [list of obstacle_class]: a list of all obstacles and their properties, which present in the local environment
     attractor [list of [dim]]]: list of positions of all attractors
     weightPow [int]: hyperparameter which defines the evaluation of the weight
+    gamma_cutoff [float>1]: (optional) obstacles with Gamma>=gamma_cutoff are ignored. For an ObstacleContainer the candidates are found with a spatial index, i.e. the cost scales with the local obstacle density.
+    weight_cutoff [float]: (optional) obstacles with a (normalized) weight<weight_cutoff are ignored before the modulation matrices are evaluated
+    
+    Approximation error of the cutoff: the raw weight (1/(Gamma-1))^2 of an ignored obstacle is at most (1/(gamma_cutoff-1))^2, hence the neglected share of the weights is at most n_ignored*((Gamma_min-1)/(gamma_cutoff-1))^2, where Gamma_min is the smallest Gamma of the considered obstacles. If all obstacles are ignored, the initial velocity is returned; the full modulation would differ by the eigenvalues 1-/+1/Gamma (i.e. O(1/gamma_cutoff)) and the obstacle velocity scaled by exp(-(gamma_cutoff-1)/sigma).
     
     OUTPUT
     xd [dim]: modulated dynamical system at position x
@@ -39,6 +42,17 @@ def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPo
     if not N_obs: # No obstacle
         return xd
 
+    if not gamma_cutoff is None:
+        if gamma_cutoff <= 1:
+            raise ValueError("The gamma_cutoff has to be larger than 1.")
+
+        if hasattr(obs, 'get_obstacle_candidates'):
+            ind_candidate = obs.get_obstacle_candidates(x, gamma_cutoff=gamma_cutoff)
+            obs = [obs[ii] for ii in np.arange(N_obs)[ind_candidate]]
+            N_obs = len(obs)
+            if not N_obs:
+                return xd
+
     dim = obs[0].dimension
 
     xd_norm = np.linalg.norm(xd)
@@ -73,7 +87,14 @@ def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPo
 
     if any(Gamma > 1e9):
         return xd
-        
+
+    if not gamma_cutoff is None:
+        ind_relevant = Gamma < gamma_cutoff
+        if not np.sum(ind_relevant):
+            return xd
+        obs = [obs[ii] for ii in np.arange(N_obs)[ind_relevant]]
+        Gamma, pos_relative = Gamma[ind_relevant], pos_relative[:, ind_relevant]
+        N_obs = len(obs)
 
     if N_attr:
         d_a = LA.norm(x - np.array(attractor)) # Distance to attractor
@@ -81,6 +102,13 @@ def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPo
     else:
         weight = compute_weights(Gamma, N_obs)
 
+        if not weight_cutoff is None:
+            ind_relevant = weight >= min(weight_cutoff, np.max(weight)) # Keep at least one
+            obs = [obs[ii] for ii in np.arange(N_obs)[ind_relevant]]
+            Gamma, pos_relative = Gamma[ind_relevant], pos_relative[:, ind_relevant]
+            weight = weight[ind_relevant]/np.sum(weight[ind_relevant])
+            N_obs = len(obs)
+
     # Linear and angular roation of velocity
     # TODO: transform to global/relative frame!
     xd_dx_obs = np.zeros((dim, N_obs))
@@ -138,7 +166,7 @@ def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPo
                 xd_temp = np.copy(xd)
 
             # Modulation with M = E @ D @ E^-1
-            xd_hat[:, n] = E[:,:,n].dot(D[:,:,n]).dot(LA.pinv(E[:,:,n])).dot(xd_temp)
+            xd_hat[:, n] = compute_modulated_velocity(xd_temp, E[:,:,n], E_orth[:,:,n], D[0,0,n], D[1,1,n])
             
             if not evaluate_in_global_frame:
                 xd_hat[:, n] = obs[n].transform_relative2global_dir(xd_hat[:, n])
@@ -203,6 +231,186 @@ def obs_avoidance_interpolation_moving(x, xd, obs=[], attractor='none', weightPo
     return xd
 
 
+def obs_avoidance_interpolation_moving_batch(x, xd, obs=[], attractor='none', weightPow=2, repulsive_gammaMargin=0.01, repulsive_obstacle=True, velocicity_max=None, evaluate_in_global_frame=False, zero_vel_inside=False, gamma_cutoff=None, weight_cutoff=None):
+    '''
+    Batch version of obs_avoidance_interpolation_moving(). The modulation of all positions and obstacles is evaluated with array operations on a snapshot of the obstacles (CompiledEnvironment).
+
+    INPUT
+    x [dim x N]: positions at which the modulation is happening
+    xd [dim x N]: initial dynamical system at the positions x
+    obs [list of obstacle_class / ObstacleContainer / CompiledEnvironment]: obstacles present in the local environment. The snapshot of a container is only rebuilt if an obstacle has changed (see ObstacleContainer.compile)
+    attractor [list of [dim]]]: list of positions of all attractors
+    weightPow [int]: hyperparameter which defines the evaluation of the weight
+    gamma_cutoff, weight_cutoff [float]: optional culling of far obstacles (see obs_avoidance_interpolation_moving)
+
+    OUTPUT
+    xd [dim x N]: modulated dynamical system at the positions x
+    '''
+    x = np.array(x, dtype=float)
+    xd = np.array(xd, dtype=float)
+
+    N_obs = len(obs) #number of obstacles
+    if not N_obs: # No obstacle
+        return xd
+
+    if not (type(attractor)==str and not attractor=='default'):
+        raise NotImplementedError("Attractor weighting is not implemented for batch evaluation.")
+
+    if not gamma_cutoff is None and gamma_cutoff <= 1:
+        raise ValueError("The gamma_cutoff has to be larger than 1.")
+
+    if isinstance(obs, CompiledEnvironment):
+        environment = obs
+    elif hasattr(obs, 'compile'):
+        environment = obs.compile()
+    else:
+        environment = CompiledEnvironment(obs)
+
+    dim = environment.dim
+
+    xd_norm = np.linalg.norm(xd, axis=0)
+    ind_eval = xd_norm > 0 # Trivial solution otherwise
+
+    # Candidate pairs of obstacle and position [N_obs x N]
+    if gamma_cutoff is None:
+        ind_relevant = np.ones((N_obs, x.shape[1]), dtype=bool)
+    elif hasattr(obs, 'get_obstacle_candidates'):
+        ind_relevant = obs.get_obstacle_candidates(x, gamma_cutoff=gamma_cutoff)
+    else:
+        ind_relevant = environment.get_obstacle_candidates(x, gamma_cutoff=gamma_cutoff)
+    ind_relevant[:, ~ind_eval] = False
+
+    # Geometry is evaluated in the obstacle frames [dim x N_obs x N]
+    pos_relative = environment.transform_global2relative(x)
+    Gamma = environment.get_gamma(pos_relative, ind_evaluate=ind_relevant)
+
+    xd_mod = np.copy(xd)
+    if zero_vel_inside:
+        ind_inside = ind_eval & np.any(Gamma < 1, axis=0)
+        xd_mod[:, ind_inside] = 0
+        ind_eval = ind_eval & ~ind_inside
+
+    ind_eval = ind_eval & ~np.any(ind_relevant & (Gamma > 1e9), axis=0)
+
+    if not gamma_cutoff is None:
+        ind_relevant = ind_relevant & (Gamma < gamma_cutoff)
+        ind_eval = ind_eval & np.any(ind_relevant, axis=0)
+
+    if not np.sum(ind_eval):
+        return xd_mod
+
+    # Only evaluate the nontrivial points
+    x = x[:, ind_eval]
+    xd = xd[:, ind_eval]
+    xd_normalized = xd/xd_norm[ind_eval]
+    pos_relative = pos_relative[:, :, ind_eval]
+    Gamma = Gamma[:, ind_eval]
+    ind_relevant = ind_relevant[:, ind_eval]
+    n_points = x.shape[1]
+
+    # Culled obstacles have zero weight
+    weight = compute_weights_batch(np.where(ind_relevant, Gamma, np.inf))
+
+    if not weight_cutoff is None:
+        ind_relevant = ind_relevant & (weight >= np.minimum(weight_cutoff, np.max(weight, axis=0))) # Keep at least one
+        weight[~ind_relevant] = 0
+        weight = weight/np.sum(weight, axis=0)
+
+    # Linear and angular roation of velocity
+    pos_center = x[:, np.newaxis, :] - environment.center_position.T[:, :, np.newaxis]
+    if dim==2:
+        w = environment.angular_velocity[:, np.newaxis]
+        xd_w = w*np.stack((-pos_center[1, :, :], pos_center[0, :, :]))
+    elif dim==3:
+        xd_w = np.cross(environment.angular_velocity[:, np.newaxis, :], pos_center.transpose(1, 2, 0)).transpose(2, 0, 1)
+    else:
+        xd_w = np.zeros((dim, N_obs, n_points))
+        warnings.warn('Angular velocity is not defined for={}'.format(dim))
+
+    #The Exponential term is very helpful as it help to avoid the crazy rotation of the robot due to the rotation of the object
+    exp_weight = np.exp(-1/environment.sigma[:, np.newaxis]*(np.maximum(Gamma, 1)-1))
+    xd_obs_n = exp_weight*(environment.linear_velocity.T[:, :, np.newaxis] + xd_w)
+    xd_obs_n[:, ~ind_relevant] = 0
+    xd_obs = np.sum(xd_obs_n*weight, axis=1)
+
+    xd = xd-xd_obs #computing the relative velocity with respect to the obstacle
+
+    # Modulation with M = E @ D @ E^-1 of all relevant pairs (obstacle, position)
+    # Undefined basis (e.g. at the obstacle center) results in nan-velocity
+    ind_obs, ind_points = np.nonzero(ind_relevant)
+    normal_vector = environment.get_normal_direction(pos_relative, ind_evaluate=ind_relevant)[:, ind_relevant]
+    reference_direction = environment.get_reference_direction(pos_relative, ind_evaluate=ind_relevant)[:, ind_relevant]
+    E, E_orth = compute_decomposition_matrix_from_directions(normal_vector, reference_direction)
+    eigenvalue_reference, eigenvalue_tangent = compute_diagonal_eigenvalues_batch(Gamma[ind_relevant])
+
+    rotation_matrix = environment.rotation_matrix[ind_obs]
+    if dim > 3:
+        rotation_matrix = np.tile(np.eye(dim), (ind_obs.shape[0], 1, 1))
+
+    xd_temp = np.einsum('kji,jk->ik', rotation_matrix, xd[:, ind_points])
+    xd_hat_pairs = compute_modulated_velocity(xd_temp, E, E_orth, eigenvalue_reference, eigenvalue_tangent)
+    xd_hat_pairs = np.einsum('kij,jk->ik', rotation_matrix, xd_hat_pairs)
+
+    ind_boundary = environment.is_boundary[ind_obs]
+    if np.sum(ind_boundary):
+        # Only consider boundary when moving towards (normal direction)
+        normal_vector = E_orth[:, 0, :]
+        if evaluate_in_global_frame:
+            normal_vector = np.einsum('kij,jk->ik', rotation_matrix, normal_vector)
+        ind_away = ind_boundary & (np.sum(normal_vector*xd[:, ind_points], axis=0) < 0)
+        xd_hat_pairs[:, ind_away] = xd[:, ind_points[ind_away]]
+
+    if repulsive_obstacle:
+        # Move away from center in case of a collision
+        Gamma_pairs = Gamma[ind_relevant]
+        ind_repulsive = Gamma_pairs < (1+repulsive_gammaMargin)
+        if np.sum(ind_repulsive):
+            repulsive_power = 5
+            repulsive_factor = 5
+            repulsive_gamma = (1+repulsive_gammaMargin)
+
+            repulsive_speed = ((repulsive_gamma/Gamma_pairs[ind_repulsive])**repulsive_power-
+                               repulsive_gamma)*repulsive_factor
+            repulsive_speed[ind_boundary[ind_repulsive]] *= (-1)
+
+            if evaluate_in_global_frame:
+                pos_repulsive = x[:, ind_points[ind_repulsive]]
+            else:
+                pos_repulsive = pos_relative[:, ind_relevant][:, ind_repulsive]
+            norm_xt = np.linalg.norm(pos_repulsive, axis=0)
+
+            repulsive_velocity = np.zeros((dim, np.sum(ind_repulsive)))
+            repulsive_velocity[0, :] = 1*repulsive_speed
+            ind_nonzero = norm_xt > 0
+            repulsive_velocity[:, ind_nonzero] = (pos_repulsive[:, ind_nonzero]/norm_xt[ind_nonzero]
+                                                  * repulsive_speed[ind_nonzero])
+
+            xd_hat_pairs[:, ind_repulsive] = repulsive_velocity
+
+    xd_hat = np.zeros((dim, N_obs, n_points))
+    xd_hat[:, ind_relevant] = xd_hat_pairs
+
+    xd_hat_magnitude = np.sqrt(np.sum(xd_hat**2, axis=0))
+
+    xd_hat_normalized = np.zeros(xd_hat.shape)
+    ind_nonzero = (xd_hat_magnitude>0)
+    xd_hat_normalized[:, ind_nonzero] = xd_hat[:, ind_nonzero]/xd_hat_magnitude[ind_nonzero]
+
+    weighted_direction = get_directional_weighted_sum_batch(reference_direction=xd_normalized, directions=xd_hat_normalized, weights=weight, total_weight=1)
+
+    xd_magnitude = np.sum(xd_hat_magnitude*weight, axis=0)
+    xd = xd_magnitude*weighted_direction
+
+    xd = xd + xd_obs
+    if not velocicity_max is None:
+        xd_norm = np.linalg.norm(xd, axis=0)
+        ind_fast = xd_norm > velocicity_max
+        xd[:, ind_fast] = xd[:, ind_fast]/xd_norm[ind_fast] * velocicity_max
+
+    xd_mod[:, ind_eval] = xd
+    return xd_mod
+
+
 def obs_avoidance_rk4(dt, x, obs, obs_avoidance=obs_avoidance_interpolation_moving, ds=linearAttractor, x0=False):
     ''' Fourth order integration of obstacle avoidance differential equation '''
     # NOTE: The movement of the obstacle is considered as small, hence position and movement changed are not considered. This will be fixed in future iterations.
@@ -219,20 +427,20 @@ def obs_avoidance_rk4(dt, x, obs, obs_avoidance=obs_avoidance_interpolation_movi
 
     # k2
     xd = ds(x+0.5*k1, x0)
-    xd = velConst_attr(x, xd, x0)
+    xd = velConst_attr(x+0.5*k1, xd, x0)
     xd = obs_avoidance(x+0.5*k1, xd, obs)
     k2 = dt*xd
 
     # k3
     xd = ds(x+0.5*k2, x0)
-    xd = velConst_attr(x, xd, x0)
+    xd = velConst_attr(x+0.5*k2, xd, x0)
     xd = obs_avoidance(x+0.5*k2, xd, obs)
     
     k3 = dt*xd
 
     # k4
     xd = ds(x+k3, x0)
-    xd = velConst_attr(x, xd, x0)
+    xd = velConst_attr(x+k3, xd, x0)
     xd = obs_avoidance(x+k3, xd, obs)
     k4 = dt*xd
 
@@ -242,3 +450,250 @@ def obs_avoidance_rk4(dt, x, obs, obs_avoidance=obs_avoidance_interpolation_movi
 
 
     return x
+
+
+def obs_avoidance_rk4_batch(dt, x, obs, obs_avoidance=obs_avoidance_interpolation_moving_batch, ds=linearAttractor, x0=False, ind_active=None):
+    '''
+    Fourth order integration step of all positions x [dim x N] at once.
+    The dynamical system ds(x, x0) and obs_avoidance(x, xd, obs) are evaluated on arrays [dim x N]
+    (the attractor x0 is passed with shape [dim x 1]).
+
+    ind_active [N] (bool): only these positions are advanced, the others are returned unchanged
+    '''
+    x = np.array(x, dtype=float)
+    dim = x.shape[0]
+
+    if type(x0)==bool:
+        x0 = np.zeros(dim)
+    x0 = np.reshape(x0, (dim, 1))
+
+    x_next = np.copy(x)
+    if not ind_active is None:
+        if not np.sum(ind_active):
+            return x_next
+        x = x[:, ind_active]
+
+    # k1
+    xd = ds(x, x0)
+    xd = velConst_attr(x, xd, x0)
+    xd = obs_avoidance(x, xd, obs)
+    k1 = dt*xd
+
+    # k2
+    xd = ds(x+0.5*k1, x0)
+    xd = velConst_attr(x+0.5*k1, xd, x0)
+    xd = obs_avoidance(x+0.5*k1, xd, obs)
+    k2 = dt*xd
+
+    # k3
+    xd = ds(x+0.5*k2, x0)
+    xd = velConst_attr(x+0.5*k2, xd, x0)
+    xd = obs_avoidance(x+0.5*k2, xd, obs)
+    k3 = dt*xd
+
+    # k4
+    xd = ds(x+k3, x0)
+    xd = velConst_attr(x+k3, xd, x0)
+    xd = obs_avoidance(x+k3, xd, obs)
+    k4 = dt*xd
+
+    if ind_active is None:
+        x_next = x + 1./6*(k1+2*k2+2*k3+k4) # + O(dt^5)
+    else:
+        x_next[:, ind_active] = x + 1./6*(k1+2*k2+2*k3+k4)
+    return x_next
+
+
+def obs_avoidance_rk4_trajectories(dt, points_init, obs, max_simu_step=300, convergence_margin=0.03, obs_avoidance=obs_avoidance_interpolation_moving_batch, ds=linearAttractor, x0=False):
+    '''
+    Integrate the trajectories starting at points_init [dim x N] with obs_avoidance_rk4_batch().
+    A trajectory has converged once its squared distance to the attractor x0 is below the convergence_margin,
+    it is not evaluated anymore and stays at its last position.
+
+    OUTPUT
+    x_pos [dim x n_steps+1 x N]: positions (the integration stops when all trajectories converged)
+    ind_converged [N] (bool): converged trajectories
+    '''
+    points_init = np.array(points_init, dtype=float)
+    dim, n_points = points_init.shape
+
+    if type(x0)==bool:
+        x0 = np.zeros(dim)
+    x0 = np.reshape(x0, (dim, 1))
+
+    x_pos = np.zeros((dim, max_simu_step+1, n_points))
+    x_pos[:, 0, :] = points_init
+
+    ind_converged = np.sum((points_init-x0)**2, axis=0) < convergence_margin
+    for iSim in range(max_simu_step):
+        x_pos[:, iSim+1, :] = obs_avoidance_rk4_batch(
+            dt, x_pos[:, iSim, :], obs, obs_avoidance=obs_avoidance, ds=ds, x0=x0, ind_active=~ind_converged)
+
+        ind_converged = ind_converged | (np.sum((x_pos[:, iSim+1, :]-x0)**2, axis=0) < convergence_margin)
+        if np.all(ind_converged):
+            x_pos = x_pos[:, :iSim+2, :]
+            break
+
+    return x_pos, ind_converged
+
+
+# Dormand-Prince coefficients (RK45)
+dormand_prince_nodes = np.array([0, 1./5, 3./10, 4./5, 8./9, 1., 1.])
+dormand_prince_matrix = np.array([
+    [0, 0, 0, 0, 0, 0],
+    [1./5, 0, 0, 0, 0, 0],
+    [3./40, 9./40, 0, 0, 0, 0],
+    [44./45, -56./15, 32./9, 0, 0, 0],
+    [19372./6561, -25360./2187, 64448./6561, -212./729, 0, 0],
+    [9017./3168, -355./33, 46732./5247, 49./176, -5103./18656, 0],
+    [35./384, 0, 500./1113, 125./192, -2187./6784, 11./84]])
+dormand_prince_weights = np.array([35./384, 0, 500./1113, 125./192, -2187./6784, 11./84, 0]) # 5th order
+dormand_prince_error = dormand_prince_weights - np.array([5179./57600, 0, 7571./16695, 393./640, -92097./339200, 187./2100, 1./40]) # 5th - 4th order
+
+
+def get_minimal_gamma(x, obs):
+    ''' Smallest Gamma of all obstacles obs at position x [dim] (inf if there are no obstacles) '''
+    Gamma_min = np.inf
+    for n in range(len(obs)):
+        Gamma_min = min(Gamma_min, np.min(obs[n].get_gamma(x, in_global_frame=True)))
+    return Gamma_min
+
+
+def get_hermite_interpolation(t, t0, t1, x0, x1, xd0, xd1):
+    ''' Cubic (Hermite) interpolation between the steps (t0, x0, xd0) and (t1, x1, xd1) at time t [float] '''
+    dt = t1 - t0
+    ss = (t - t0)/dt
+    return ((2*ss**3 - 3*ss**2 + 1)*x0 + (ss**3 - 2*ss**2 + ss)*dt*xd0
+            + (-2*ss**3 + 3*ss**2)*x1 + (ss**3 - ss**2)*dt*xd1)
+
+
+def obs_avoidance_rk45(x, obs, t_max=10, dt_init=0.01, dt_min=1e-6, dt_max=1.0, rtol=1e-3, atol=1e-4, convergence_margin=0.03, max_simu_step=10000, obs_avoidance=obs_avoidance_interpolation_moving, ds=linearAttractor, x0=False, t_eval=None, check_collision=True, event_resolution=0.05):
+    '''
+    Adaptive integration of the modulated dynamical system with the embedded Runge-Kutta 
+    (Dormand-Prince, RK45) method. The step size is controlled with the difference of the 
+    4th and 5th order solution, i.e. the step becomes large in free space and small close to obstacles.
+
+    The integration stops at the first event:
+    'converged': squared distance to the attractor x0 is below the convergence_margin
+    'collision': the smallest Gamma crosses 1 (only if check_collision)
+    The events are checked on the dense output every event_resolution (distance), the time of the
+    event is located by bisection and the last step is truncated to it.
+    
+    INPUT
+    x [dim]: initial position
+    obs [list of obstacle_class]: obstacles
+    rtol, atol [float]: relative and absolute tolerance of the local error
+    t_eval [array]: (optional) times at which the dense output (cubic Hermite) is evaluated
+
+    OUTPUT
+    t_steps [n_steps+1]: time of the accepted steps (or t_eval until the end of the integration)
+    x_steps [dim x n_steps+1]: positions of the accepted steps (or at t_eval)
+    event [str]: 'converged', 'collision', 'max_time' or 'max_step'
+    '''
+    x = np.array(x, dtype=float)
+    dim = x.shape[0]
+
+    if type(x0)==bool:
+        x0 = np.zeros(dim)
+
+    def get_velocity(position):
+        xd = ds(position, x0)
+        xd = velConst_attr(position, xd, x0)
+        return obs_avoidance(position, xd, obs)
+
+    def get_event_value(position):
+        values = [np.sum((position-x0)**2) - convergence_margin]
+        if check_collision:
+            values.append(get_minimal_gamma(position, obs) - 1)
+        return np.array(values)
+    event_names = ['converged', 'collision']
+
+    t_steps = [0]
+    x_steps = [x]
+    xd_steps = [get_velocity(x)]
+    event = 'max_step'
+
+    if np.sum((x-x0)**2) < convergence_margin:
+        event = 'converged'
+        max_simu_step = 0
+
+    dt = dt_init
+    k_stages = np.zeros((dim, 7))
+    for it_step in range(max_simu_step):
+        tt, xx = t_steps[-1], x_steps[-1]
+        if tt >= t_max:
+            event = 'max_time'
+            break
+        dt = min(dt, dt_max, t_max-tt)
+
+        k_stages[:, 0] = xd_steps[-1] # First same as last
+        while True:
+            for ii in range(1, 7):
+                k_stages[:, ii] = get_velocity(xx + dt*k_stages[:, :ii].dot(dormand_prince_matrix[ii, :ii]))
+            x_next = xx + dt*k_stages.dot(dormand_prince_weights)
+
+            error_scale = atol + rtol*np.maximum(np.abs(xx), np.abs(x_next))
+            error_norm = np.sqrt(np.mean((dt*k_stages.dot(dormand_prince_error)/error_scale)**2))
+
+            if error_norm <= 1 or dt <= dt_min:
+                break
+            dt = max(dt_min, dt*max(0.2, 0.9*error_norm**(-1./5)))
+
+        t_steps.append(tt+dt)
+        x_steps.append(x_next)
+        xd_steps.append(np.copy(k_stages[:, 6]))
+
+        # Events: locate the (first) sign change on the dense output, which is sampled with
+        # event_resolution such that large steps do not jump over an obstacle
+        n_samples = int(np.ceil(LA.norm(x_next-xx)/event_resolution))
+        t_samples = tt + dt*np.arange(1, n_samples+1)/max(n_samples, 1)
+        if not n_samples:
+            t_samples = np.array([tt+dt])
+        for t_sample in t_samples:
+            x_sample = get_hermite_interpolation(t_sample, tt, tt+dt, xx, x_next, xd_steps[-2], xd_steps[-1])
+            event_value = get_event_value(x_sample)
+            if np.any(event_value < 0):
+                break
+
+        if np.any(event_value < 0):
+            t_low, t_high = max(tt, t_sample-dt/max(n_samples, 1)), t_sample
+            for it_bisection in range(30):
+                t_mid = 0.5*(t_low+t_high)
+                x_mid = get_hermite_interpolation(t_mid, tt, tt+dt, xx, x_next, xd_steps[-2], xd_steps[-1])
+                if np.any(get_event_value(x_mid) < 0):
+                    t_high = t_mid
+                else:
+                    t_low = t_mid
+            t_steps[-1] = t_high
+            x_steps[-1] = get_hermite_interpolation(t_high, tt, tt+dt, xx, x_next, xd_steps[-2], xd_steps[-1])
+            xd_steps[-1] = get_velocity(x_steps[-1])
+            event = event_names[np.nonzero(event_value < 0)[0][0]]
+            break
+
+        # Step size of the next step
+        if error_norm:
+            dt = dt*min(5, max(0.2, 0.9*error_norm**(-1./5)))
+        else:
+            dt = dt*5
+    else:
+        if t_steps[-1] >= t_max:
+            event = 'max_time'
+
+    t_steps = np.array(t_steps)
+    x_steps = np.array(x_steps).T
+    if t_eval is None:
+        return t_steps, x_steps, event
+
+    # Dense output
+    xd_steps = np.array(xd_steps).T
+    t_eval = np.array(t_eval)
+    t_eval = t_eval[(t_eval >= t_steps[0]) & (t_eval <= t_steps[-1])]
+    x_eval = np.zeros((dim, t_eval.shape[0]))
+
+    ind_step = np.clip(np.searchsorted(t_steps, t_eval, side='right')-1, 0, max(len(t_steps)-2, 0))
+    for ii, it in enumerate(ind_step):
+        if it+1 >= len(t_steps):
+            x_eval[:, ii] = x_steps[:, it]
+            continue
+        x_eval[:, ii] = get_hermite_interpolation(t_eval[ii], t_steps[it], t_steps[it+1], x_steps[:, it], x_steps[:, it+1], xd_steps[:, it], xd_steps[:, it+1])
+    return t_eval, x_eval, event
@@ -16,9 +16,33 @@ import warnings
 from dynamic_obstacle_avoidance.dynamical_system.dynamical_system_representation import *
 from dynamic_obstacle_avoidance.obstacle_avoidance.angle_math import *
 
-import matplotlib.pyplot as plt
+# Counters of the modulation evaluations (see get_modulation_statistics)
+# They only count the evaluations of this process; evaluations in other processes have to be
+# returned and added with add_modulation_statistics (as done by vector_field_evaluation).
+modulation_statistics = {'n_modulations': 0, 'n_dot_margin': 0, 'n_pinv': 0}
 
 
+def reset_modulation_statistics():
+    ''' Set all counters of the modulation evaluation to zero. '''
+    for key in modulation_statistics:
+        modulation_statistics[key] = 0
+
+
+def get_modulation_statistics():
+    '''
+    Returns a copy of the counters of the modulation evaluation (in this process)
+    n_modulations: number of modulated velocities (per obstacle and position)
+    n_dot_margin: number of decompositions which required the (dot_margin) adaption of the reference direction
+    n_pinv: number of modulations which required the general pseudo-inverse of E
+    '''
+    return dict(modulation_statistics)
+
+
+def add_modulation_statistics(statistics):
+    ''' Add counters (e.g. returned from a process pool worker) to the counters of this process. '''
+    for key in statistics:
+        modulation_statistics[key] += statistics[key]
+
 
 def compute_diagonal_matrix(Gamma, dim, is_boundary=False, rho=1):
     ''' Compute diagonal Matrix'''
@@ -60,6 +84,7 @@ def compute_decomposition_matrix(obs, x_t, in_global_frame=False, dot_margin=0.0
     dot_prod = np.dot(normal_vector, reference_direction)
     
     if np.abs(dot_prod) < dot_margin:
+        modulation_statistics['n_dot_margin'] += 1
         # Adapt reference direction to avoid singularities
         # WARNING: full convergence is not given anymore, but impenetrability
         if not np.linalg.norm(normal_vector): # zero
@@ -74,10 +99,125 @@ def compute_decomposition_matrix(obs, x_t, in_global_frame=False, dot_margin=0.0
     E_orth = get_orthogonal_basis(normal_vector, normalize=True)
     E = np.copy((E_orth))
     E[:, 0] = -reference_direction
-    
+
     return E, E_orth
 
 
+def compute_diagonal_eigenvalues_batch(Gamma, rho=1):
+    ''' Eigenvalues (reference, tangent) of the diagonal matrix for an array of Gamma.
+    Same values as the diagonal of compute_diagonal_matrix(). '''
+    Gamma = np.array(Gamma, dtype=float)
+
+    delta_eigenvalue = np.ones(Gamma.shape)
+    ind_outside = Gamma > 1
+    delta_eigenvalue[ind_outside] = 1./np.abs(Gamma[ind_outside])**(1/rho)
+
+    return 1 - delta_eigenvalue, 1 + delta_eigenvalue
+
+
+def compute_decomposition_matrix_batch(obs, x_t, in_global_frame=False, dot_margin=0.05):
+    ''' Compute decomposition matrix and orthogonal matrix to basis for positions x_t [dim x N]
+    Returns E, E_orth of shape [dim x dim x N]'''
+    normal_vector = obs.get_normal_direction(x_t, normalize=True, in_global_frame=in_global_frame)
+    reference_direction = obs.get_reference_direction(x_t, in_global_frame=in_global_frame)
+
+    normal_vector = np.array(normal_vector, dtype=float).reshape(x_t.shape)
+    reference_direction = np.array(reference_direction, dtype=float).reshape(x_t.shape)
+
+    return compute_decomposition_matrix_from_directions(normal_vector, reference_direction, dot_margin=dot_margin)
+
+
+def compute_decomposition_matrix_from_directions(normal_vector, reference_direction, dot_margin=0.05):
+    ''' Decomposition matrix and orthogonal matrix from the normal and reference directions [dim x N]
+    Returns E, E_orth of shape [dim x dim x N]'''
+    normal_vector = np.copy(normal_vector)
+    reference_direction = np.copy(reference_direction)
+
+    dot_prod = np.sum(normal_vector*reference_direction, axis=0)
+
+    # Singular configurations are rare -- they are treated pointwise
+    ind_singular = np.abs(dot_prod) < dot_margin
+    modulation_statistics['n_dot_margin'] += np.sum(ind_singular)
+    for pp in np.arange(normal_vector.shape[1])[ind_singular]:
+        # Adapt reference direction to avoid singularities
+        # WARNING: full convergence is not given anymore, but impenetrability
+        if not np.linalg.norm(normal_vector[:, pp]): # zero
+            normal_vector[:, pp] = -reference_direction[:, pp]
+        else:
+            weight = np.abs(dot_prod[pp])/dot_margin
+            dir_norm = np.copysign(1, dot_prod[pp])
+            reference_direction[:, pp] = get_directional_weighted_sum(
+                reference_direction=normal_vector[:, pp],
+                directions=np.vstack((reference_direction[:, pp], dir_norm*normal_vector[:, pp])).T,
+                weights=np.array([weight, (1-weight)]))
+
+    E_orth = get_orthogonal_basis_batch(normal_vector, normalize=True)
+    E = np.copy(E_orth)
+    E[:, 0, :] = -reference_direction
+
+    return E, E_orth
+
+
+def compute_modulated_velocity(velocity, E, E_orth, eigenvalue_reference, eigenvalue_tangent, singularity_margin=1e-6):
+    '''
+    Modulated velocity M @ velocity with M = E @ D @ E^-1, without inverting E.
+
+    The columns of E are the reference direction followed by the tangent basis of
+    E_orth, which is orthogonal to the normal direction (first column of E_orth).
+    Hence, the component along the reference direction is obtained by the projection on
+    the normal and the remaining part of the velocity lies in the tangent space:
+        M @ v = lambda_t*v + (lambda_r - lambda_t) * (n.v)/(n.e_r) * e_r
+
+    The general pseudo-inverse is only used for d>3 or if n.e_r is close to zero.
+
+    Input
+    velocity [dim] or [dim x N]
+    E, E_orth [dim x dim] or [dim x dim x N]: decomposition matrices (compute_decomposition_matrix)
+    eigenvalue_reference, eigenvalue_tangent [float] or [N]: eigenvalues of the diagonal matrix
+    '''
+    single_velocity = (len(velocity.shape)==1)
+    if single_velocity:
+        velocity = velocity.reshape(-1, 1)
+        E = E.reshape(E.shape + (1,))
+        E_orth = E_orth.reshape(E_orth.shape + (1,))
+
+    dim, n_points = velocity.shape
+    eigenvalue_reference = np.broadcast_to(eigenvalue_reference, (n_points,))
+    eigenvalue_tangent = np.broadcast_to(eigenvalue_tangent, (n_points,))
+
+    modulation_statistics['n_modulations'] += n_points
+
+    reference_vector = E[:, 0, :]
+    normal_vector = E_orth[:, 0, :]
+    normal_dot_reference = np.sum(normal_vector*reference_vector, axis=0)
+
+    if dim > 3:
+        ind_general = np.ones(n_points, dtype=bool)
+    else:
+        # Undefined basis (nan) is not evaluated with the general method
+        ind_general = np.abs(normal_dot_reference) < singularity_margin
+
+    velocity_mod = np.zeros((dim, n_points))
+
+    ind_closed = ~ind_general
+    if np.sum(ind_closed):
+        factor_reference = (np.sum(normal_vector[:, ind_closed]*velocity[:, ind_closed], axis=0)
+                            / normal_dot_reference[ind_closed]
+                            * (eigenvalue_reference[ind_closed]-eigenvalue_tangent[ind_closed]))
+        velocity_mod[:, ind_closed] = (eigenvalue_tangent[ind_closed]*velocity[:, ind_closed]
+                                       + factor_reference*reference_vector[:, ind_closed])
+
+    if np.sum(ind_general):
+        modulation_statistics['n_pinv'] += np.sum(ind_general)
+        for pp in np.arange(n_points)[ind_general]:
+            D = np.diag(np.hstack((eigenvalue_reference[pp], np.ones(dim-1)*eigenvalue_tangent[pp])))
+            velocity_mod[:, pp] = E[:, :, pp].dot(D).dot(LA.pinv(E[:, :, pp])).dot(velocity[:, pp])
+
+    if single_velocity:
+        return velocity_mod[:, 0]
+    return velocity_mod
+
+
 def compute_modulation_matrix(x_t, obs, matrix_singularity_margin=pi/2.0*1.05, angular_vel_weight=0):
     # TODO: depreciated remove
     '''
@@ -377,6 +517,36 @@ def compute_weights(distMeas, N=0, distMeas_lowerLimit=1, weightType='inverseGam
     return w
 
 
+def compute_weights_batch(distMeas, distMeas_lowerLimit=1, weightType='inverseGamma', weightPow=2):
+    '''
+    Weights for distance measures of shape [N_dist x N_points], evaluated independently for each point.
+    Equal to compute_weights() applied to each column.
+    '''
+    distMeas = np.array(distMeas, dtype=float)
+    w = np.zeros(distMeas.shape)
+
+    critical_points = distMeas <= distMeas_lowerLimit
+    n_critical = np.sum(critical_points, axis=0)
+
+    ind_critical = n_critical > 0
+    if np.sum(ind_critical):
+        if np.sum(n_critical > 1):
+            # TODO: continuous weighting function
+            warnings.warn('Implement continuity of weighting function.')
+        w[:, ind_critical] = critical_points[:, ind_critical]*1./n_critical[ind_critical]
+
+    if weightType == 'inverseGamma':
+        w_free = (1/(distMeas[:, ~ind_critical] - distMeas_lowerLimit))**weightPow
+
+        sum_w = np.sum(w_free, axis=0)
+        ind_nonzero = sum_w > 0
+        w_free[:, ind_nonzero] = w_free[:, ind_nonzero] / sum_w[ind_nonzero] # Normalization
+        w[:, ~ind_critical] = w_free
+    else:
+        warnings.warn("Unkown weighting method.")
+    return w
+
+
 def compute_R(d, th_r):
     if th_r == 0:
         rotMatrix = np.eye(d)
@@ -406,60 +576,55 @@ def compute_R(d, th_r):
 
 
 def obs_check_collision_2d(obs_list, XX, YY):
-    d = 2
-
+    ''' Collision free mask of the grid XX, YY (see obs_check_collision) '''
     dim_points = XX.shape
-    if len(dim_points)==1:
-        N_points = dim_points[0]
-    else:
-        N_points = dim_points[0]*dim_points[1]
 
     # No obstacles
     if not len(obs_list):
         return np.ones((dim_points))
-        
-    points = np.array(([np.reshape(XX,(N_points,)) , np.reshape(YY, (N_points,)) ] ))
-    # At the moment only implemented for 2D
-    collision = np.zeros( dim_points )
 
-    N_points = points.shape[1]
+    points = np.vstack((np.reshape(XX, (-1)), np.reshape(YY, (-1))))
+    noColl = obs_check_collision(points, obs_list)
 
-    noColl = np.ones((1,N_points), dtype=bool)
+    return np.reshape(noColl, dim_points)
 
-    for it_obs in range(len(obs_list)):
-        # on the surface, we have: \Gamma = \sum_{i=1}^d (xt_i/a_i)^(2p_i) == 1
-        R = compute_R(d,obs_list[it_obs].th_r)
 
-        # Gamma = np.sum( ( 1/obs_list[it_obs].sf * R.T @ (points - np.tile(np.array([obs_list[it_obs].x0]).T,(1,N_points) ) ) / np.tile(np.array([obs_list[it_obs].a]).T, (1, N_points)) )**(np.tile(2*np.array([obs_list[it_obs].p]).T, (1,N_points)) ), axis=0 )
+def obs_check_collision(points, obs_list, early_exit=True, bounding_box_prefilter=True):
+    '''
+    Check all points against all obstacles (any dimension) with array Gamma evaluation.
 
-        Gamma = np.zeros(N_points)
-        for ii in range(N_points):
-            Gamma[ii] = obs_list[it_obs].get_gamma(points[:,ii], in_global_frame=True)
-            
-        noColl = (noColl* Gamma>1)
+    INPUT
+    points [dim x N]: positions in the global frame
+    obs_list [list of obstacle_class]
+    early_exit [bool]: points which are known to collide are not evaluated for the following obstacles
+    bounding_box_prefilter [bool]: only points in the bounding box of the sphere of get_gamma_bound_radius()
+        are evaluated (outside Gamma>1 for sure)
 
-    return np.reshape(noColl, dim_points)
+    OUTPUT
+    noColl [N] (bool): True if the point is outside of all obstacles (Gamma>1)
+    '''
+    points = np.array(points, dtype=float)
+    n_points = points.shape[1]
+    noColl = np.ones(n_points, dtype=bool)
 
+    for it_obs in range(len(obs_list)):
+        if early_exit:
+            ind_eval = np.copy(noColl)
+        else:
+            ind_eval = np.ones(n_points, dtype=bool)
 
-def obs_check_collision(obs_list, dim, *args):
-    # No obstacles
-    if len(obs_list)==0:
-        return np.ones(args[0].shape)
-    dim = obs_list[0].dim
-
-    if len(*args)==dim:
-        points = np.array([])
-        for ii in range(dim):
-            input_shape = args[0].shape
-            points = np.vstack((points, np.arary(args[ii]).flatten()))
-            
-    N_points = points.shape[1]
+        if bounding_box_prefilter:
+            radius = obs_list[it_obs].get_gamma_bound_radius()
+            if np.isfinite(radius):
+                center = np.reshape(obs_list[it_obs].center_position, (-1, 1))
+                ind_eval[ind_eval] = np.all(np.abs(points[:, ind_eval]-center) < radius, axis=0)
+
+        if not np.sum(ind_eval):
+            continue
 
-    # At the moment only implemented for 2D
-    collision = np.zeros((N_points))
+        Gamma = obs_list[it_obs].get_gamma(points[:, ind_eval], in_global_frame=True)
+        noColl[ind_eval] = noColl[ind_eval] & (Gamma>1)
 
-    for ii in range(N_points):
-        pass
     return noColl
 
 
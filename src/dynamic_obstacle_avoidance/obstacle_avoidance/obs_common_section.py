@@ -8,211 +8,648 @@ from numpy import linalg as LA
 
 from math import ceil, sin, cos, sqrt
 
-import matplotlib.pyplot as plt # for debugging
 
 import warnings
+import heapq
+from collections import deque
+
+from dynamic_obstacle_avoidance.obstacle_avoidance.obs_dynamic_center_3d import get_dynamic_center_distance, get_dynamic_center_pair, get_dynamic_reference_point
+from dynamic_obstacle_avoidance.obstacle_avoidance.spatial_index import get_overlapping_box_pairs
+
+def get_packed_index(slot1, slot2):
+    ''' Index of the pair of slots (slot1!=slot2, also arrays) in the packed triangular storage '''
+    slot_high = np.maximum(slot1, slot2)
+    return slot_high*(slot_high-1)//2 + np.minimum(slot1, slot2)
+
 
 class Intersection_matrix():
-    # Matrix uses less space this way this is useful with many obstacles! e.g. dense crowds
-    # Symmetric matrix with zero as diagonal values
+    '''
+    Symmetric matrix of the obstacle pairs with zero diagonal, e.g. for dense crowds.
+    The pairs are stored in packed triangular arrays:
+    is_intersecting [bool], intersection point [dim] and distance [float] (nan if unknown).
+
+    Each obstacle index is mapped to a slot of the storage. The pair of the slots (a, b) with
+    a<b is stored at b*(b-1)/2+a, hence the storage grows without moving the stored pairs.
+    Inserting / deleting an obstacle only changes the slot mapping (deleted slots are reused).
+    The version is increased with each change.
+    '''
     def __init__(self, n_obs, dim=2):
-        self._intersection_list = [False for ii in range(int((n_obs-1)*n_obs/2))]
-        self._dim = n_obs-1
+        self.dim = dim
+        self.version = 0
+        self._capacity = 0
+        self._is_intersecting = np.zeros(0, dtype=bool)
+        self._intersection_points = np.zeros((dim, 0))
+        self._distance = np.zeros(0)
+        self._free_slots = []
+
+        self.reserve(n_obs)
+        self._slots = np.arange(n_obs, dtype=int)
+        self._free_slots = []
+
+    def __len__(self):
+        return self._slots.shape[0]
+
+    def __repr__(self):
+        return "Intersection_matrix of {} obstacles (capacity {})".format(len(self), self._capacity)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def reserve(self, capacity):
+        ''' Increase the number of slots; the new slots are free '''
+        if capacity <= self._capacity:
+            return
+        n_new = capacity*(capacity-1)//2 - self._is_intersecting.shape[0]
+
+        self._is_intersecting = np.hstack((self._is_intersecting, np.zeros(n_new, dtype=bool)))
+        self._intersection_points = np.hstack((self._intersection_points, np.zeros((self.dim, n_new))))
+        self._distance = np.hstack((self._distance, np.ones(n_new)*np.nan))
+
+        self._free_slots = self._free_slots + list(range(capacity-1, self._capacity-1, -1))
+        self._capacity = capacity
+
+    def insert(self, index=None):
+        ''' Insert an obstacle at index (default: append); all its pairs are reset '''
+        if index is None:
+            index = len(self)
+        if not len(self._free_slots):
+            self.reserve(self._capacity + max(self._capacity//4, 2)) # Geometric growth
+
+        self._slots = np.insert(self._slots, index, self._free_slots.pop())
+        self.reset(index)
+        self.version += 1
+
+    def delete(self, index):
+        ''' Remove the obstacle at index (the following indices are shifted as in a list) '''
+        self._free_slots.append(self._slots[index])
+        self._slots = np.delete(self._slots, index)
+        self.version += 1
+
+    def reset(self, index):
+        ''' Reset all pairs of an obstacle (no intersection, unknown distance) '''
+        ind_pairs = self.get_row_index(index)[0]
+        self._is_intersecting[ind_pairs] = False
+        self._intersection_points[:, ind_pairs] = 0
+        self._distance[ind_pairs] = np.nan
+        self.version += 1
+
+    def get_index(self, row, col):
+        if row < 0:
+            row += len(self)
+        if col < 0:
+            col += len(self)
+        if row == col:
+            raise IndexError("Self collision observation meainingless.")
+        return int(get_packed_index(self._slots[row], self._slots[col]))
+
+    def get_row_index(self, index):
+        ''' Packed indices of the pairs (index, jj) [N-1] and the obstacles jj!=index [N-1] '''
+        ind_other = np.arange(len(self))
+        ind_other = ind_other[ind_other!=index]
+        return get_packed_index(self._slots[index], self._slots[ind_other]), ind_other
+
+    def get_triangle_index(self):
+        ''' Rows, columns (row>col) and packed indices of the lower triangle of the dense matrix '''
+        ind_row, ind_col = np.tril_indices(len(self), k=-1)
+        return ind_row, ind_col, get_packed_index(self._slots[ind_row], self._slots[ind_col])
 
     def set(self, row, col, value):
-        ind = self.get_index(row,col)
-        self._intersection_list[ind] = value
+        ''' Intersection point [dim] of the pair, or False / None if there is no intersection '''
+        ind = self.get_index(row, col)
+        self.version += 1
+        if value is None or isinstance(value, (bool, np.bool_)):
+            self._is_intersecting[ind] = bool(value)
+            if not value:
+                self._intersection_points[:, ind] = 0
+            return
+        self._is_intersecting[ind] = True
+        self._intersection_points[:, ind] = value
 
     def get(self, row, col):
-        ind = self.get_index(row,col)
-        return self._intersection_list[ind]
+        ''' Intersection point [dim] of the pair, False if there is no intersection '''
+        ind = self.get_index(row, col)
+        if not self._is_intersecting[ind]:
+            return False
+        return np.copy(self._intersection_points[:, ind])
+
+    def set_distance(self, row, col, value):
+        self._distance[self.get_index(row, col)] = np.nan if value is None else value
+        self.version += 1
+
+    def get_distance(self, row, col):
+        return self._distance[self.get_index(row, col)]
+
+    def get_row(self, index, value='intersection'):
+        '''
+        All pairs of an obstacle (row and column are equal for the symmetric matrix).
+        value: 'intersection' [N] (bool), 'point' [dim x N] or 'distance' [N] (diagonal is zero)
+        '''
+        ind_pairs, ind_other = self.get_row_index(index)
+        if value == 'intersection':
+            row = np.zeros(len(self), dtype=bool)
+            row[ind_other] = self._is_intersecting[ind_pairs]
+        elif value == 'point':
+            row = np.zeros((self.dim, len(self)))
+            row[:, ind_other] = self._intersection_points[:, ind_pairs]
+        elif value == 'distance':
+            row = np.zeros(len(self))
+            row[ind_other] = self._distance[ind_pairs]
+        else:
+            raise ValueError("Unknown value <<{}>>.".format(value))
+        return row
+
+    def get_edges(self):
+        ''' Intersecting pairs [M x 2] (ii<jj) read from the packed storage '''
+        ind_pairs = np.nonzero(self._is_intersecting)[0]
+        slot_high = ((1 + np.sqrt(1 + 8*ind_pairs))//2).astype(int)
+        # Rounding of the square root
+        slot_high -= (slot_high*(slot_high-1)//2 > ind_pairs)
+        slot_high += ((slot_high+1)*slot_high//2 <= ind_pairs)
+        slot_low = ind_pairs - slot_high*(slot_high-1)//2
+
+        slot_index = -np.ones(self._capacity, dtype=int) # Free slots are -1
+        slot_index[self._slots] = np.arange(len(self))
+        edges = np.vstack((slot_index[slot_low], slot_index[slot_high])).T
+        edges = edges[np.all(edges>=0, axis=1), :]
+        return np.sort(edges, axis=1)
+
+    def get_adjacency_list(self):
+        ''' Intersecting obstacles of each obstacle (list of sorted index-arrays) '''
+        edges = self.get_edges()
+        edges = np.vstack((edges, edges[:, ::-1]))
+        edges = edges[np.lexsort((edges[:, 1], edges[:, 0])), :]
+        return np.split(edges[:, 1], np.cumsum(np.bincount(edges[:, 0], minlength=len(self)))[:-1])
 
     def get_intersection_matrix(self):
-        # Maybe not necessary function
-        space_dim = 2
-        matr = np.zeros((space_dim, self._dim+1, self._dim+1))
-        for col in range(self._dim+1):
-            for row in range(self._dim+1):
-                if col!=row and type(self.get(row,col))!= bool:
-                    matr[:,col,row] = self.get(row,col)
+        ''' Intersection points [dim x N x N] (zero if not intersecting) '''
+        matr = np.zeros((self.dim, len(self), len(self)))
+        ind_row, ind_col, ind_pairs = self.get_triangle_index()
+        points = self._intersection_points[:, ind_pairs]
+        matr[:, ind_row, ind_col] = points
+        matr[:, ind_col, ind_row] = points
         return matr
 
     def get_bool_triangle_matrix(self):
-        intersection_exists_matrix = np.zeros((self._dim+1,self._dim+1), dtype=bool)
-
-        for col in range(self._dim+1):
-            for row in range(col+1, self._dim+1):
-                if type(self.get(row,col))== bool and (self.get(row,col) == False):
-                    continue
-                intersection_exists_matrix[row, col] = True
-
+        intersection_exists_matrix = np.zeros((len(self), len(self)), dtype=bool)
+        ind_row, ind_col, ind_pairs = self.get_triangle_index()
+        intersection_exists_matrix[ind_row, ind_col] = self._is_intersecting[ind_pairs]
         return intersection_exists_matrix
 
     def get_bool_matrix(self):
         boolMat = self.get_bool_triangle_matrix()
         return boolMat + boolMat.T
 
-    def get_index(self, row, col):
-        if row > np.abs(self._dim):
-            print('WARNING: Fist object index out of bound.')
-            row = 0
-        if row < 0: row = self._dim+1-row
-            
-        if col > np.abs(self._dim):
-            print('WARNING: Second object index out of bound.')
-            col = 1
-        if col < 0: row = self._dim+1-col
-        
-        if row == col:
-            print('WARNING: Self collision observation meainingless.')
-            row, col = 1, 0
+    def get_distance_matrix(self):
+        ''' Distances [N x N] (nan if unknown, zero diagonal) '''
+        distance_matrix = np.zeros((len(self), len(self)))
+        ind_row, ind_col, ind_pairs = self.get_triangle_index()
+        distance_matrix[ind_row, ind_col] = self._distance[ind_pairs]
+        distance_matrix[ind_col, ind_row] = self._distance[ind_pairs]
+        return distance_matrix
+
+
+class DistanceMatrix(Intersection_matrix):
+    ''' Intersection_matrix with item access to the distance, e.g. dist_matrix[ii, jj] = None (unknown) '''
+    def __getitem__(self, key):
+        return self.get_distance(key[0], key[1])
+
+    def __setitem__(self, key, value):
+        self.set_distance(key[0], key[1], value)
+
+
+def get_intersection_points(obs1, obs2, Gamma_steps=5):
+    '''
+    Points of the common section of two obstacles [dim x M] (empty if they do not intersect).
+    The boundary of each obstacle (with margin) and Gamma_steps-1 scaled copies towards
+    its center are checked against the other obstacle.
+    '''
+    dim = obs1.dim
+    intersection_sf = np.zeros((dim, 0))
+
+    for obs_a, obs_b in [(obs1, obs2), (obs2, obs1)]: # Do it both ways
+        x_obs_sf = obs_a.boundary_points_margin_global
+        center = np.reshape(obs_a.center_position, (dim, 1))
+
+        # Increase resolution by sampling points within obstacle, too
+        samples = [x_obs_sf] + [center + (x_obs_sf-center)*ii/Gamma_steps for ii in range(1, Gamma_steps)] + [center]
+        samples = np.hstack(samples)
+
+        Gamma = obs_b.get_gamma(samples, in_global_frame=True)
+        intersection_sf = np.hstack((intersection_sf, samples[:, Gamma<1]))
+
+    return intersection_sf
+
+
+class DisjointSet():
+    '''
+    Union-find of N elements (union by size, path halving), e.g. the families of intersecting
+    obstacles. The union edges are stored (each pair once), such that an element can be removed
+    (or isolated) by rebuilding the sets from the remaining edges.
+    '''
+    def __init__(self, n_elements=0, pairs=[]):
+        self._parent = list(range(n_elements))
+        self._size = [1 for ii in range(n_elements)]
+        self._edges = set() # Pairs (ii, jj) with ii<jj
+        self.version = 0 # Increased with each change of the sets
+        self._labels = None
+        self._labels_version = None
+
+        for ii, jj in pairs:
+            self.union(ii, jj)
+
+    def __len__(self):
+        return len(self._parent)
+
+    def find(self, ii):
+        parent = self._parent
+        while parent[ii] != ii:
+            parent[ii] = parent[parent[ii]]
+            ii = parent[ii]
+        return ii
+
+    def union(self, ii, jj):
+        ''' Merge the sets of ii and jj. Returns True if they were not connected. '''
+        ii, jj = int(ii), int(jj)
+        if ii != jj:
+            self._edges.add((min(ii, jj), max(ii, jj)))
+        root_ii, root_jj = self.find(ii), self.find(jj)
+        if root_ii == root_jj:
+            return False
+
+        if self._size[root_ii] < self._size[root_jj]:
+            root_ii, root_jj = root_jj, root_ii
+        self._parent[root_jj] = root_ii
+        self._size[root_ii] += self._size[root_jj]
+        self.version += 1
+        return True
+
+    def is_connected(self, ii, jj):
+        return self.find(ii) == self.find(jj)
+
+    def add(self):
+        ''' Append a new (single) element '''
+        self._parent.append(len(self._parent))
+        self._size.append(1)
+        self.version += 1
+
+    def isolate(self, index):
+        ''' Remove all unions of the element index '''
+        self._rebuild(len(self), [(ii, jj) for ii, jj in self._edges if ii!=index and jj!=index])
+
+    def remove(self, index):
+        ''' Remove the element index (the following indices are shifted as in a list) '''
+        edges = [(ii-(ii>index), jj-(jj>index)) for ii, jj in self._edges if ii!=index and jj!=index]
+        self._rebuild(len(self)-1, edges)
+
+    def _rebuild(self, n_elements, edges):
+        version = self.version
+        self.__init__(n_elements, edges)
+        self.version = version + 1
+
+    def get_labels(self):
+        ''' Label of the set of each element [N] (int from 0 to number of sets-1, in order of appearance) '''
+        if self._labels_version != self.version:
+            roots = np.array(self._parent, dtype=int)
+            while True: # Pointer jumping (all elements at once)
+                roots_next = roots[roots]
+                if np.array_equal(roots_next, roots):
+                    break
+                roots = roots_next
+            roots_unique, ind_first, ind_inverse = np.unique(roots, return_index=True, return_inverse=True)
+            # Relabel in order of the first element of each set
+            label_order = np.argsort(np.argsort(ind_first))
+            self._labels = label_order[np.reshape(ind_inverse, (-1))]
+            self._labels_version = self.version
+        return self._labels
+
+    def get_groups(self):
+        ''' Sets with more than one element (list of sorted index-lists) '''
+        labels = self.get_labels()
+        ind_sorted = np.argsort(labels, kind='mergesort')
+        groups = np.split(ind_sorted, np.cumsum(np.bincount(labels))[:-1])
+        return [[int(ii) for ii in group] for group in groups if group.shape[0] > 1]
+
+
+def get_shortest_path(neighbours, ind_start, ind_end, weights=None):
+    '''
+    Shortest path between two nodes of a graph. Breadth first search (number of edges) or
+    Dijkstra if the weights are given.
+
+    INPUT
+    neighbours [list of index-arrays]: adjacency list
+    weights [function(ii, jj)]: non negative weight of the edge (ii, jj)
+
+    OUTPUT
+    path [list of indices from ind_start to ind_end] (None if they are not connected)
+    '''
+    ind_previous = {ind_start: None}
+
+    if weights is None:
+        queue = deque([ind_start])
+        while len(queue) and not ind_end in ind_previous:
+            ii = queue.popleft()
+            for jj in neighbours[ii]:
+                if not jj in ind_previous:
+                    ind_previous[jj] = ii
+                    queue.append(jj)
+    else:
+        distance = {ind_start: 0}
+        is_visited = set()
+        queue = [(0, ind_start)]
+        while len(queue):
+            dist_ii, ii = heapq.heappop(queue)
+            if ii in is_visited:
+                continue
+            if ii == ind_end:
+                break
+            is_visited.add(ii)
+            for jj in neighbours[ii]:
+                dist_jj = dist_ii + weights(ii, jj)
+                if not jj in distance or dist_jj < distance[jj]:
+                    distance[jj] = dist_jj
+                    ind_previous[jj] = ii
+                    heapq.heappush(queue, (dist_jj, jj))
+
+    if not ind_end in ind_previous:
+        return None
 
-        if col > row: # inverse indices
-            col, row = row, col
+    path = [ind_end]
+    while not ind_previous[path[-1]] is None:
+        path.append(ind_previous[path[-1]])
+    return [int(ii) for ii in path[::-1]]
 
-        return int((row-col-1) + col*((self._dim) + self._dim-(col-1) )*0.5)
+
+def get_intersection_groups(n_obs, intersecting_pairs):
+    ''' Connected obstacles (list of sorted index-lists) from the list of intersecting pairs (ii, jj). '''
+    return DisjointSet(n_obs, intersecting_pairs).get_groups()
+
+
+def get_intersection_reference_point(intersection_points):
+    ''' Common reference point of an intersection group (numerical mean) from a list of point-arrays [dim x M] '''
+    intersection_sf = np.unique(np.hstack(intersection_points), axis=1)
+    return np.mean(intersection_sf, axis=1)
+
+
+def get_bounding_boxes(obs):
+    ''' Bounding boxes of all obstacles as arrays box_low, box_high [N x dim] '''
+    box = [obs[it_obs].get_bounding_box() for it_obs in range(len(obs))]
+    return np.array([bb[0] for bb in box]), np.array([bb[1] for bb in box])
+
+
+def get_intersecting_pairs(obs, Gamma_steps=5):
+    '''
+    Intersection points of all intersecting pairs, i.e. a dictionary {(ii, jj): [dim x M]} with ii<jj.
+    Only the pairs with overlapping bounding boxes (broadphase) are sampled.
+    '''
+    intersection_points = {}
+    for it_obs1, it_obs2 in get_overlapping_box_pairs(*get_bounding_boxes(obs)):
+        intersection_sf = get_intersection_points(obs[it_obs1], obs[it_obs2], Gamma_steps)
+        if intersection_sf.shape[1]:
+            intersection_points[(int(it_obs1), int(it_obs2))] = intersection_sf
+    return intersection_points
 
 
 def obs_common_section(obs):
-    #OBS_COMMON_SECTION finds common section of two ore more obstacles 
-    # at the moment only solution in two d is implemented
+    '''
+    Finds the common section of two or more obstacles and sets the reference point of
+    all intersecting obstacles to its (numerical) mean.
 
+    Only the pairs with overlapping bounding boxes (broadphase) are sampled.
+
+    Returns the intersecting groups [list of index-lists]
+    '''
     N_obs = len(obs)
     # No intersection region 
     if N_obs <= 1:
         return []
 
-    # Intersction surface
-    intersection_obs = []
-    intersection_sf = []
-    intersection_sf_temp = []
-    it_intersect = -1
-
-    # Ext for more dimensions
-    d = len(obs[0].x0)
-
-    N_points = 30 # Choose number of points each iteration
-    Gamma_steps = 5 # Increases computational cost
-    
-    rotMat = np.zeros((d,d, N_obs))
-    
-    for it_obs in range(N_obs):
-        rotMat[:,:,it_obs] = np.array(( obs[it_obs].rotMatrix ))
-        obs[it_obs].draw_obstacle()
-        obs[it_obs].cent_dyn = np.copy(obs[it_obs].x0) # set default value
-        
-    for it_obs1 in range(N_obs):
-        intersection_with_obs1 = False
-        # Check if current obstacle 'it_obs1' has already an intersection with another
-        # obstacle 
-        memberFound = False
-        for ii in range(len(intersection_obs)):
-            if it_obs1 in intersection_obs[ii]:
-                memberFound=True
-                continue
+    intersection_points = get_intersecting_pairs(obs)
+    intersection_obs = get_intersection_groups(N_obs, intersection_points.keys())
 
-        for it_obs2 in range(it_obs1+1,N_obs):
-            # Check if obstacle has already an intersection with another
-            # obstacle 
-            memberFound=False
-            for ii in range(len(intersection_obs)):
-                if it_obs2 in intersection_obs[ii]:
-                    memberFound=True 
-                    continue
-
-            if memberFound: continue 
-
-            if intersection_with_obs1:# Modify intersecition part
-                obsCloseBy = False
-
-                # Roughly check dimensions before starting expensive calculation
-                #for ii in intersection_obs:
-                    # if it_intersect[ii]:
-                    #     if LA.norm(obs[ii].x0 - obs[it_obs2].x0) < np.lina(obs[ii].a)*obs[ii].sf + np.linalg.norm(obs[it_obs2].a)*obs[it_obs2].sf:
-                    #         # Obstacles to far apart
-                    #         obsCloseBy = True
-                    #         break
-
-                #if obsCloseBy:
-                if True:
-                    N_inter = intersection_sf[it_intersect].shape[1] # Number of intersection points
-
-                    ## R = compute_R(d,obs[it_obs2].th_r)
-                    Gamma_temp = ( rotMat[:,:,it_obs2].T @(intersection_sf[it_intersect]-np.tile(obs[it_obs2].x0,(N_inter,1)).T )/ np.tile(obs[it_obs2].a,(N_inter,1)).T ) ** (2*np.tile(obs[it_obs2].p,(N_inter,1)).T)
-                    Gamma = np.sum( 1/obs[it_obs2].sf *Gamma_temp, axis=0 )
-
-                    ind = Gamma<1
-                    
-                    if sum(ind):
-                        intersection_sf[it_intersect] = intersection_sf[it_intersect][:,ind]
-                        intersection_obs[it_intersect] = intersection_obs[it_intersect] + [it_obs2]
-            else:
-                # Roughly check dimensions before starting expensive calculation
-                #if sqrt(sum((np.array(obs[it_obs1].x0)-np.array(obs[it_obs2].x0))**2)) < max(obs[it_obs1].a)*obs[it_obs1].sf + max(obs[it_obs2].a)*obs[it_obs2].sf: # Obstacles are close enough
-                if True:
-                    
-                    # get all points of obs2 in obs1
-                    # R = compute_R(d,obs[it_obs1].th_r)
-                    # \Gamma = \sum_[i=1]^d (xt_i/a_i)^(2p_i) == 1
-                    N_points = len(obs[it_obs1].x_obs_sf)
-                    
-                    Gamma_temp = (rotMat[:,:,it_obs1].T @  (np.array(obs[it_obs2].x_obs_sf).T-np.tile(obs[it_obs1].x0,(N_points,1)).T ) / np.tile(obs[it_obs1].a, (N_points,1)).T )
-                    Gamma = np.sum( (1/obs[it_obs1].sf *  Gamma_temp) ** (2*np.tile(obs[it_obs1].p, (N_points,1)).T), axis=0)
-                    intersection_sf_temp = np.array(obs[it_obs2].x_obs_sf)[Gamma<1,:].T
-
-                    # Get all poinst of obs1 in obs2
-                    #                 R = compute_R(d,obs[it_obs2].th_r)
-                    Gamma_temp = ( rotMat[:,:,it_obs2].T @ (np.array(obs[it_obs1].x_obs_sf).T-np.tile(obs[it_obs2].x0,(N_points,1)).T ) / np.tile(obs[it_obs2].a, (N_points,1)).T )
-                    Gamma = np.sum(( 1/obs[it_obs2].sf *  Gamma_temp)  ** (2*np.tile(obs[it_obs2].p, (N_points,1)).T), axis=0 )
-                    intersection_sf_temp = np.hstack((intersection_sf_temp, np.array(obs[it_obs1].x_obs_sf)[Gamma<1,:].T ) )
-
-                    if intersection_sf_temp.shape[1] > 0:
-                        it_intersect = it_intersect + 1
-                        intersection_with_obs1 = True
-                        intersection_sf.append(intersection_sf_temp)
-                        intersection_obs.append([it_obs1,it_obs2])
-
-                        # Increase resolution by sampling points within
-                        # obstacle, too
-                                                    # obstaacles of 2 in 1
-                        for kk in range(2):
-                            
-                            if kk == 0:
-                                it_obs1_ = it_obs1
-                                it_obs2_ = it_obs2
-
-                            elif kk ==1: # Do it both ways
-                                it_obs1_ = it_obs2
-                                it_obs2_ = it_obs1
-
-                            for ii in range(1,Gamma_steps):
-                                N_points_interior = ceil(N_points/Gamma_steps*ii)
-                                
-                                #print('a_temp_outside', np.array(obs[it_obs1_].a)/Gamma_steps*ii)
-                                x_obs_sf_interior= obs[it_obs1_].draw_ellipsoid(numPoints=N_points_interior, a_temp = np.array(obs[it_obs1_].a)/Gamma_steps*ii)
-
-                                resolution = x_obs_sf_interior.shape[1] # number of points 
-
-                                # Get Gamma value
-                                Gamma = np.sum( (1/obs[it_obs2_].sf *  rotMat[:,:,it_obs2_].T @ (x_obs_sf_interior-np.tile(obs[it_obs2_].x0,(resolution,1)).T ) / np.tile(obs[it_obs2_].a, (resolution,1)).T ) ** (2*np.tile(obs[it_obs2_].p, (resolution,1)).T), axis=0)
-                                intersection_sf[it_intersect] = np.hstack((intersection_sf[it_intersect],x_obs_sf_interior[:,Gamma<1] ))
-                                
-                            # Check center point
-                            if 1 > sum( (1/obs[it_obs2_].sf*rotMat[:,:,it_obs2_].T @ ( np.array(obs[it_obs1_].x0) - np.array(obs[it_obs2_].x0) )/ np.array(obs[it_obs2_].a) ) ** (2*np.array(obs[it_obs2_].p))):
-                                intersection_sf[it_intersect] = np.hstack([intersection_sf[it_intersect],np.tile(obs[it_obs1_].x0,(1,1)).T ] )
-
-    if len(intersection_sf)==0:
-        return  []
-
-    for ii in range(len(intersection_obs)):
-    #     plot(intersection_sf[ii](1,:),intersection_sf[ii](2,:),'x')
-        intersection_sf[ii] = np.unique(intersection_sf[ii], axis=1)
-
-        # Get numerical mean
-        x_center_dyn= np.mean(intersection_sf[ii], axis=1)
-        
-        for it_obs in intersection_obs[ii]:
-            obs[it_obs].set_reference_point(x_center_dyn, in_global_frame=True)
+    for group in intersection_obs:
+        x_center_dyn = get_intersection_reference_point(
+            [points for pair, points in intersection_points.items() if pair[0] in group])
 
-    return intersection_obs 
+        for it_obs in group:
+            obs[it_obs].set_reference_point(x_center_dyn, in_global_frame=True)
 
+    return intersection_obs
+
+
+class CommonSectionTracker():
+    '''
+    Incremental version of obs_common_section() and dynamic_center_3d() for animations,
+    i.e. update(obs) gives the same result as obs_common_section(obs) followed by
+    dynamic_center_3d(obs, intersection_obs) on the current obstacles.
+
+    The pairwise results (intersection and dynamic center) are stored sparsely (dictionaries
+    of the pairs) and only recomputed for pairs which involve an obstacle whose pose or shape
+    changed since its pairs were evaluated. The shape includes the reference point, i.e. the
+    pairs of an obstacle are recomputed once more after its reference point was set here.
+    Only the reference points of obstacles with a changed pair or group are recomputed.
+
+    Broadphase: the candidate pairs are found by the overlap of the boxes of the interaction
+    region (bounding box and dynamic center region). As in obs_common_section, the intersection
+    is only sampled if the bounding boxes overlap, otherwise only the dynamic center is evaluated.
+    '''
+    def __init__(self, marg_dynCenter=1.3, numbFactor_closest=2, Gamma_steps=5):
+        self.marg_dynCenter = marg_dynCenter
+        self.numbFactor_closest = numbFactor_closest
+        self.Gamma_steps = Gamma_steps
+
+        self.reset()
+
+    def reset(self):
+        self._obstacle_list = []
+        self._versions = []
+        self._intersection_points = {} # {(ii, jj): [dim x M]}
+        self._dynamic_center = {} # {(ii, jj): (weight, delta_reference [dim x 2])}
+        self._pairs = [] # Stored pairs of each obstacle [list of sets]
+        self._group = [] # Intersection group of each obstacle (tuple, empty if none)
+        self._box_low, self._box_high = None, None # Bounding boxes [N x dim]
+        self._center_position, self._interaction_radius = None, None # [N x dim], [N]
+        self.intersection_obs = []
+        self.n_pair_evaluations = 0 # Number of recomputed pairs (last update)
+
+    def get_changed_obstacles(self, obs):
+        ''' Indices of the obstacles which are new or changed pose / shape since the last update '''
+        if (len(obs) != len(self._obstacle_list)
+            or any(not obs[ii] is self._obstacle_list[ii] for ii in range(len(obs)))):
+            self.reset()
+            N_obs = len(obs)
+            self._obstacle_list = [oo for oo in obs]
+            self._versions = [None for oo in obs]
+            self._pairs = [set() for oo in obs]
+            self._group = [() for oo in obs]
+
+            dim = obs[0].dim
+            self._box_low, self._box_high = np.zeros((N_obs, dim)), np.zeros((N_obs, dim))
+            self._center_position = np.zeros((N_obs, dim))
+            self._interaction_radius = np.zeros(N_obs)
+
+        return [ii for ii in range(len(obs))
+                if self._versions[ii] != (obs[ii].pose_version, obs[ii].shape_version)]
+
+    def get_bounding_radius(self, obs_ii):
+        return np.inf if obs_ii.is_boundary else obs_ii.get_bounding_radius()
+
+    def get_interaction_radius(self, obs_ii):
+        '''
+        Half width of a box around the center such that two obstacles can only interact if their
+        boxes overlap. The box contains the bounding box and the pair distance of
+        get_broadphase_distance is smaller than the sum of the two half widths.
+        '''
+        return self.get_bounding_radius(obs_ii) + self.marg_dynCenter*LA.norm(obs_ii.axes_length)
+
+    def get_broadphase_distance(self, obs, ii, jj):
+        ''' Center distance beyond which the obstacles ii and jj (ii<jj) have no dynamic center interaction '''
+        ref_dist = get_dynamic_center_distance(obs[ii], obs[jj], self.marg_dynCenter)[1]
+        # Boundary points of obs[jj] within the dynamic center region of obs[ii]
+        return ref_dist + self.get_bounding_radius(obs[jj])
+
+    def update_geometry(self, obs, ind_changed):
+        ''' Bounding boxes and interaction spheres of the changed obstacles '''
+        for ii in ind_changed:
+            self._box_low[ii, :], self._box_high[ii, :] = obs[ii].get_bounding_box()
+            self._center_position[ii, :] = obs[ii].center_position
+            self._interaction_radius[ii] = self.get_interaction_radius(obs[ii])
+
+    def get_candidate_pairs(self, obs, ind_changed):
+        ''' Pairs (ii, jj) with ii<jj with overlapping interaction region and at least one changed obstacle '''
+        N_obs = len(obs)
+        sphere_low = self._center_position - self._interaction_radius[:, np.newaxis]
+        sphere_high = self._center_position + self._interaction_radius[:, np.newaxis]
+
+        if 4*len(ind_changed) > N_obs: # Sweep and prune over all obstacles
+            is_changed = np.zeros(N_obs, dtype=bool)
+            is_changed[ind_changed] = True
+            pairs = get_overlapping_box_pairs(sphere_low, sphere_high)
+            return [(int(ii), int(jj)) for ii, jj in pairs[is_changed[pairs[:, 0]] | is_changed[pairs[:, 1]], :]]
+
+        pairs = set()
+        for ii in ind_changed:
+            is_overlapping = np.all((sphere_low <= sphere_high[ii, :]) & (sphere_high >= sphere_low[ii, :]), axis=1)
+            for jj in np.nonzero(is_overlapping)[0]:
+                if jj != ii:
+                    pairs.add((min(ii, int(jj)), max(ii, int(jj))))
+        return sorted(pairs)
+
+    def remove_pair(self, pair):
+        self._intersection_points.pop(pair, None)
+        self._dynamic_center.pop(pair, None)
+        self._pairs[pair[0]].discard(pair)
+        self._pairs[pair[1]].discard(pair)
+
+    def update_pair(self, obs, ii, jj):
+        if np.all((self._box_low[ii, :] <= self._box_high[jj, :])
+                  & (self._box_high[ii, :] >= self._box_low[jj, :])):
+            self.n_pair_evaluations += 1
+            intersection_sf = get_intersection_points(obs[ii], obs[jj], self.Gamma_steps)
+        else:
+            intersection_sf = np.zeros((obs[ii].dim, 0))
+
+        if intersection_sf.shape[1]:
+            self._intersection_points[(ii, jj)] = intersection_sf
+        else:
+            if LA.norm(self._center_position[ii, :]-self._center_position[jj, :]) >= self.get_broadphase_distance(obs, ii, jj):
+                return
+
+            self.n_pair_evaluations += 1
+            weight, delta_reference = get_dynamic_center_pair(
+                obs[ii], obs[jj], marg_dynCenter=self.marg_dynCenter, numbFactor_closest=self.numbFactor_closest)
+            if not weight:
+                return
+            self._dynamic_center[(ii, jj)] = (weight, delta_reference)
+
+        self._pairs[ii].add((ii, jj))
+        self._pairs[jj].add((ii, jj))
+
+    def get_dynamic_reference_point(self, obs, ii):
+        ''' Dynamic center of a non-intersecting obstacle from its stored pairs '''
+        weight_obs, delta_reference = [], []
+        for pair in self._pairs[ii]:
+            if not pair in self._dynamic_center:
+                continue
+            jj = pair[1] if pair[0]==ii else pair[0]
+            if len(self._group[jj]):
+                continue
+            weight, delta = self._dynamic_center[pair]
+            weight_obs.append(weight)
+            delta_reference.append(delta[:, 0] if pair[0]==ii else delta[:, 1])
+
+        if not len(weight_obs):
+            return np.array(obs[ii].center_position, dtype=float)
+        return get_dynamic_reference_point(obs[ii], np.array(weight_obs), np.array(delta_reference).T)
+
+    def update(self, obs):
+        '''
+        Update the reference points of all obstacles obs.
+        Returns the intersecting groups [list of index-lists] (as obs_common_section)
+        '''
+        N_obs = len(obs)
+        self.n_pair_evaluations = 0
+        if N_obs <= 1:
+            return []
+
+        ind_changed = self.get_changed_obstacles(obs)
+        if not len(ind_changed):
+            return self.intersection_obs
+
+        # Versions of the evaluation (a reference point which is set below invalidates the pairs again)
+        for ii in ind_changed:
+            self._versions[ii] = (obs[ii].pose_version, obs[ii].shape_version)
+
+        # Obstacles whose reference point has to be recomputed
+        is_affected = np.zeros(N_obs, dtype=bool)
+        is_affected[ind_changed] = True
+
+        # Remove the pairs of the changed obstacles
+        for ii in ind_changed:
+            for pair in list(self._pairs[ii]):
+                is_affected[list(pair)] = True
+                self.remove_pair(pair)
+
+        self.update_geometry(obs, ind_changed)
+        for ii, jj in self.get_candidate_pairs(obs, ind_changed):
+            self.update_pair(obs, ii, jj)
+
+        for ii in ind_changed:
+            for pair in self._pairs[ii]:
+                is_affected[list(pair)] = True
+
+        # Intersections (groups of the affected obstacles)
+        self.intersection_obs = get_intersection_groups(N_obs, self._intersection_points.keys())
+        group_old = self._group
+        self._group = [() for ii in range(N_obs)]
+        for group in self.intersection_obs:
+            for ii in group:
+                self._group[ii] = tuple(group)
+
+        ind_group_changed = [ii for ii in range(N_obs) if self._group[ii] != group_old[ii]]
+        for ii in ind_group_changed:
+            # The dynamic center of the neighbours depends on the intersecting obstacles
+            is_affected[ii] = True
+            for pair in self._pairs[ii]:
+                is_affected[list(pair)] = True
+
+        reference_points = {}
+        for group in self.intersection_obs:
+            if not np.any(is_affected[group]):
+                continue
+            x_center_dyn = get_intersection_reference_point(
+                [self._intersection_points[(ii, jj)] for ii in group
+                 for (ii_pair, jj) in self._pairs[ii] if ii_pair==ii and (ii, jj) in self._intersection_points])
+            for ii in group:
+                reference_points[ii] = x_center_dyn
+
+        # Dynamic center of the other obstacles
+        for ii in np.nonzero(is_affected)[0]:
+            if not len(self._group[ii]):
+                reference_points[ii] = self.get_dynamic_reference_point(obs, ii)
+
+        for ii, reference_point in reference_points.items():
+            if not np.allclose(obs[ii].transform_global2relative(reference_point), obs[ii].local_reference_point):
+                obs[ii].set_reference_point(reference_point, in_global_frame=True)
+
+        return self.intersection_obs
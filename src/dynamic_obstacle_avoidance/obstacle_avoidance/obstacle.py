@@ -27,7 +27,6 @@ from dynamic_obstacle_avoidance.obstacle_avoidance.modulation import *
 # from dynamic_obstacle_avoidance.obstacle_avoidance.obs_dynamic_center_3d import *
 
 # TODO: remove after debugging/developping
-import matplotlib.pyplot as plt
 
 # import quaternion 
 
@@ -41,6 +40,27 @@ class Obstacle(State):
     # TODO -- enforce certain functions
     id_counter = 0
     active_counter = 0
+
+    # Increased with every change of pose, twist or shape (see compiled_environment)
+    _state_version = 0
+    # Shared by all obstacles: increased with every change of any obstacle or container
+    # (compiled_environment only checks the state_version of each obstacle if it changed)
+    modification_counter = 0
+    # Increased with every change of the shape or the reference point (see radius lookup table)
+    _shape_version = 0
+    # Increased with every change of position or orientation
+    _pose_version = 0
+
+    # Tabulated local radius (optional), see build_radius_lookup_table()
+    use_radius_lookup_table = False
+    _radius_lookup_table = None
+
+    # Boundary points are drawn on first access (draw_obstacle(numPoints=boundary_resolution))
+    # and redrawn if the shape / reference point or the resolution changed
+    lazy_boundary_points = False
+    boundary_resolution = None
+    _boundary_key = None # (shape_version, resolution) of the drawn boundary
+    _boundary_global_cache = None # {margin: (pose_version, boundary_key, points)}
     
     def __repr__(self):
         return "Obstacle <<{}>> is of Type: {}".format(self.name, type(self))
@@ -157,6 +177,29 @@ class Obstacle(State):
     @property
     def dimension(self):
         return self.dim
+
+    @property
+    def state_version(self):
+        return self._state_version
+
+    def increment_state_version(self):
+        ''' Has to be called when the obstacle is changed in place (e.g. numpy-array elements) '''
+        self._state_version += 1
+        Obstacle.modification_counter += 1
+
+    @property
+    def shape_version(self):
+        return self._shape_version
+
+    @property
+    def pose_version(self):
+        return self._pose_version
+
+    def increment_shape_version(self):
+        ''' Has to be called when the shape is changed in place (invalidates the radius lookup table) '''
+        self._shape_version += 1
+        self.increment_state_version()
+
     @property
     def center_dyn(self):# TODO: depreciated -- delete
         return self.reference_point
@@ -175,6 +218,7 @@ class Obstacle(State):
     def local_reference_point(self, value):
         # Rename kernel-point?
         self._reference_point = value
+        self.increment_shape_version()
         
     @property
     def reference_point(self):
@@ -184,6 +228,7 @@ class Obstacle(State):
     @reference_point.setter
     def reference_point(self, value):
         self._reference_point = value
+        self.increment_shape_version()
 
     @property
     def orientation(self):
@@ -196,6 +241,8 @@ class Obstacle(State):
         else:
             self._orientation = value
         self.compute_R()
+        self._pose_version += 1
+        self.increment_state_version()
 
     @property
     def position(self):
@@ -215,6 +262,22 @@ class Obstacle(State):
             self._center_position = np.array(value) 
         else:
             self._center_position = value
+        self._pose_version += 1
+        self.increment_state_version()
+
+    def set_pose(self, position, orientation, rotation_matrix=None):
+        ''' Set center position and orientation at once; the rotation matrix is computed if not given. '''
+        self._center_position = np.array(position, dtype=float)
+        if isinstance(orientation, list) and self.dim==3:
+            orientation = np.array(orientation)
+        self._orientation = orientation
+
+        if rotation_matrix is None:
+            self.compute_R()
+        else:
+            self.rotMatrix = rotation_matrix
+        self._pose_version += 1
+        self.increment_state_version()
 
     @property
     def th_r(self): # TODO: will be removed since outdated
@@ -246,21 +309,81 @@ class Obstacle(State):
             import pdb; pdb.set_trace()
         self._linear_velocity = value
 
+    @property
+    def xd(self):
+        return self._xd
+
+    @xd.setter
+    def xd(self, value):
+        self._xd = value
+        self.increment_state_version()
+
+    @property
+    def w(self):
+        return self._w
+
+    @w.setter
+    def w(self, value):
+        self._w = value
+        self.increment_state_version()
+
+    @property
+    def sigma(self):
+        return self._sigma
+
+    @sigma.setter
+    def sigma(self, value):
+        self._sigma = value
+        self.increment_state_version()
+
+    @property
+    def is_boundary(self):
+        return self._is_boundary
+
+    @is_boundary.setter
+    def is_boundary(self, value):
+        self._is_boundary = value
+        self.increment_state_version()
+
+    def update_boundary_points(self):
+        ''' Draw the boundary points if they are outdated (only for lazy_boundary_points) '''
+        if (self.lazy_boundary_points
+            and self._boundary_key != (self._shape_version, self.boundary_resolution)):
+            self.draw_obstacle(numPoints=self.boundary_resolution)
+
+    def get_boundary_points_global(self, margin=False):
+        ''' Boundary points (with margin) in the global frame. They are cached until the pose or the boundary changes. '''
+        self.update_boundary_points()
+        if self._boundary_global_cache is None:
+            self._boundary_global_cache = {}
+
+        key = (self._pose_version, self._boundary_key)
+        if not margin in self._boundary_global_cache or self._boundary_global_cache[margin][0] != key:
+            boundary_points = self.transform_relative2global(
+                self._boundary_points_margin if margin else self._boundary_points)
+            boundary_points.flags.writeable = False # Shared by all callers
+            self._boundary_global_cache[margin] = (key, boundary_points)
+        return self._boundary_global_cache[margin][1]
+
     @property
     def boundary_points(self):
+        self.update_boundary_points()
         return self._boundary_points
 
     @boundary_points.setter
     def boundary_points(self, value):
         self._boundary_points = value
+        self._boundary_global_cache = None
         
     @property
     def boundary_points_local(self):
+        self.update_boundary_points()
         return self._boundary_points
 
     @boundary_points_local.setter
     def boundary_points_local(self, value):
         self._boundary_points = value
+        self._boundary_global_cache = None
 
     @property
     def x_obs(self):
@@ -273,7 +396,7 @@ class Obstacle(State):
 
     @property
     def boundary_points_global(self):
-        return self.transform_relative2global(self._boundary_points)
+        return self.get_boundary_points_global()
 
     # @property
     # def boundary_points_margin(self):
@@ -285,11 +408,13 @@ class Obstacle(State):
 
     @property
     def boundary_points_margin_local(self):
+        self.update_boundary_points()
         return self._boundary_points_margin
     
     @boundary_points_margin_local.setter
     def boundary_points_margin_local(self, value):
         self._boundary_points_margin = value
+        self._boundary_global_cache = None
 
     @property
     def x_obs_sf(self):
@@ -297,8 +422,7 @@ class Obstacle(State):
     
     @property
     def boundary_points_margin_global(self):
-        # import pdb; pdb.set_trace() ## DEBUG ##
-        return self.transform_relative2global(self._boundary_points_margin)
+        return self.get_boundary_points_global(margin=True)
 
     @property
     def boundary_points_margin_global_closed(self):
@@ -338,6 +462,8 @@ class Obstacle(State):
             if not reference_point is None:
                 reference_point = self.transform_global2relative(reference_point)
 
+        use_lookup_table = (reference_point is None and self.use_radius_lookup_table
+                            and self.radius_depends_only_on_direction)
         if reference_point is None:
             reference_point = self.local_reference_point
         else:
@@ -355,13 +481,16 @@ class Obstacle(State):
         
         gamma = np.zeros(dist_position.shape)
         
-        radius = self._get_local_radius(position[:, ind_nonzero], reference_point)
+        if use_lookup_table:
+            radius = self.get_local_radius_from_lookup_table(position[:, ind_nonzero])
+        else:
+            radius = self._get_local_radius(position[:, ind_nonzero], reference_point)
         
         if gamma_type=='proportional':
-            gamma[ind_nonzero] = dist_position[ind_nonzero]/radius[ind_nonzero]
+            gamma[ind_nonzero] = dist_position[ind_nonzero]/radius
 
         elif gamma_type=='linear':
-            gamma[ind_nonzero] = 1 + (dist_position[ind_nonzero]-radius[ind_nonzero])/self.get_reference_length()
+            gamma[ind_nonzero] = 1 + (dist_position[ind_nonzero]-radius)/self.get_reference_length()
             
         else:
             raise NotImplementedError("Not implemented for other gamma types.")
@@ -376,6 +505,86 @@ class Obstacle(State):
 
         return gamma
         
+    def get_bounding_radius(self):
+        ''' Radius of a sphere around the center which contains the obstacle (inf if unknown) '''
+        return np.inf
+
+    def get_bounding_box(self):
+        '''
+        Axis aligned box (global frame) which contains the obstacle (infinite if unknown).
+
+        OUTPUT
+        box_low, box_high [dim]
+        '''
+        radius = np.inf if self.is_boundary else self.get_bounding_radius()
+        center_position = np.array(self.center_position, dtype=float)
+        return center_position-radius, center_position+radius
+
+    def get_gamma_bound_radius(self):
+        ''' Radius r with Gamma(x) >= |x-center|/r, i.e. Gamma>1 outside of the sphere (inf if unknown) '''
+        return np.inf
+
+    @property
+    def radius_depends_only_on_direction(self):
+        ''' True if the local radius is a function of the direction from the reference point only '''
+        return False
+
+    def build_radius_lookup_table(self, n_angles=360):
+        '''
+        Tabulate the local radius over the directions from the reference point, i.e. a polar
+        grid of n_angles in 2D and a spherical grid of (n_angles/2+1) x n_angles in 3D.
+        The table is defined in the local frame, hence it stays valid when the obstacle moves.
+        It is rebuilt when the shape changes (axes, curvature, margin or reference point).
+        '''
+        if not self.dim in (2, 3):
+            raise NotImplementedError("Lookup table only implemented for d=2 and d=3.")
+
+        azimuth = np.linspace(-pi, pi, n_angles, endpoint=False)
+        if self.dim==2:
+            direction = np.vstack((np.cos(azimuth), np.sin(azimuth)))
+            table_shape = (n_angles,)
+        else:
+            polar = np.linspace(0, pi, n_angles//2+1)
+            polar, azimuth = np.meshgrid(polar, azimuth, indexing='ij')
+            direction = np.vstack((np.sin(polar).flatten()*np.cos(azimuth).flatten(),
+                                   np.sin(polar).flatten()*np.sin(azimuth).flatten(),
+                                   np.cos(polar).flatten()))
+            table_shape = polar.shape
+
+        reference_point = np.reshape(self.local_reference_point, (self.dim, 1))
+        radius = self._get_local_radius(reference_point + direction, self.local_reference_point)
+
+        self._radius_lookup_table = np.reshape(radius, table_shape)
+        self._radius_lookup_table_version = self.shape_version
+
+    def get_local_radius_from_lookup_table(self, position):
+        ''' Local radius [N] at the positions [dim x N] (local frame) interpolated from the lookup table '''
+        if self._radius_lookup_table is None or self._radius_lookup_table_version != self.shape_version:
+            self.build_radius_lookup_table(n_angles=self._radius_lookup_table.shape[-1]
+                                           if not self._radius_lookup_table is None else 360)
+
+        direction = position - np.reshape(self.local_reference_point, (self.dim, 1))
+        ind_zero = np.all(direction==0, axis=0)
+        direction[:, ind_zero] = position[:, ind_zero] # Take the direction from the center
+
+        table = self._radius_lookup_table
+        n_azimuth = table.shape[-1]
+
+        azimuth = (np.arctan2(direction[1], direction[0]) + pi)/(2*pi)*n_azimuth
+        ind_azim0 = np.floor(azimuth).astype(int) % n_azimuth
+        ind_azim1 = (ind_azim0+1) % n_azimuth
+        weight_azim = azimuth - np.floor(azimuth)
+
+        if self.dim==2:
+            return (1-weight_azim)*table[ind_azim0] + weight_azim*table[ind_azim1]
+
+        n_polar = table.shape[0]
+        polar = np.arccos(np.clip(direction[2]/LA.norm(direction, axis=0), -1, 1))/pi*(n_polar-1)
+        ind_pol0 = np.minimum(np.floor(polar).astype(int), n_polar-2)
+        weight_pol = polar - ind_pol0
+        return ((1-weight_pol)*((1-weight_azim)*table[ind_pol0, ind_azim0] + weight_azim*table[ind_pol0, ind_azim1])
+                + weight_pol*((1-weight_azim)*table[ind_pol0+1, ind_azim0] + weight_azim*table[ind_pol0+1, ind_azim1]))
+
     # def get_gamma(self, *args, **kwargs):
                 
         # raise NotImplementedError("Child of type {} needs an Implemenation of virtual class.".format(type(self)))
@@ -529,7 +738,6 @@ class Obstacle(State):
             self.orientation = orientation
             self.linear_velocity = np.zeros(self.dim)
             self.angular_velocity = np.zeros(self.dim)
-            self.draw_obstacle()
             return 
         
         dt = time_current - self.timestamp
@@ -567,8 +775,6 @@ class Obstacle(State):
             #TODO add filter
         self.timestamp = time_current
 
-        self.draw_obstacle()
-
     def are_lines_intersecting(self, direction_line, passive_line):
         # TODO only return intersection point or None
         # solve equation line1['point_start'] + a*line1['direction'] = line2['point_end'] + b*line2['direction']
@@ -588,6 +794,7 @@ class Obstacle(State):
                     return True, LA.norm(direction_factors[0]*connection_direction)
  
         if False: # show plot
+            import matplotlib.pyplot as plt
             dir_start = self.transform_relative2global(direction_line['point_start'])
             dir_end = self.transform_relative2global(direction_line['point_end'])
 
@@ -711,6 +918,8 @@ class Obstacle(State):
 
     
     def draw_reference_hull(self, normal_vector, position):
+        import matplotlib.pyplot as plt
+        
         pos_abs = self.transform_relative2global(position)
         norm_abs = self.transform_relative2global_dir(normal_vector)
 
@@ -770,12 +979,13 @@ class Obstacle(State):
                     self.xd = self.func_xd(t)
                     self.w = self.func_w(t)
 
-                self.center_position = [self.center_position[i] + dt*self.xd[i] for i in range(self.d)] # update position
+                center_position = [self.center_position[i] + dt*self.xd[i] for i in range(self.d)] # update position
 
                 if len(x_lim):
-                    self.center_position[0] = np.min([np.max([self.center_position[0], x_lim[0]]), x_lim[1]])
+                    center_position[0] = np.min([np.max([center_position[0], x_lim[0]]), x_lim[1]])
                 if len(y_lim):
-                    self.center_position[1] = np.min([np.max([self.center_position[1], y_lim[0]]), y_lim[1]])
+                    center_position[1] = np.min([np.max([center_position[1], y_lim[0]]), y_lim[1]])
+                self.center_position = center_position
 
                 if self.w: # if new rotation speed
 
@@ -785,10 +995,9 @@ class Obstacle(State):
                         self.th_r = [self.th_r[i]+dt*self.w[i] for i in range(self.d)]  #update orientation/attitude
                     self.compute_R() # Update rotation matrix
 
-                self.draw_obstacle()
-
     def get_scaled_boundary_points(self, scale, safety_margin=True, redraw_obstacle=False):
         # Draws at 1:scale
+        self.update_boundary_points()
         if safety_margin:
             scaled_boundary_points = scale*self._boundary_points_margin
         else:
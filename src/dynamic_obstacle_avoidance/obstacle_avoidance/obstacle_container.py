@@ -11,6 +11,8 @@ import copy
 # from math import sin, cos, pi, ceil
 from math import pi
 import warnings, sys
+from collections import OrderedDict
+import multiprocessing
 
 import numpy.linalg as LA
 import matplotlib.pyplot as plt
@@ -22,13 +24,15 @@ from dynamic_obstacle_avoidance.obstacle_avoidance.modulation import *
 from dynamic_obstacle_avoidance.obstacle_avoidance.obs_common_section import *
 from dynamic_obstacle_avoidance.obstacle_avoidance.obs_dynamic_center_3d import *
 
-from dynamic_obstacle_avoidance.obstacle_avoidance.obstacle_learning import LearningObstacle
+from dynamic_obstacle_avoidance.obstacle_avoidance.obstacle import Obstacle
+from dynamic_obstacle_avoidance.obstacle_avoidance.obstacle_learning import LearningObstacle, learn_obstacle_from_cluster
 
-from dynamic_obstacle_avoidance.obstacle_avoidance.obs_common_section import Intersection_matrix
+from dynamic_obstacle_avoidance.obstacle_avoidance.obs_common_section import Intersection_matrix, DistanceMatrix
+from dynamic_obstacle_avoidance.obstacle_avoidance.compiled_environment import CompiledEnvironment
+from dynamic_obstacle_avoidance.obstacle_avoidance.spatial_index import GridHashIndex
 
 visualize_debug = False
 
-from sklearn.cluster import DBSCAN # Only used for learning (Clustering)
 
 class BaseContainer():
     def __init__(self, obs_list=None):
@@ -43,26 +47,70 @@ class BaseContainer():
                     self.index_wall = ii
         else:
             self._obstacle_list = []
-        # pass
+        self.reset_name_index()
+
+    def reset_name_index(self):
+        ''' Dictionary name -> index (the first obstacle if the name is not unique) '''
+        self._name_index = {}
+        for ii in range(len(self._obstacle_list)-1, -1, -1):
+            self._name_index[self._obstacle_list[ii].name] = ii
+
+    def get_index(self, key):
+        ''' Index of the obstacle with the name key (or the integer key) '''
+        if not isinstance(key, str):
+            if key < 0:
+                key += len(self._obstacle_list)
+            return key
+
+        ind = self._name_index.get(key)
+        if (ind is None or ind >= len(self._obstacle_list)
+            or self._obstacle_list[ind].name != key):
+            # The obstacle was renamed or the list was changed directly
+            self.reset_name_index()
+            ind = self._name_index.get(key)
+            if ind is None:
+                raise ValueError("Obstacle <<{}>> not in list.".format(key))
+        return ind
 
     def __getitem__(self, key):
         ''' List-like or dictionarry-like access to obstacle'''
         if isinstance(key, (str)):
-            for ii in range(len(self._obstacle_list)):
-                if self._obstacle_list[ii].name == key:
-                    return self._obstacle_list[ii]
-            raise ValueError("Obstacle <<{}>> not in list.".format(key))
+            return self._obstacle_list[self.get_index(key)]
         else:
             return self._obstacle_list[key]
 
     def __setitem__(self, key, value):
         # Is this useful?
+        key = self.get_index(key)
+        name_old = self._obstacle_list[key].name
         self._obstacle_list[key] = value
+        Obstacle.modification_counter += 1
+
+        # Only the names of this index change (other obstacles with the old name are found by get_index)
+        if self._name_index.get(name_old)==key:
+            del self._name_index[name_old]
+        if self._name_index.get(value.name, len(self._obstacle_list)) > key:
+            self._name_index[value.name] = key
+
+        if value.is_boundary:
+            if not self.index_wall in (None, key):
+                warnings.warn("Two wall obstacles in container.")
+            self.index_wall = key
+        elif self.index_wall==key:
+            self.index_wall = None
     
     def __delitem__(self, key):
         '''Obstacle is not part of the workspace anymore.'''
-        
+        key = self.get_index(key)
+        name = self._obstacle_list[key].name
         del(self._obstacle_list[key])
+        Obstacle.modification_counter += 1
+
+        if self._name_index.get(name)==key:
+            del self._name_index[name]
+        for name, ind in self._name_index.items(): # Shift the following obstacles
+            if ind > key:
+                self._name_index[name] = ind-1
 
         if not self.index_wall is None:
             if self.index_wall>key:
@@ -75,11 +123,117 @@ class BaseContainer():
 
     def append(self, value): # Compatibility with normal list.
         self._obstacle_list.append(value)
+        Obstacle.modification_counter += 1
+        self._name_index.setdefault(value.name, len(self._obstacle_list)-1)
         if value.is_boundary:
             if not self.index_wall is None:
                 warnings.warn("Two wall obstacles in container.")
             self.index_wall = len(self._obstacle_list)-1
 
+    def update_poses(self, poses):
+        '''
+        Set the pose of several obstacles at once (e.g. the tracker updates of one time step).
+        The rotation matrices are computed for all obstacles together (2D).
+
+        INPUT
+        poses [dict]: {name: (position, orientation)}
+
+        OUTPUT
+        ind_updated [array of int]: indices of the updated obstacles
+        '''
+        names = list(poses.keys())
+        ind_updated = np.array([self.get_index(name) for name in names], dtype=int)
+        if not len(names):
+            return ind_updated
+
+        positions = np.array([poses[name][0] for name in names], dtype=float)
+        orientations = [poses[name][1] for name in names]
+        self.set_poses(ind_updated, positions, orientations)
+        return ind_updated
+
+    def set_poses(self, index, positions, orientations):
+        ''' Set the poses of the obstacles index [N] to positions [N x dim] and orientations [N] '''
+        rotation_matrices = [None for ii in index]
+        if positions.shape[1]==2:
+            angle = np.array(orientations, dtype=float)
+            cos_angle, sin_angle = np.cos(angle), np.sin(angle)
+            rotation_matrices = np.array([[cos_angle, -sin_angle],
+                                          [sin_angle, cos_angle]]).transpose(2, 0, 1)
+
+        for kk, ii in enumerate(index):
+            self._obstacle_list[ii].set_pose(positions[kk, :], orientations[kk],
+                                             rotation_matrix=rotation_matrices[kk])
+
+    def update_positions_and_orientations(self, positions, orientations, index=None, time_current=None, k_position=0.9, k_linear_velocity=0.9, k_orientation=0.9, k_angular_velocity=0.9, reset=False):
+        '''
+        Filtered pose and twist update of several obstacles at once, i.e. the batch version of
+        Obstacle.update_position_and_orientation. Each obstacle keeps its own timestamp.
+        The boundary is not redrawn, since the boundary points are in the local frame.
+
+        INPUT
+        positions [N x dim] & orientations [N] (2D)
+        index [N]: indices or names of the obstacles (default: all obstacles)
+        time_current [float] or [N]: time of the measurements (default: now)
+        reset [bool] or [N]: set the pose and zero velocity (the timestamp is not changed)
+
+        OUTPUT
+        index [array of int]: updated obstacles
+        '''
+        if index is None:
+            index = np.arange(len(self._obstacle_list))
+        else:
+            index = np.array([self.get_index(ii) for ii in index], dtype=int)
+        n_obs = index.shape[0]
+        if not n_obs:
+            return index
+
+        positions = np.reshape(np.array(positions, dtype=float), (n_obs, -1))
+        orientations = np.reshape(np.array(orientations, dtype=float), (n_obs))
+        if positions.shape[1]>2:
+            raise NotImplementedError("Implement for dimension >2.")
+
+        if time_current is None:
+            time_current = time.time()
+        time_current = np.ones(n_obs)*time_current
+        reset = np.ones(n_obs, dtype=bool)&reset
+
+        obs_list = [self._obstacle_list[ii] for ii in index]
+        timestamp = np.array([obs.timestamp for obs in obs_list])
+        position_old = np.array([obs.center_position for obs in obs_list], dtype=float)
+        orientation_old = np.array([obs.orientation for obs in obs_list], dtype=float)
+        linear_velocity = np.array([obs.linear_velocity for obs in obs_list], dtype=float)
+        angular_velocity = np.array([np.sum(obs.angular_velocity) for obs in obs_list], dtype=float)
+
+        dt = (time_current - timestamp)[:, np.newaxis]
+        ind = ~reset
+        new_linear_velocity = (positions[ind, :]-position_old[ind, :])/dt[ind]
+        new_angular_velocity = angle_difference_directional(orientations[ind], orientation_old[ind])/dt[ind, 0]
+
+        linear_velocity[ind, :] = k_linear_velocity*linear_velocity[ind, :] + (1-k_linear_velocity)*new_linear_velocity
+        positions[ind, :] = (k_position*(linear_velocity[ind, :]*dt[ind] + position_old[ind, :])
+                             + (1-k_position)*positions[ind, :])
+
+        angular_velocity[ind] = k_angular_velocity*angular_velocity[ind] + (1-k_angular_velocity)*new_angular_velocity
+
+        # Periodic weighted average (as periodic_weighted_sum) of prediction and measurement
+        angle_prediction = angular_velocity[ind]*dt[ind, 0] + orientation_old[ind]
+        reference_angle = angle_modulo(angle_difference_directional(angle_prediction, orientations[ind])/2.0
+                                       + orientations[ind])
+        orientations[ind] = angle_modulo(
+            k_orientation*angle_modulo(angle_prediction-reference_angle)
+            + (1-k_orientation)*angle_modulo(orientations[ind]-reference_angle) + reference_angle)
+
+        linear_velocity[reset, :] = 0
+        angular_velocity[reset] = 0
+
+        self.set_poses(index, positions, orientations)
+        for kk, obs in enumerate(obs_list):
+            obs.linear_velocity = linear_velocity[kk, :]
+            obs.angular_velocity = angular_velocity[kk]
+            if not reset[kk]:
+                obs.timestamp = time_current[kk]
+        return index
+
     @property
     def dimension(self):
         # Dimension of all obstacles is expected to be equal
@@ -105,8 +259,20 @@ class LearningContainer(BaseContainer):
 
         # self.temp = 0
             
-    def create_obstacles_from_data(self, data, label, cluster_eps=0.1, cluster_min_samles=10, label_free=0, label_obstacle=1, plot_raw_data=False):
-        # TODO: numpy import instead?
+    def create_obstacles_from_data(self, data, label, cluster_eps=0.1, cluster_min_samles=10, label_free=0, label_obstacle=1, plot_raw_data=False, support_budget=None, n_workers=1, negative_distance_factor=None):
+        '''
+        Cluster the obstacle data (DBSCAN) and learn one obstacle for each cluster.
+        The negative samples of a cluster are the free data and the other clusters.
+
+        INPUT
+        data [dim x N], label [N]
+        support_budget [int]: number of support vectors of each obstacle after compression (default: no compression)
+        n_workers [int]: number of processes for the learning of the clusters (None: number of cpus)
+        negative_distance_factor [float]: only negative samples closer than negative_distance_factor*max_dist
+            to the center of the cluster are used (default: all). Gamma is only finite up to 2*max_dist,
+            hence a factor >= 2 is recommended.
+        '''
+        from sklearn.cluster import DBSCAN # Only used for learning (Clustering)
         
         data_obs = data[:, label==label_obstacle]
         data_free = data[:, label==label_free]
@@ -131,24 +297,87 @@ class LearningContainer(BaseContainer):
         # TODO: can obs_index be used?
 
         n_obstacles = np.sum(cluster_labels>=0)
-        
-        obs_points = [] #
-        
+
+        learning_kwargs = {'support_budget': support_budget}
+        clusters_data = []
         for oo in range(n_obstacles):
             ind_clusters = (clusters.labels_==oo)
-            obs_points.append(data_obs[:, ind_clusters])
+            obs_points = data_obs[:, ind_clusters]
 
-            mean_position = np.mean(obs_points[-1], axis=1)
+            mean_position = np.mean(obs_points, axis=1)
             # TODO: make sure mean_position is within obstacle...
-            
-            self._obstacle_list.append(LearningObstacle(center_position=mean_position))
 
-            
             data_non_obs_temp = np.hstack((data_obs[:, ~ind_clusters], data_free))
-            self._obstacle_list[oo].learn_obstacles_from_data(data_obs=obs_points[oo], data_free=data_non_obs_temp)
+
+            if not negative_distance_factor is None:
+                max_dist = np.max(LA.norm(obs_points - np.tile(mean_position, (obs_points.shape[1], 1)).T, axis=0))
+                dist_negative = LA.norm(data_non_obs_temp - np.tile(mean_position, (data_non_obs_temp.shape[1], 1)).T, axis=0)
+                ind_close = dist_negative < negative_distance_factor*max_dist
+                if np.sum(ind_close):
+                    data_non_obs_temp = data_non_obs_temp[:, ind_close]
+
+            clusters_data.append((mean_position, obs_points, data_non_obs_temp, learning_kwargs))
+
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+
+        if n_workers > 1 and n_obstacles > 1:
+            pool = multiprocessing.Pool(processes=min(n_workers, n_obstacles))
+            try:
+                obstacles = pool.map(learn_obstacle_from_cluster, clusters_data) # Keeps the order of the clusters
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            obstacles = [learn_obstacle_from_cluster(cluster) for cluster in clusters_data]
+
+        for obs in obstacles:
+            self.append(obs)
+
+    def save_obstacles_to_file(self, file_name):
+        '''
+        Store the learned obstacles in an (uncompressed) npz-file.
+
+        The support vectors and coefficients of all obstacles are stacked, the obstacle oo
+        has the entries support_index[oo]:support_index[oo+1].
+        '''
+        if not file_name.endswith('.npz'):
+            file_name = file_name + '.npz'
+
+        n_support = [obs.n_support_vectors for obs in self._obstacle_list]
+        np.savez(file_name,
+                 file_version=np.array(1),
+                 center_position=np.array([obs.center_position for obs in self._obstacle_list], dtype=float),
+                 reference_point=np.array([obs.local_reference_point for obs in self._obstacle_list], dtype=float),
+                 max_dist=np.array([obs._max_dist for obs in self._obstacle_list], dtype=float),
+                 support_index=np.hstack((0, np.cumsum(n_support))).astype(int),
+                 support_vectors=np.vstack([obs.support_vectors for obs in self._obstacle_list]),
+                 dual_coef=np.hstack([obs.dual_coef for obs in self._obstacle_list]),
+                 intercept=np.array([obs.intercept for obs in self._obstacle_list], dtype=float),
+                 gamma_svm=np.array([obs.gamma_svm for obs in self._obstacle_list], dtype=float))
 
     def load_obstacles_from_file(self, file_name):
-        pass
+        '''
+        Append the obstacles stored with save_obstacles_to_file (no learning / sklearn needed).
+        '''
+        if not file_name.endswith('.npz'):
+            file_name = file_name + '.npz'
+
+        with np.load(file_name) as data:
+            support_index = data['support_index']
+            support_vectors = data['support_vectors']
+            dual_coef = data['dual_coef']
+
+            for oo in range(data['center_position'].shape[0]):
+                obs = LearningObstacle(center_position=data['center_position'][oo, :])
+                if np.sum(np.abs(data['reference_point'][oo, :])):
+                    obs.set_reference_point(data['reference_point'][oo, :], in_global_frame=False)
+                obs._max_dist = data['max_dist'][oo]
+
+                ind_support = slice(support_index[oo], support_index[oo+1])
+                obs.set_svm_model(support_vectors[ind_support, :], dual_coef[ind_support],
+                                  data['intercept'][oo], data['gamma_svm'][oo])
+                self.append(obs)
 
 
 class ObstacleContainer(BaseContainer):
@@ -176,15 +405,34 @@ class ObstacleContainer(BaseContainer):
         self._unique_families = None
         self._rotation_direction = None
 
+        # Union-find of the families (intersecting / parent-child obstacles) and its version of the labels
+        self._family_sets = None
+        self._family_version = None
+
+        # Intersection adjacency and cached (unweighted) shortest paths {(start, end, adjacency version): path}
+        self.intersection_matrix = None
+        self._adjacency_list = None
+        self._adjacency_version = None
+        self._path_cache = OrderedDict()
+        self.path_cache_size = 1000
+
+        # Struct-of-arrays snapshot of the obstacles (see compile)
+        self._compiled_environment = None
+
+        # Spatial index of the influence regions and its (snapshot-version, gamma_cutoff)
+        self._spatial_index = None
+        self._spatial_index_key = None
+
         if len(self) == 0:
             # self._intersection_matrix = None
             self._dynamic_reference_points = None
             self._distance_matrix = None
         else:
             # self._intersection_matrix = Intersection_matrix(n_obs=, dim=self[0].dim)
-            self._dynamic_reference_points = np.zeros((2, n_obs, n_obs))
-            self._distance_matrix = DistanceMatrix(n_obs=self.number)
+            self._dynamic_reference_points = np.zeros((2, self.number, self.number))
+            self._distance_matrix = DistanceMatrix(self.number, self.dim)
 
+        self.reset_name_index()
         # The reset clusters has to be called after all obstacles are inserted in order to update the container
 
     def reset_clusters(self):
@@ -210,36 +458,27 @@ class ObstacleContainer(BaseContainer):
     def number(self):
         return len(self._obstacle_list)
 
-    def __getitem__(self, key):
-        ''' List-like or dictionarry-like access to obstacle'''
-        if isinstance(key, (str)):
-            for ii in range(len(self._obstacle_list)):
-                if self._obstacle_list[ii].name == key:
-                    return self._obstacle_list[ii]
-            raise ValueError("Obstacle <<{}>> not in list.".format(key))
-        else:
-            return self._obstacle_list[key]
-
     def __setitem__(self, key, value):
-        # Is this useful?
-        self._obstacle_list[key] = value
+        key = self.get_index(key)
+        super().__setitem__(key, value)
+        self._distance_matrix.reset(key)
 
-        for jj in range(self.number):
-            if jj == key:
-                continue
-            self._distance_matrix[jj, key] = None
+        if not self._family_sets is None:
+            self._family_sets.isolate(key)
+        if not self.intersection_matrix is None:
+            self.intersection_matrix.reset(key)
 
     def __delitem__(self, key):
         '''Obstacle is not part of the workspace anymore.'''
-        
-        del(self._obstacle_list[key])
-        if self.index_wall>key:
-            self.index_wall -= 1
-        elif self.index_wall==key:
-            self.index_wall = None
+        key = self.get_index(key)
+        super().__delitem__(key)
+
+        self._distance_matrix.delete(key)
 
-        warnings.warn("Intersection Matrix is not updated properly.")
-        self._distance_matrix = Intersection_matrix(len(self._obstacle_list), self[0].dim)
+        if not self._family_sets is None:
+            self._family_sets.remove(key)
+        if not self.intersection_matrix is None:
+            self.intersection_matrix.delete(key)
 
     @property
     def dimension(self):
@@ -261,27 +500,49 @@ class ObstacleContainer(BaseContainer):
 
         
     def append(self, value): # Compatibility with normal list.
-        self._obstacle_list.append(value)
-        if value.is_boundary:
-            if not self.index_wall is None:
-                warnings.warn("Two wall obstacles in container.")
-            self.index_wall = len(self._obstacle_list)-1
+        super().append(value)
 
-        self._distance_matrix = Intersection_matrix()
-        
-        distance_matrix_old = self._intersection_matrix
-        for ii in range(self.number-1):
-            for jj in range(ii):
-                self._distance_matrix[ii, jj] = distance_matrix_old[ii, jj]
+        if self._distance_matrix is None:
+            self._distance_matrix = DistanceMatrix(len(self._obstacle_list), self.dimension)
+        else:
+            self._distance_matrix.insert()
+
+        if not self._family_sets is None:
+            self._family_sets.add()
+        if not self.intersection_matrix is None:
+            self.intersection_matrix.insert()
 
     def reset_intersections(self, index=None):
         if index is None:
-            self._distance_matrix = Intersection_matrix(len(self._obstacle_list), self.dimension)
+            self._distance_matrix = DistanceMatrix(len(self._obstacle_list), self.dimension)
         else:
-            for ii in range(self.number):
-                if ii==index:
-                    continue
-                self._distance_matrix[index, ii] = None
+            self._distance_matrix.reset(index)
+
+    def compile(self, force_rebuild=False):
+        ''' Returns the (struct-of-arrays) CompiledEnvironment of all obstacles.
+        It is only rebuilt if an obstacle was added, removed or has changed (state_version).
+        If obs.list is reordered directly, the rebuild has to be forced. '''
+        if self._compiled_environment is None:
+            self._compiled_environment = CompiledEnvironment(self._obstacle_list)
+        else:
+            self._compiled_environment.update(self._obstacle_list, force_rebuild=force_rebuild)
+        return self._compiled_environment
+
+    def get_spatial_index(self, gamma_cutoff):
+        ''' Grid hash of the influence regions (Gamma<gamma_cutoff) of the obstacles.
+        It is rebuilt if the snapshot or the cutoff has changed. '''
+        environment = self.compile()
+        key = (environment.version, gamma_cutoff)
+        if self._spatial_index is None or self._spatial_index_key != key:
+            self._spatial_index = GridHashIndex(environment.center_position,
+                                                environment.get_influence_radius(gamma_cutoff))
+            self._spatial_index_key = key
+        return self._spatial_index
+
+    def get_obstacle_candidates(self, position, gamma_cutoff):
+        ''' Obstacles which can have Gamma<gamma_cutoff at the position [dim] or [dim x M].
+        Returns a boolean array [N] or [N x M] '''
+        return self.get_spatial_index(gamma_cutoff).query(position)
 
     def get_distance(self, index1=None, index2=None):
         if index1 is None:
@@ -293,51 +554,65 @@ class ObstacleContainer(BaseContainer):
 
     
     def find_root(self):
-        ind_parents = np.array([self[ii].ind_parent for ii in range(len(self))])
-        hirarchy_max = np.max([self[ii].ind_parent for ii in range(len(self))])
-
-        ind_roots = (ind_parents<0)
-        ind_parents[ind_roots] = (np.arange(np.sum(ind_roots) , dtype=int)+1)*(-1)
-        
-        for ii in range(hirarchy_max):
-            ind_nonRoot = (ind_parents>=0)
-
-            ind_parents[ind_nonRoot] = ind_parents[ind_parents[ind_nonRoot]]
-            
-        self._family_label = ind_parents*(-1) -1 # Range from 0 to n
-        
+        ''' Join each obstacle with its parent (ind_parent) in the family sets '''
+        for ii in range(len(self)):
+            if self[ii].ind_parent >= 0:
+                self._family_sets.union(ii, self[ii].ind_parent)
 
     def get_sibling_groups(self):
-        intersecting_obs, self.intersection_matrix = obs_common_section_hirarchy(self, update_reference_point=False, get_intersection_matrix=True)
-
-        if True:
-            self._family_label = np.ones(len(self))*(-1)
+        '''
+        Families of obstacles which intersect (or are parent / child). Each family gets a
+        label from 0 to number of families-1.
+        The intersection points (mean of each pair) are stored in the intersection_matrix.
+        '''
+        intersection_points = get_intersecting_pairs(self)
+
+        self.intersection_matrix = Intersection_matrix(len(self), self.dim)
+        for (ii, jj), points in intersection_points.items():
+            self.intersection_matrix.set(ii, jj, np.mean(points, axis=1))
+        self._adjacency_list = None
+        self._path_cache.clear()
+
+        self._family_sets = DisjointSet(len(self), intersection_points.keys())
+        self.find_root()
+        self.update_families()
 
-            it_lablel = 0
-            for ii in range(len(intersecting_obs)):
-                self._family_label[intersecting_obs[ii]] = ii
+    def add_intersection(self, index1, index2, intersection_point=None):
+        ''' Join the families of two obstacles (e.g. new intersection); default point is the mean of the centers '''
+        if self._family_sets is None:
+            self.get_sibling_groups()
+        self._family_sets.union(index1, index2)
 
-            ind_singles = self._family_label == (-1)
+        if intersection_point is None:
+            intersection_point = 0.5*(np.array(self[index1].center_position)+self[index2].center_position)
+        self.intersection_matrix.set(index1, index2, intersection_point)
 
-            if np.sum(ind_singles): # nonzero
-                self._family_label[ind_singles] = np.arange(len(intersecting_obs),
-                                                              len(intersecting_obs)+np.sum(ind_singles))
+    def update_families(self):
+        ''' Labels and centers of the families (only if the family sets changed) '''
+        if self._family_version == self._family_sets.version:
+            return
+        self._family_version = self._family_sets.version
 
-            self._family_label = self._family_label.astype(int)
-        
-        self.find_root()
-        self._unique_families = np.unique(self._family_label)
-        self._family_centers = np.zeros((self.dim, self._unique_families.shape[0]))
+        self._family_label = self._family_sets.get_labels()
+        n_families = np.max(self._family_label)+1 if len(self) else 0
+        self._unique_families = np.arange(n_families)
+        self.update_family_centers()
 
-        center_list = np.array([self[jj].center_position for jj in range(len(self))]).T
-        for ii in range(self._family_centers.shape[1]):
-            self._family_centers[:, ii] = np.mean(center_list[:, (self._family_label==ii)], axis=1)
+        if not self._rotation_direction is None:
+            self.reset_rotation_direction() # Families changed
 
+    def update_family_centers(self):
+        ''' Mean center position of each family [dim x n_families] '''
+        center_list = np.array([self[jj].center_position for jj in range(len(self))], dtype=float).T
+        n_members = np.bincount(self._family_label, minlength=self._unique_families.shape[0])
 
+        self._family_centers = np.zeros((self.dim, self._unique_families.shape[0]))
+        np.add.at(self._family_centers.T, self._family_label, center_list.T)
+        self._family_centers = self._family_centers / n_members
 
     def get_family_index(self, index):
         # Assumption: _unique_families is sorted
-        return self._family_label[index]
+        return self.family_label[index]
 
     # @property
     # def family_center(self, index):
@@ -361,12 +636,14 @@ class ObstacleContainer(BaseContainer):
         
     @property
     def family_label(self):
-        if isinstance(self._family_label, type(None)):
+        if self._family_sets is None:
             self.get_sibling_groups()
+        else:
+            self.update_families()
         return self._family_label
 
     def get_siblings_boolIndex(self, index):
-        label = self._family_label[index]
+        label = self.family_label[index]
         return (label==self._family_label)
         
     def get_siblings_number(self, index):
@@ -406,144 +683,75 @@ class ObstacleContainer(BaseContainer):
         # if index[0] == index[1]
 
     def get_relative_angle_to_family(self, ind_newObstacle, position):
-        # Angle Windup to Family Member
-        # TODO: Debug and verify
-        ind_family = (self._family_label==self._family_label[ind_newObstacle])
-
+        '''
+        Angle windup from the position to the obstacle ind_newObstacle along the shortest
+        connection (through the intersections) from a family member whose influence region
+        the position is in.
+        '''
         short_connection = [ind_newObstacle]
-        for ii in range(ind_family.shape[0]):
-            if not self.is_outside_influence_region(ind_family[ii]):
-                ind_short_connection = self.find_shortes_connection(ind_family[ii], ind_newObstacle)
+        for ii in self.get_siblings_number(ind_newObstacle):
+            if not self.is_outside_influence_region(ii):
+                path = self.find_shortes_connection(ii, ind_newObstacle)
+                if not path is None:
+                    short_connection = path
                 break
 
+        # Under the assumption that everything is star-shaped
+        points = [position, self[short_connection[0]].global_reference_point]
+        for ii in range(len(short_connection)-1):
+            points.append(self.intersection_matrix.get(short_connection[ii], short_connection[ii+1]))
+            points.append(self[short_connection[ii+1]].global_reference_point)
+
         angle_space_difference = 0
-        # for ii in range(len(short_connection)-1):
-        # for ii in range(1, len(short_connection)-1)):
-            # Under the assumption that everything is star-shaped
-        
         basis_direction = np.zeros(self.dim)
         basis_direction[0] = 1
-        transform_direction = self[ind_short_connection[0]].global_reference_point - position
-        angle_space_difference += get_directional_space(ref_dir, transform_direction)
-
-        for ii in range(0, len(short_connection)-1):
+        for ii in range(len(points)-1):
+            transform_direction = points[ii+1] - points[ii]
+            if not LA.norm(transform_direction): # Common reference point
+                continue
+            angle_space_difference += get_angle_space(basis_direction, transform_direction)
             basis_direction = transform_direction
-            transform_direction = self.intesection_points[ind_short_connection[ii+1], ind_short_connection[ii]] - self[ind_short_connection[ii]].global_reference_point
-            
-            angle_space_difference += get_directional_space(basis_direction, transform_direction)
-
-            basis_direction_= transform_direction
-            transform_dir = self[ind_short_connection[ii]].global_reference_point - self.intersection_points[ind_short_connection[ii+1], ind_short_connection[ii]]
-            angle_space_difference += get_directional_spaceget_directional_space(basis_direction, transform_direction)
 
         return angle_space_difference
 
-    def find_shortes_connection(self, ind_start, ind_end):
-        # Exploration search
-        # TODO: DEBUG AND VERIFY
-        # CREATE TESTING FUNCTION!!!!
-        it_list = [] # Search it list
-        siblings_list = [get_siblings(ind_start)]
-        flat_list = [siblings_list]
-        
-        path_not_found = True
-        it_list = [0 for ii in range(len(it_list)+1)] # increment of one
-        siblings_list.append(copy.deepcopy(siblings_list[-1]))
+    def get_adjacency_list(self):
+        ''' Intersecting obstacles of each obstacle (list of index-arrays); rebuilt when the intersections change '''
+        if self.intersection_matrix is None:
+            self.get_sibling_groups()
+
+        if self._adjacency_list is None or self._adjacency_version != self.intersection_matrix.version:
+            self._adjacency_list = self.intersection_matrix.get_adjacency_list()
+            self._adjacency_version = self.intersection_matrix.version
+        return self._adjacency_list
+
+    def get_reference_point_distance(self, index1, index2):
+        return LA.norm(self[index1].global_reference_point - self[index2].global_reference_point)
+
+    def find_shortes_connection(self, ind_start, ind_end, weighted=False):
+        '''
+        Shortest connection through intersecting obstacles (list of indices from ind_start to
+        ind_end, None if they are not connected). Breadth first search, or Dijkstra weighted
+        by the distance of the reference points.
+        The unweighted paths are cached (least recently used) for each version of the intersections.
+        The weighted paths are not cached, since the reference points change with the obstacles.
+        '''
+        neighbours = self.get_adjacency_list()
+        if weighted:
+            return get_shortest_path(neighbours, int(ind_start), int(ind_end),
+                                     weights=self.get_reference_point_distance)
+
+        key = (int(ind_start), int(ind_end), self._adjacency_version)
+        if key in self._path_cache:
+            self._path_cache.move_to_end(key)
+            return self._path_cache[key]
+
+        path = get_shortest_path(neighbours, key[0], key[1])
+
+        self._path_cache[key] = path
+        if len(self._path_cache) > self.path_cache_size:
+            self._path_cache.popitem(last=False)
+        return path
 
-        increment_level = -1
-        
-        while(path_not_found):
-            increment_in_process = True
-            # while(increment_in_process):
-            
-            eval_list = siblings_list[-2]
-            # for ii in range(len(it_list)):
-            # Increment get evaluation-list
-            ii=0
-            while(ii < range(len(it_list))):
-                # while len(it_list[ii]): #nonzero
-                    # it_list[ii] += 1
-                if ii==increment_level:
-                    it_list[ii] += 1
-
-                if it_list[ii] > len(eval_list):
-                    it_list[ii] = 0
-                    increment_level = (ii-1)
-                    if increment_level==0: # all siblings found
-                        siblings_list.append(copy.deepcopy(siblings_list[-1]))
-                        it_list.apppend(0)
-                        increment_level = len(it_list)-1
-                        ii = 0
-                        continue
-                    
-                    eval_list = siblings_list[-2]
-                    ii = 0
-                    continue
-                
-                eval_list = eval_list[it_list[ii]]
-                ii+=1
-                
-            increment_level = len(it_list)-1
-
-            fill_list = siblings_list[-1]                        
-            for ii in range(len(it_list)):
-                fill_list = fill_list[it_list[ii]]
-                
-            # Fill the list
-            for ii in range(1, len(it_list)):
-                fill_list = fill_list[it_list[ii]]
-                
-                if ind_end in fill_list[ii]:
-                    it_list.append(np.array(fill_list[ii] == ind_end)[0])
-                # while (ii<len(fill_list[-1])):
-                    # if temp_list[ii]==ind_end:
-                    # it_list[-1] = ii
-                    return it_list
-                    # path_not_found = False
-                    # break
-                
-                # Check for Duplicates
-                jj = 0
-                while (jj<len(fill_list[-1])):
-                    if fill_list[ii] in flat_list:
-                        del fill_list[jj]
-                        continue
-                    jj += 1
-                flat_list.append(fill_list[-1])
-
-
-            # # Increment
-            # increment_level = len(it_list)
-            # while(increment_level>0):
-            #     it_list[increment_level] += 1
-                
-            #     eval_list = siblings_list
-            #     for ii in range(len(it_list)-1):
-            #         eval_list = eval_list[it_list]
-
-            #         if len(eval_list)==0:
-            #             it_list[increment_level] = 0
-            #             increment_level -= 1
-            #             break
-
-            #         if (ii==increment_level and
-            #             it_list[increment_level] > len(eval_list)):
-            #             it_list[increment_level] = 0
-            #             increment_level -= 1
-            #             break
-
-            # siblings_list.append(copy.deepcopy(siblings_list))
-            
-            # if it_list[-1]>=len(eval_list):
-                # it_list[0]
-            
-            # break
-    
     def get_siblings(self, ind):
-        # TODO: use intersection matrix instead / maybe not
-        if self[ind].parent>=0:
-            return np.array([self[ind].parent] + self.ind_children)
-        else:
-            return np.array(self.ind_children)
-        
-        
+        ''' Intersecting obstacles of the obstacle ind '''
+        return self.get_adjacency_list()[ind]
@@ -28,14 +28,63 @@ from matplotlib import colors
 from matplotlib.colors import ListedColormap
 # import quaternion
 
-from sklearn import svm
-
 visualize_debug = False
 
+
+def get_rbf_kernel(position, support_vectors, gamma_svm, support_vectors_sq_norm=None):
+    '''
+    Rbf-kernel k(x, y) = exp(-gamma_svm*|x-y|^2) of the positions [dim x N] and the
+    support vectors [n_support x dim]. Returns [N x n_support]
+    '''
+    if support_vectors_sq_norm is None:
+        support_vectors_sq_norm = np.sum(support_vectors**2, axis=1)
+
+    sq_dist = (np.sum(position**2, axis=0)[:, np.newaxis]
+               + support_vectors_sq_norm[np.newaxis, :]
+               - 2*position.T.dot(support_vectors.T))
+    return np.exp(-gamma_svm*np.maximum(sq_dist, 0))
+
+
+def get_farthest_point_indices(points, n_points):
+    '''
+    Indices of n_points of the points [N x dim] which cover them evenly (farthest point
+    sampling starting at the first point).
+    '''
+    n_points = min(n_points, points.shape[0])
+    ind_selected = np.zeros(n_points, dtype=int)
+    min_dist = np.linalg.norm(points - points[0, :], axis=1)
+    for ii in range(1, n_points):
+        ind_selected[ii] = np.argmax(min_dist)
+        min_dist = np.minimum(min_dist, np.linalg.norm(points - points[ind_selected[ii], :], axis=1))
+    return ind_selected
+
+
+def learn_obstacle_from_cluster(cluster):
+    '''
+    Learn one obstacle (e.g. in a process pool).
+
+    INPUT
+    cluster [tuple]: (center_position, data_obs, data_free, learning_kwargs)
+
+    OUTPUT
+    obstacle [LearningObstacle]
+    '''
+    center_position, data_obs, data_free, learning_kwargs = cluster
+    obstacle = LearningObstacle(center_position=center_position)
+    obstacle.learn_obstacles_from_data(data_obs=data_obs, data_free=data_free, **learning_kwargs)
+    return obstacle
+
+
 class LearningObstacle(Obstacle):
     """ Obstacle is learned through any function.
     Note: compared to other obstacles, all the description are in the 'global' frame.
+
+    The svm is evaluated with numpy on the exported model (support_vectors, dual_coef,
+    intercept, gamma_svm); sklearn is only needed for learning.
     """
+    # Maximum number of positions which are evaluated at once (memory: svm_chunk_size x n_support)
+    svm_chunk_size = 2000
+
     # self.ellipse_type = dynamic_obstacle_avoidance.obstacle_avoidance.obstacle.Ellipse
     def __init__(self,
                  *args, **kwargs):
@@ -48,12 +97,47 @@ class LearningObstacle(Obstacle):
         self._cassifier_obstacle = None
 
         self._max_dist = 0
-    
-    def learn_obstacles_from_data(self, data_obs, data_free, gamma_svm=20, C_svm=20.0):
+
+        self._classifier = None
+        self.support_vectors = None
+        self.dual_coef = None
+        self.intercept = 0
+        self.gamma_svm = None
+        self.compression_error = None
+
+    @property
+    def n_support_vectors(self):
+        if self.support_vectors is None:
+            return 0
+        return self.support_vectors.shape[0]
+
+    def set_svm_model(self, support_vectors, dual_coef, intercept, gamma_svm):
+        '''
+        Set the rbf-svm which describes the obstacle.
+
+        INPUT
+        support_vectors [n_support x dim]
+        dual_coef [n_support]: dual coefficients (times the label) of the support vectors
+        intercept [float]
+        gamma_svm [float]: kernel width, i.e. k(x, y) = exp(-gamma_svm*|x-y|^2)
+        '''
+        self.support_vectors = np.ascontiguousarray(support_vectors, dtype=float)
+        self.dual_coef = np.ascontiguousarray(np.reshape(dual_coef, (-1)), dtype=float)
+        self.intercept = float(intercept)
+        self.gamma_svm = float(gamma_svm)
+
+        self._support_vectors_sq_norm = np.sum(self.support_vectors**2, axis=1)
+
+    def learn_obstacles_from_data(self, data_obs, data_free, gamma_svm=20, C_svm=20.0, support_budget=None):
+        ''' Learn the svm. The support vectors are compressed to support_budget (if given). '''
+        from sklearn import svm # Only needed for learning
+        
         data = np.hstack((data_free, data_obs))
         label = np.hstack(( np.zeros(data_free.shape[1]), np.ones(data_obs.shape[1]) ))
         self._classifier = svm.SVC(kernel='rbf', gamma=gamma_svm, C=C_svm).fit(data.T, label)
-        self.gamma_svm = gamma_svm
+
+        self.set_svm_model(self._classifier.support_vectors_, self._classifier.dual_coef_[0, :],
+                           self._classifier.intercept_[0], gamma_svm)
 
         print('Number of support vectors / data points')
         print('Free space: ({} / {}) --- Obstacle ({} / {})'.format(
@@ -63,6 +147,63 @@ class LearningObstacle(Obstacle):
         dist = np.linalg.norm(data_obs-np.tile(self.global_reference_point, (data_obs.shape[1], 1)).T, axis=0)
         self._max_dist = np.max(dist)
 
+        if not support_budget is None:
+            self.compress_support_vectors(data, n_support=support_budget)
+
+    def compress_support_vectors(self, data, n_support=None, reduction_factor=10, regularization=1e-6):
+        '''
+        Reduced-set approximation of the svm with a budget of support vectors.
+
+        The new support vectors are chosen by farthest point sampling of the current ones,
+        their coefficients and the intercept are refitted (regularized least squares) to the
+        score of the full model on the data.
+
+        INPUT
+        data [dim x N]: evaluation points of the fit (e.g. the training data)
+        n_support [int]: budget of support vectors (default: n_support_vectors/reduction_factor)
+
+        OUTPUT
+        compression_error [dict]: error of the compressed to the full model on the data
+            'score_max', 'score_mean': absolute error of the svm score
+            'label_mismatch': fraction of the data which changed the side of the boundary
+        '''
+        if n_support is None:
+            n_support = int(ceil(self.n_support_vectors/float(reduction_factor)))
+        n_support = max(1, n_support)
+
+        score_full = self.get_svm_score(data)
+        if n_support >= self.n_support_vectors:
+            self.compression_error = {'score_max': 0.0, 'score_mean': 0.0, 'label_mismatch': 0.0,
+                                      'n_support_full': self.n_support_vectors, 'n_support': self.n_support_vectors}
+            return self.compression_error
+
+        support_vectors = self.support_vectors[
+            get_farthest_point_indices(self.support_vectors, n_support), :]
+
+        # Columns: kernel of the new support vectors & intercept
+        kernel = np.hstack((get_rbf_kernel(data, support_vectors, self.gamma_svm),
+                            np.ones((data.shape[1], 1))))
+        kernel_sq = kernel.T.dot(kernel)
+        regularization = regularization*np.trace(kernel_sq)/kernel_sq.shape[0]
+        coefficients = LA.solve(kernel_sq + regularization*np.eye(kernel_sq.shape[0]),
+                                kernel.T.dot(score_full))
+
+        score_diff = np.abs(kernel.dot(coefficients) - score_full)
+        self.compression_error = {
+            'score_max': np.max(score_diff),
+            'score_mean': np.mean(score_diff),
+            'label_mismatch': np.mean((kernel.dot(coefficients)>0) != (score_full>0)),
+            'n_support_full': self.n_support_vectors,
+            'n_support': n_support}
+
+        self.set_svm_model(support_vectors, coefficients[:-1], coefficients[-1], self.gamma_svm)
+
+        print('Compressed support vectors ({} / {})'.format(n_support, self.compression_error['n_support_full']))
+        print('Score error (max / mean): ({:.3f} / {:.4f}) --- Label mismatch: {:.2f}%'.format(
+            self.compression_error['score_max'], self.compression_error['score_mean'],
+            self.compression_error['label_mismatch']*100))
+        return self.compression_error
+
     def draw_obstacle(self, fig=None, ax=None, show_contour=True, gamma_value=False):
         xx, yy = np.meshgrid(np.arange(0, 1, 0.01), np.arange(0, 1, 0.01))
 
@@ -75,7 +216,7 @@ class LearningObstacle(Obstacle):
             predict_score = predict_score - 1 # Subtract 1 to have differentiation boundary at 1
             plt.title("$\Gamma$-Score")
         else:
-            predict_score = self._classifier.decision_function(np.c_[xx.ravel(), yy.ravel()])
+            predict_score = self.get_svm_score(np.vstack((xx.ravel(), yy.ravel())))
             plt.title("SVM Score")
         predict_score = predict_score.reshape(xx.shape)
         # import pdb; pdb.set_trace() ## DEBUG ##
@@ -112,6 +253,42 @@ class LearningObstacle(Obstacle):
     # def load_obstacles_from_file(self, file_name):
         # raise NotImplementedError()
 
+    def get_svm_score(self, position, return_gradient=False):
+        '''
+        Decision function of the rbf-svm at the positions [dim x N] (global frame), i.e.
+        score = sum_i dual_coef_i * exp(-gamma_svm*|x-sv_i|^2) + intercept
+
+        The gradient reuses the kernel values (no additional pass over the support vectors):
+        d score / dx = 2*gamma_svm * sum_i dual_coef_i * k_i * (sv_i - x)
+
+        OUTPUT
+        score [N]
+        gradient [dim x N] (only if return_gradient)
+        '''
+        n_points = position.shape[1]
+        score = np.zeros(n_points)
+        if return_gradient:
+            gradient = np.zeros((self.dim, n_points))
+
+        for it_start in range(0, n_points, self.svm_chunk_size):
+            it_end = min(it_start+self.svm_chunk_size, n_points)
+            pos = position[:, it_start:it_end]
+
+            kernel_coef = get_rbf_kernel(pos, self.support_vectors, self.gamma_svm,
+                                         self._support_vectors_sq_norm) # [N x n_sv]
+            kernel_coef *= self.dual_coef
+
+            weight_sum = np.sum(kernel_coef, axis=1)
+            score[it_start:it_end] = weight_sum + self.intercept
+
+            if return_gradient:
+                gradient[:, it_start:it_end] = 2*self.gamma_svm*(
+                    self.support_vectors.T.dot(kernel_coef.T) - pos*weight_sum)
+
+        if return_gradient:
+            return score, gradient
+        return score
+
     def get_gamma(self, position, in_global_frame=True):
         ''' Gamma value is learned for each obstacle individually'''
         if not in_global_frame:
@@ -120,7 +297,7 @@ class LearningObstacle(Obstacle):
         pos_shape = position.shape
         position = position.reshape(self.dim, -1)
         
-        score = self._classifier.decision_function(np.c_[position[0, :].T, position[1, :].T])
+        score = self.get_svm_score(position)
         
         dist = np.linalg.norm(position - np.tile(self.global_reference_point, (position.shape[1], 1)).T, axis=0)
 
@@ -140,24 +317,48 @@ class LearningObstacle(Obstacle):
             gamma = gamma[0]
         return gamma
 
-    def get_normal_direction(self, position, in_global_frame=True, normalize=True, delta_dist=1.e-5):
-        ''' Numerical differentiation to of Gamma to get normal direction. '''
+    def get_gamma_and_normal(self, position, in_global_frame=True, normalize=True):
+        '''
+        Gamma and normal direction (gradient of Gamma) with one evaluation of the svm.
+
+        Gamma = (1-score) * distance_score, where the distance score only changes
+        between _max_dist and 2*_max_dist from the reference point.
+
+        OUTPUT
+        gamma [N] (float for a single position)
+        normals [dim x N] (in the frame of the input)
+        '''
         if not in_global_frame:
             position = self.transform_relative2global(position)
 
         pos_shape = position.shape
         positions = position.reshape(self.dim, -1)
+        n_points = positions.shape[1]
 
-        delta_dist = self.gamma_svm*delta_dist
+        score, score_gradient = self.get_svm_score(positions, return_gradient=True)
 
-        normals = np.zeros((positions.shape))
-        
-        for dd in range(self.dimension):
-            pos_low, pos_high = np.copy(positions), np.copy(positions)
-            pos_high[dd, :] = pos_high[dd, :] + delta_dist
-            pos_low[dd, :] = pos_low[dd, :] - delta_dist
+        ref_dir = positions - np.tile(self.global_reference_point, (n_points, 1)).T
+        dist_ref = np.linalg.norm(ref_dir, axis=0)
 
-            normals[dd, :] = (self.get_gamma(pos_high) - self.get_gamma(pos_low))/2*delta_dist
+        outer_ref_dist = self._max_dist*2.0
+        dist = np.clip(dist_ref, self._max_dist, outer_ref_dist)
+        ind_noninf = outer_ref_dist > dist
+
+        distance_score = (outer_ref_dist-self._max_dist)/(outer_ref_dist-dist[ind_noninf])
+
+        max_float = 1e12
+        gamma = np.ones(n_points)*max_float
+        gamma[ind_noninf] = (-score[ind_noninf] + 1) * distance_score
+
+        # Product rule (the distance score is constant outside of the interval)
+        normals = np.zeros((self.dim, n_points))
+        normals[:, ind_noninf] = -score_gradient[:, ind_noninf]*distance_score
+
+        ind_dist = ind_noninf & (dist_ref > self._max_dist)
+        if np.sum(ind_dist):
+            distance_gradient = ((outer_ref_dist-self._max_dist)/(outer_ref_dist-dist_ref[ind_dist])**2
+                                 * ref_dir[:, ind_dist]/dist_ref[ind_dist])
+            normals[:, ind_dist] = normals[:, ind_dist] + (-score[ind_dist] + 1)*distance_gradient
 
         if normalize:
             mag_normals = np.linalg.norm(normals, axis=0)
@@ -165,13 +366,15 @@ class LearningObstacle(Obstacle):
 
             if any(nonzero_ind):
                 normals[:, nonzero_ind] = normals[:, nonzero_ind] / mag_normals[nonzero_ind]
-            
+
         if not in_global_frame:
-            normals = self.transform_relative2global_dir(normals)
+            normals = self.transform_global2relative_dir(normals)
 
         if len(pos_shape)==1: # Same input as ouput format
+            gamma = gamma[0]
             normals = normals[:, 0]
+        return gamma, normals
 
-        # return (-1)*normals # due to gradent definition
-        return normals
-    
+    def get_normal_direction(self, position, in_global_frame=True, normalize=True):
+        ''' Normal direction from the analytic gradient of Gamma (rbf-kernel). '''
+        return self.get_gamma_and_normal(position, in_global_frame=in_global_frame, normalize=normalize)[1]
@@ -0,0 +1,146 @@
+'''
+Spatial index over the bounding spheres of the obstacles.
+
+Used to find the candidate obstacles of a query point without evaluating all obstacles
+of the environment (e.g. influence-radius culling of the modulation).
+
+@author Lukas Huber
+@date 2020-04-22
+'''
+
+import numpy as np
+import itertools
+
+
+class GridHashIndex():
+    '''
+    Uniform grid hash of spheres (center, radius). Each sphere is stored in all cells
+    which are touched by its bounding box. Spheres with infinite radius (or which cover
+    too many cells) are candidates for all query points.
+
+    centers [N x dim]
+    radius [N]
+    cell_size [float]: length of the (hyper-)cubic cells; default is twice the median radius
+    '''
+    def __init__(self, centers, radius, cell_size=None, max_cells_per_sphere=1000):
+        self.centers = np.array(centers, dtype=float)
+        self.radius = np.array(radius, dtype=float)
+
+        n_spheres, self.dim = self.centers.shape
+        ind_finite = np.isfinite(self.radius)
+
+        if cell_size is None:
+            if np.sum(ind_finite) and np.median(self.radius[ind_finite]) > 0:
+                cell_size = 2*np.median(self.radius[ind_finite])
+            else:
+                cell_size = 1.0
+        self.cell_size = cell_size
+
+        self._cells = {}
+        ind_global = []
+        for ii in range(n_spheres):
+            if not ind_finite[ii]:
+                ind_global.append(ii)
+                continue
+
+            cell_low = np.floor((self.centers[ii, :]-self.radius[ii])/self.cell_size).astype(int)
+            cell_high = np.floor((self.centers[ii, :]+self.radius[ii])/self.cell_size).astype(int)
+
+            if np.prod(cell_high-cell_low+1) > max_cells_per_sphere:
+                ind_global.append(ii)
+                continue
+
+            for key in itertools.product(*[range(cell_low[dd], cell_high[dd]+1) for dd in range(self.dim)]):
+                self._cells.setdefault(key, []).append(ii)
+
+        self._cells = {key: np.array(value, dtype=int) for key, value in self._cells.items()}
+        self._ind_global = np.array(ind_global, dtype=int)
+
+    def __len__(self):
+        return self.centers.shape[0]
+
+    @property
+    def num_cells(self):
+        return len(self._cells)
+
+    def query(self, position):
+        '''
+        Candidate spheres of the positions [dim x M], i.e. the position is inside the sphere.
+        Returns a boolean array [N x M]
+        '''
+        if len(position.shape)==1:
+            return self.query(np.reshape(position, (-1, 1)))[:, 0]
+
+        n_points = position.shape[1]
+        ind_candidate = np.zeros((len(self), n_points), dtype=bool)
+        ind_candidate[self._ind_global, :] = True
+
+        if not len(self._cells) or not n_points:
+            return ind_candidate
+
+        cells = np.floor(position/self.cell_size).astype(int)
+        cells_unique, ind_inverse = np.unique(cells, axis=1, return_inverse=True)
+        ind_inverse = np.reshape(ind_inverse, (-1))
+
+        for cc in range(cells_unique.shape[1]):
+            ind_spheres = self._cells.get(tuple(cells_unique[:, cc]))
+            if ind_spheres is None:
+                continue
+
+            ind_points = np.nonzero(ind_inverse==cc)[0]
+            dist = np.linalg.norm(position[:, np.newaxis, ind_points]
+                                  - self.centers[ind_spheres, :].T[:, :, np.newaxis], axis=0)
+            inside = dist < self.radius[ind_spheres, np.newaxis]
+            ind_candidate[np.ix_(ind_spheres, ind_points)] = inside
+
+        return ind_candidate
+
+
+def get_overlapping_box_pairs(box_low, box_high, sweep_axis=None):
+    '''
+    Pairs of overlapping axis aligned boxes (sweep and prune).
+
+    The boxes are sorted along the sweep axis (default: axis with the largest spread of
+    the boxes), each box is only compared to the following boxes which start before it
+    ends. Touching boxes are overlapping. Infinite boxes are allowed.
+
+    INPUT
+    box_low, box_high [N x dim]
+
+    OUTPUT
+    pairs [M x 2] (int): index pairs (ii, jj) with ii<jj in lexicographical order
+    '''
+    box_low = np.array(box_low, dtype=float)
+    box_high = np.array(box_high, dtype=float)
+    n_boxes, dim = box_low.shape
+
+    if sweep_axis is None:
+        ind_finite = np.all(np.isfinite(box_low) & np.isfinite(box_high), axis=1)
+        if np.sum(ind_finite) > 1:
+            center = 0.5*(box_low[ind_finite, :]+box_high[ind_finite, :])
+            sweep_axis = np.argmax(np.var(center, axis=0))
+        else:
+            sweep_axis = 0
+
+    ind_sort = np.argsort(box_low[:, sweep_axis], kind='mergesort')
+    low_sorted = box_low[ind_sort, sweep_axis]
+    # Boxes starting before the end of the box are the candidates
+    ind_end = np.searchsorted(low_sorted, box_high[ind_sort, sweep_axis], side='right')
+
+    pairs = []
+    for kk in range(n_boxes):
+        ind_candidate = ind_sort[kk+1:ind_end[kk]]
+        if not ind_candidate.shape[0]:
+            continue
+
+        ii = ind_sort[kk]
+        is_overlapping = np.all((box_low[ind_candidate, :] <= box_high[ii, :])
+                                & (box_high[ind_candidate, :] >= box_low[ii, :]), axis=1)
+        ind_candidate = ind_candidate[is_overlapping]
+        pairs.append(np.vstack((np.minimum(ii, ind_candidate), np.maximum(ii, ind_candidate))).T)
+
+    if not len(pairs):
+        return np.zeros((0, 2), dtype=int)
+
+    pairs = np.vstack(pairs)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0])), :]
@@ -10,7 +10,6 @@ import time
 from dynamic_obstacle_avoidance.obstacle_avoidance.state import *
 from dynamic_obstacle_avoidance.obstacle_avoidance.modulation import *
 
-import matplotlib.pyplot as plt # for debugging
 
 class State(object):
     def __init__(self, typename=None, name="default", reference_frame="world", is_empty=True, *args):
@@ -0,0 +1,163 @@
+'''
+Evaluation of the initial and the modulated dynamical system on many positions
+(e.g. the grid of a vector field). No plotting is done here.
+
+The positions are split into chunks (tiles), which are evaluated with the batch
+modulation (if available) and / or distributed over a process pool. The dynamical
+system is only evaluated on all positions of a chunk at once if it is known to be
+array-safe (batch_dynamical_systems), otherwise position by position.
+The output is ordered as the input independent of the number of workers.
+The modulation statistics of the workers are added to the statistics of the calling process.
+
+@author Lukas Huber
+@date 2020-05-02
+'''
+
+import numpy as np
+import multiprocessing
+
+from dynamic_obstacle_avoidance.dynamical_system.dynamical_system_representation import linearAttractor
+from dynamic_obstacle_avoidance.obstacle_avoidance.linear_modulations import obs_avoidance_interpolation_moving, obs_avoidance_interpolation_moving_batch
+from dynamic_obstacle_avoidance.obstacle_avoidance.modulation import reset_modulation_statistics, get_modulation_statistics, add_modulation_statistics
+
+
+# Modulation functions and their batch version (evaluated on [dim x N])
+batch_modulation_functions = {
+    obs_avoidance_interpolation_moving: obs_avoidance_interpolation_moving_batch,
+}
+
+# Dynamical systems which can be evaluated on positions [dim x N] (with the attractor [dim x 1])
+batch_dynamical_systems = set([linearAttractor])
+
+# Environment of the process pool (is set once per worker, not for each chunk)
+worker_environment = {}
+
+
+def set_worker_environment(environment):
+    worker_environment.clear()
+    worker_environment.update(environment)
+
+
+def evaluate_vector_field_chunk(positions, obs=None, dynamicalSystem=None, xAttractor=None, obs_avoidance_func=None, attractingRegion=False, use_batch=True):
+    '''
+    Initial and modulated DS at the positions [dim x N] of one chunk.
+    The arguments which are not given are taken from the worker environment.
+
+    OUTPUT
+    xd_init, xd_mod [dim x N]
+    '''
+    if obs is None:
+        obs = worker_environment['obs']
+        dynamicalSystem = worker_environment['dynamicalSystem']
+        xAttractor = worker_environment['xAttractor']
+        obs_avoidance_func = worker_environment['obs_avoidance_func']
+        attractingRegion = worker_environment['attractingRegion']
+        use_batch = worker_environment['use_batch']
+
+    dim, n_points = positions.shape
+
+    if use_batch and dynamicalSystem in batch_dynamical_systems:
+        # The dynamical system is evaluated on arrays (attractor of shape [dim x 1])
+        xd_init = dynamicalSystem(positions, x0=np.reshape(xAttractor, (dim, 1)))
+    else:
+        xd_init = np.zeros((dim, n_points))
+        for ii in range(n_points):
+            xd_init[:, ii] = dynamicalSystem(positions[:, ii], x0=xAttractor) # initial DS
+
+    if (use_batch and not attractingRegion
+        and obs_avoidance_func in batch_modulation_functions):
+        xd_mod = batch_modulation_functions[obs_avoidance_func](positions, xd_init, obs)
+        return xd_init, xd_mod
+
+    xd_mod = np.zeros((dim, n_points))
+    for ii in range(n_points):
+        if attractingRegion: # Forced to attracting Region
+            xd_mod[:, ii] = obs_avoidance_func(positions[:, ii], xd_init[:, ii], obs, xAttractor)
+        else:
+            xd_mod[:, ii] = obs_avoidance_func(positions[:, ii], xd_init[:, ii], obs) # modulataed DS with IFS
+    return xd_init, xd_mod
+
+
+def evaluate_vector_field_chunk_worker(positions):
+    ''' Evaluation of a chunk in a pool worker, returns the modulation statistics of the chunk as well. '''
+    reset_modulation_statistics()
+    xd_init, xd_mod = evaluate_vector_field_chunk(positions)
+    return xd_init, xd_mod, get_modulation_statistics()
+
+
+def evaluate_vector_field(positions, obs=[], dynamicalSystem=linearAttractor, xAttractor=None, obs_avoidance_func=obs_avoidance_interpolation_moving, attractingRegion=False, chunk_size=None, n_workers=1, use_batch=True):
+    '''
+    Evaluate the initial and the modulated dynamical system at all positions.
+
+    INPUT
+    positions [dim x N]
+    obs [list of obstacle_class / ObstacleContainer]: the obstacles have to be picklable for n_workers>1
+    dynamicalSystem: called as dynamicalSystem(x, x0=xAttractor) for each position; if it is listed in
+        batch_dynamical_systems and use_batch is True, it is called once with x [dim x N]
+    obs_avoidance_func: modulation of one position; the batch version is used instead if it is
+        listed in batch_modulation_functions and use_batch is True
+    chunk_size [int]: number of positions per chunk (default: all positions are split equally over the workers)
+    n_workers [int]: number of processes (None: number of cpus)
+
+    OUTPUT
+    xd_init, xd_mod [dim x N]: initial and modulated DS (in the order of the positions)
+    '''
+    positions = np.array(positions, dtype=float)
+    dim, n_points = positions.shape
+
+    if xAttractor is None:
+        xAttractor = np.zeros(dim)
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    if chunk_size is None:
+        chunk_size = int(np.ceil(n_points/float(n_workers)))
+    chunk_size = max(1, chunk_size)
+
+    chunks = [positions[:, ii:ii+chunk_size] for ii in range(0, n_points, chunk_size)]
+
+    environment = {'obs': obs, 'dynamicalSystem': dynamicalSystem, 'xAttractor': xAttractor,
+                   'obs_avoidance_func': obs_avoidance_func, 'attractingRegion': attractingRegion,
+                   'use_batch': use_batch}
+
+    if n_workers > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(processes=min(n_workers, len(chunks)),
+                                    initializer=set_worker_environment, initargs=(environment,))
+        try:
+            results = pool.map(evaluate_vector_field_chunk_worker, chunks) # Keeps the order of the chunks
+        finally:
+            pool.close()
+            pool.join()
+
+        for result in results:
+            add_modulation_statistics(result[2])
+        results = [result[:2] for result in results]
+    else:
+        results = [evaluate_vector_field_chunk(chunk, **environment) for chunk in chunks]
+
+    xd_init = np.zeros((dim, n_points))
+    xd_mod = np.zeros((dim, n_points))
+    it_start = 0
+    for xd_init_chunk, xd_mod_chunk in results:
+        it_end = it_start + xd_init_chunk.shape[1]
+        xd_init[:, it_start:it_end] = xd_init_chunk
+        xd_mod[:, it_start:it_end] = xd_mod_chunk
+        it_start = it_end
+
+    return xd_init, xd_mod
+
+
+def evaluate_vector_field_grid(XX, YY, *args, **kwargs):
+    '''
+    Evaluate the vector field on the meshgrid XX, YY [N_x x N_y]
+    (arguments as evaluate_vector_field).
+
+    OUTPUT
+    xd_init, xd_mod [2 x N_x x N_y]
+    '''
+    grid_shape = XX.shape
+    positions = np.vstack((np.reshape(XX, (-1)), np.reshape(YY, (-1))))
+
+    xd_init, xd_mod = evaluate_vector_field(positions, *args, **kwargs)
+    return (np.reshape(xd_init, (2,)+grid_shape), np.reshape(xd_mod, (2,)+grid_shape))
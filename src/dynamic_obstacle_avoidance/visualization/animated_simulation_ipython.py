@@ -54,7 +54,7 @@ def samplePointsAtBorder_ipython(number_of_points, x_range, y_range, obs=[]):
                                    np.linspace(y_range[0]+ySpacing,y_range[1]-ySpacing, num=N_y) )) ))
     if len(obs):
         collisions = obs_check_collision(x_init, obs)
-        x_init = x_init[:,collisions[0]]
+        x_init = x_init[:,collisions]
         
     return x_init
 
@@ -98,6 +98,7 @@ class Animated_ipython():
         self.dynamicalSystem = dynamicalSystem
 
         self.converged = False
+        self.common_section_tracker = CommonSectionTracker()
     
         self.iSim = 0
 
@@ -187,20 +188,23 @@ class Animated_ipython():
                 else:
                     self.obs_polygon[o].xyz = self.obs[o].x_obs
 
-        intersection_obs = obs_common_section(self.obs)
-        dynamic_center_3d(self.obs, intersection_obs)
+        # Reference points are only updated for obstacles which moved
+        intersection_obs = self.common_section_tracker.update(self.obs)
         
+        # Trajectories which reached the attractor are not evaluated anymore
+        attractor = np.reshape(self.attractorPos, (self.dim, 1))
+        ind_active = np.sum((self.x_pos[:, self.iSim, :]-attractor)**2, axis=0) >= self.convergenceMargin
+
         if self.RK4_int: # Runge kutta integration
-            for j in range(self.N_points):
-                self.x_pos[:, self.iSim+1,j] = obs_avoidance_rk4(self.dt, self.x_pos[:,self.iSim,j], self.obs, x0=self.attractorPos, obs_avoidance = obs_avoidance_interpolation_moving)
+            self.x_pos[:, self.iSim+1, :] = obs_avoidance_rk4_batch(self.dt, self.x_pos[:, self.iSim, :], self.obs, x0=self.attractorPos, ind_active=ind_active)
 
         else: # Simple euler integration
             # Calculate DS
-            for j in range(self.N_points):
-                xd_temp = linearAttractor(self.x_pos[:,self.iSim, j], self.attractorPos)
-                
-                self.xd_ds[:,self.iSim,j] = obs_avoidance_interpolation_moving(self.x_pos[:,self.iSim, j], xd_temp, self.obs)
-                self.x_pos[:,self.iSim+1,:] = self.x_pos[:,self.iSim, :] + self.xd_ds[:,self.iSim, :]*self.dt
+            self.xd_ds[:, self.iSim, :] = 0
+            if np.sum(ind_active):
+                xd_temp = linearAttractor(self.x_pos[:, self.iSim, ind_active], attractor)
+                self.xd_ds[:, self.iSim, ind_active] = obs_avoidance_interpolation_moving_batch(self.x_pos[:, self.iSim, ind_active], xd_temp, self.obs)
+            self.x_pos[:, self.iSim+1, :] = self.x_pos[:, self.iSim, :] + self.xd_ds[:, self.iSim, :]*self.dt
 
         # Update plots
         for j in range(self.N_points):
@@ -233,7 +237,7 @@ class Animated_ipython():
         
         # Numerical hull of ellipsoid
         for n in range(len(self.obs)):
-            self.obs[n].draw_ellipsoid(numPoints=50) # 50 points resolution
+            self.obs[n].boundary_resolution = 50 # 50 points resolution (drawn on demand)
 
         for n in range(len(self.obs)):
             if self.dim==2:
@@ -17,6 +17,7 @@ import matplotlib
 
 from dynamic_obstacle_avoidance.dynamical_system import *
 from dynamic_obstacle_avoidance.obstacle_avoidance.linear_modulations import *
+from dynamic_obstacle_avoidance.obstacle_avoidance.vector_field_evaluation import evaluate_vector_field_grid
 from dynamic_obstacle_avoidance.obstacle_avoidance.obs_common_section import *
 from dynamic_obstacle_avoidance.obstacle_avoidance.obs_dynamic_center_3d import *
 
@@ -39,25 +40,14 @@ def plot_streamlines(points_init, ax, obs=[], attractorPos=[0,0],
     
     n_points = np.array(points_init).shape[1]
 
-    x_pos = np.zeros((dim, max_simu_step+1, n_points))
-    x_pos[:,0,:] = points_init
+    # All trajectories are integrated at once, converged ones are not evaluated anymore
+    x_pos, ind_converged = obs_avoidance_rk4_trajectories(
+        dt, np.array(points_init)[:dim, :], obs, max_simu_step=max_simu_step,
+        convergence_margin=convergence_margin, x0=attractorPos)
 
-    it_count = 0
-    for iSim in range(max_simu_step):
-        for j in range(n_points):
-            x_pos[:, iSim+1,j] = obs_avoidance_rk4(
-                dt, x_pos[:,iSim, j], obs, x0=attractorPos,
-                obs_avoidance=obs_avoidance_interpolation_moving)
+    if np.all(ind_converged):
+        print("Convergence reached after {} iterations.".format(x_pos.shape[1]-1))
 
-         # Check convergence
-        if (np.sum((x_pos[:, iSim+1, :]-np.tile(attractorPos, (n_points,1)).T)**2)
-            < convergence_margin):
-            x_pos = x_pos[:, :iSim+2, :]
-
-            print("Convergence reached after {} iterations.".format(it_count))
-            break
-
-        it_count += 1
     for j in range(n_points):
         ax.plot(x_pos[0, :, j], x_pos[1, :, j], '--', lineWidth=4)
         ax.plot(x_pos[0, 0, j], x_pos[1, 0, j], 'k*', markeredgewidth=4, markersize=13)
@@ -65,12 +55,14 @@ def plot_streamlines(points_init, ax, obs=[], attractorPos=[0,0],
     # return x_pos
 
     
-def Simulation_vectorFields(x_range=[0,10], y_range=[0,10], point_grid=10, obs=[], sysDyn_init=False, xAttractor = np.array(([0,0])), saveFigure=False, figName='default', noTicks=True, showLabel=True, figureSize=(12.,9.5), obs_avoidance_func=obs_avoidance_interpolation_moving, attractingRegion=False, drawVelArrow=False, colorCode=False, streamColor=[0.05,0.05,0.7], obstacleColor=[], plotObstacle=True, plotStream=True, figHandle=[], alphaVal=1, dynamicalSystem=linearAttractor, draw_vectorField=True, points_init=[], show_obstacle_number=False, automatic_reference_point=True, returnFigureHandle=False):
+def Simulation_vectorFields(x_range=[0,10], y_range=[0,10], point_grid=10, obs=[], sysDyn_init=False, xAttractor = np.array(([0,0])), saveFigure=False, figName='default', noTicks=True, showLabel=True, figureSize=(12.,9.5), obs_avoidance_func=obs_avoidance_interpolation_moving, attractingRegion=False, drawVelArrow=False, colorCode=False, streamColor=[0.05,0.05,0.7], obstacleColor=[], plotObstacle=True, plotStream=True, figHandle=[], alphaVal=1, dynamicalSystem=linearAttractor, draw_vectorField=True, points_init=[], show_obstacle_number=False, automatic_reference_point=True, returnFigureHandle=False, chunk_size=None, n_workers=1, use_batch=True):
     dim = 2
 
     # Numerical hull of ellipsoid 
     for n in range(len(obs)): 
-        obs[n].draw_obstacle(numPoints=50) # 50 points resolution 
+        obs[n].boundary_resolution = 50 # 50 points resolution (drawn on demand)
+        if not obs[n].lazy_boundary_points:
+            obs[n].draw_obstacle(numPoints=50)
 
     # Adjust dynamic center
     if automatic_reference_point:
@@ -224,23 +216,11 @@ def Simulation_vectorFields(x_range=[0,10], y_range=[0,10], point_grid=10, obs=[
     ########## STOP REMOVE ###########
 
 
-    if attractingRegion: # Forced to attracting Region
-        def obs_avoidance_temp(x, xd, obs):
-            return obs_avoidance_func(x, xd, obs, xAttractor)
-        
-        obs_avoidance= obs_avoidance_temp
-    else:
-        obs_avoidance = obs_avoidance_func
-        
-    xd_init = np.zeros((2,N_x,N_y))
-    xd_mod  = np.zeros((2,N_x,N_y))
-
-    for ix in range(N_x):
-        for iy in range(N_y):
-            pos = np.array([XX[ix,iy],YY[ix,iy]])
-
-            xd_init[:,ix,iy] = dynamicalSystem(pos, x0=xAttractor) # initial DS
-            xd_mod[:,ix,iy] = obs_avoidance(pos, xd_init[:,ix,iy], obs) # modulataed DS with IFS
+    # Evaluation of the DS on the grid (chunks / process pool, see vector_field_evaluation)
+    xd_init, xd_mod = evaluate_vector_field_grid(
+        XX, YY, obs=obs, dynamicalSystem=dynamicalSystem, xAttractor=xAttractor,
+        obs_avoidance_func=obs_avoidance_func, attractingRegion=attractingRegion,
+        chunk_size=chunk_size, n_workers=n_workers, use_batch=use_batch)
 
     if sysDyn_init:
         fig_init, ax_init = plt.subplots(figsize=(5,2.5))